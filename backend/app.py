@@ -1,9 +1,8 @@
 """Main Flask application for CityFix backend."""
-from flask import Flask
+from flask import Flask, request
 from flask_cors import CORS
 from config import config
 import os
-from datetime import datetime, timedelta
 
 
 def create_app(config_name='default'):
@@ -16,7 +15,7 @@ def create_app(config_name='default'):
         r"/api/*": {
             "origins": ["http://localhost:3000", "http://localhost:5000"],
             "methods": ["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"],
-            "allow_headers": ["Content-Type", "Authorization"],
+            "allow_headers": ["Content-Type", "Authorization", "Idempotency-Key"],
             "supports_credentials": True
         }
     })
@@ -27,16 +26,32 @@ def create_app(config_name='default'):
         response.headers.add('Access-Control-Allow-Origin',
                              'http://localhost:3000')
         response.headers.add('Access-Control-Allow-Headers',
-                             'Content-Type,Authorization')
+                             'Content-Type,Authorization,Idempotency-Key')
         response.headers.add('Access-Control-Allow-Methods',
                              'GET,POST,PUT,PATCH,DELETE,OPTIONS')
         response.headers.add('Access-Control-Allow-Credentials', 'true')
         return response
 
+    # Per-endpoint latency/status metrics, served at /metrics
+    from services import metrics, serialization, tracing
+    metrics.init_app(app)
+    # Server-Timing breakdown and slow-request trace log
+    tracing.init_app(app)
+    # orjson encoding and gzip/brotli for large responses
+    serialization.init_app(app)
+
     # Initialize Firebase
     from services.firebase_service import initialize_firebase
     initialize_firebase(app.config['FIREBASE_CREDENTIALS_PATH'])
 
+    # Keep cached admin roles current
+    from services.user_service import start_admin_listener
+    start_admin_listener()
+
+    # Warm analytics rollups off the request path
+    from services.timeseries_service import start_background_load
+    start_background_load()
+
     # Register blueprints
     from routes import auth_bp, complaints_bp, admin_bp, ai_bp
     app.register_blueprint(auth_bp, url_prefix='/api/auth')
@@ -44,91 +59,22 @@ def create_app(config_name='default'):
     app.register_blueprint(admin_bp, url_prefix='/api/admin')
     app.register_blueprint(ai_bp, url_prefix='/api/ai')
 
-    # Optional: Background daily/weekly summaries via APScheduler
+    # Background jobs via APScheduler
     try:
         from apscheduler.schedulers.background import BackgroundScheduler
-        scheduler = BackgroundScheduler()
-
-        def _generate_daily_summary():
-            try:
-                from services.firebase_service import get_firestore
-                from services.gemini_service import weekly_summary_bullets
-                db = get_firestore()
-
-                # Collect last 7 days issues (use 'issues' collection to match frontend)
-                # Fallback if lack of index: fetch recent 300 and filter client-side
-                try:
-                    issues_ref = db.collection('issues').order_by(
-                        'createdAt', direction='DESCENDING').limit(300)
-                    docs = list(issues_ref.stream())
-                except Exception:
-                    docs = list(db.collection('issues').limit(300).stream())
-                now = datetime.utcnow()
-                seven_days_ago = now - timedelta(days=7)
-
-                items = []
-                total = 0
-                resolved = 0
-                by_type = {}
-                for d in docs:
-                    data = d.to_dict() or {}
-                    created = data.get('createdAt') or data.get('created_at')
-                    # createdAt may be ISO string or Timestamp; be tolerant
-                    try:
-                        if created and hasattr(created, 'to_datetime'):
-                            created_dt = created.to_datetime()
-                        elif created and hasattr(created, 'timestamp'):
-                            created_dt = created
-                        else:
-                            created_dt = datetime.fromisoformat(
-                                str(created).replace('Z', '+00:00')) if created else None
-                    except Exception:
-                        created_dt = None
-                    if not created_dt or created_dt < seven_days_ago:
-                        continue
-                    total += 1
-                    status = (data.get('status') or '').lower()
-                    if status in ('resolved', 'closed'):
-                        resolved += 1
-                    tags = data.get('tags') or []
-                    itype = data.get('category') or (
-                        tags[0] if tags else 'other')
-                    by_type[itype] = by_type.get(itype, 0) + 1
-                    items.append({
-                        'id': d.id,
-                        'category': data.get('category'),
-                        'priority': data.get('priority'),
-                        'status': data.get('status'),
-                        'location': data.get('location')
-                    })
-
-                stats = {
-                    'total_new': total,
-                    'resolved': resolved,
-                    'pending': max(0, total - resolved),
-                    'by_type': by_type,
-                }
-                bullets = weekly_summary_bullets(stats, items)
-                report = {
-                    'generated_at': __import__('firebase_admin').firestore.SERVER_TIMESTAMP,
-                    'period_days': 7,
-                    'stats': stats,
-                    'bullets': bullets,
-                }
-                db.collection('reports').document('weekly_summary').set(report)
-            except Exception as e:
-                print(f"Summary generation error: {e}")
-
-        # Run every 24 hours
-        scheduler.add_job(_generate_daily_summary, 'interval',
-                          hours=24, id='daily_summary')
+        scheduler = BackgroundScheduler(timezone='UTC')
+
+        # Persist this worker's rollup shard and pick up the other workers' counts
+        from services.timeseries_service import persist_snapshots
+        scheduler.add_job(persist_snapshots, 'interval',
+                          minutes=app.config['ROLLUP_SNAPSHOT_MINUTES'],
+                          id='rollup_snapshots')
+
+        # Weekly summary and manual runs, executed once across workers
+        if app.config['RUN_SCHEDULER_IN_WEB']:
+            from services.scheduler_service import register_jobs
+            register_jobs(scheduler)
         scheduler.start()
-
-        # Expose manual trigger endpoint under admin
-        @app.route('/api/admin/generate-report', methods=['POST'])
-        def manual_generate_report():
-            _generate_daily_summary()
-            return {'ok': True}, 200
     except Exception as e:
         print(f"APScheduler not configured: {e}")
 
@@ -136,7 +82,7 @@ def create_app(config_name='default'):
     @app.route('/api/_debug/storage')
     def debug_storage():
         try:
-            from services.firebase_service import get_storage
+            from services.firebase_service import get_storage, check_bucket_health
             info = {
                 'bucket_name': None,
                 'exists': None,
@@ -144,15 +90,46 @@ def create_app(config_name='default'):
             }
             bucket = get_storage()
             info['bucket_name'] = getattr(bucket, 'name', None)
-            try:
-                info['exists'] = bucket.exists()
-            except Exception as e:
+            # Explicit check here also refreshes the cached health
+            health = check_bucket_health()
+            info['exists'] = health['exists']
+            if health.get('error'):
                 info['exists'] = False
-                info['error'] = str(e)
+                info['error'] = health['error']
             return info, 200
         except Exception as e:
             return {'error': str(e)}, 500
 
+    def cache_stats():
+        from services.firebase_service import token_cache_stats
+        from services.tile_service import cache_stats as tile_cache_stats
+        from services.user_service import profile_cache_stats, write_behind_stats
+        from services.prefetch_service import prefetch_stats
+        from services.resolution_service import resolution_stats
+        return {
+            'auth_tokens': token_cache_stats(),
+            'user_profiles': profile_cache_stats(),
+            'profile_write_behind': write_behind_stats(),
+            'tiles': tile_cache_stats(),
+            'ai_prefetch': prefetch_stats(),
+            'resolution': resolution_stats(),
+        }
+
+    # Cache hit ratios (dev-only)
+    @app.route('/api/_debug/caches')
+    def debug_caches():
+        return cache_stats(), 200
+
+    # Prometheus scrape endpoint
+    metrics.register_collector('caches', metrics.cache_collector(cache_stats))
+
+    @app.route('/metrics')
+    def prometheus_metrics():
+        token = app.config['METRICS_TOKEN']
+        if token and request.headers.get('Authorization') != f'Bearer {token}':
+            return {'error': 'Unauthorized'}, 401
+        return metrics.prometheus_response()
+
     # Firestore connectivity debug (dev-only)
     @app.route('/api/_debug/firestore')
     def debug_firestore():
@@ -167,7 +144,12 @@ def create_app(config_name='default'):
     # Health check endpoint
     @app.route('/api/health')
     def health_check():
-        return {'status': 'healthy', 'message': 'CityFix API is running'}, 200
+        from services.circuit_breaker import states, CLOSED
+        ai = states()
+        # Degraded, not down: complaints are still accepted and enriched later
+        degraded = any(snap['state'] != CLOSED for snap in ai.values())
+        return {'status': 'degraded' if degraded else 'healthy',
+                'message': 'CityFix API is running', 'ai': ai}, 200
 
     # Root endpoint
     @app.route('/')
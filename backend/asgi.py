@@ -0,0 +1,444 @@
+"""ASGI entry point with native async AI routes.
+
+The Flask views are synchronous: a view waiting on Gemini holds its worker
+thread for the whole model call, so a few slow AI requests can starve cheap
+endpoints such as `/api/health` and the list views. Served through this
+module instead:
+
+- JSON requests to the AI routes in NATIVE_ROUTES run on the event loop
+  (async Gemini SDK calls, httpx for photo downloads) and hold no thread
+  while the model works;
+- every other request runs the Flask app on a bounded thread pool
+  (ASGI_WSGI_THREADS);
+- native routes go through the same per-user/per-IP rate limits and AI
+  concurrency gate (services/admission.py) as the Flask views. For the AI
+  views that stay on Flask (LIMITED_ROUTES) the gate slot is taken here,
+  on the event loop, so queued AI requests never sit on a pool thread;
+- native routes run the same request functions as the Flask views
+  (routes/ai.py), awaiting async twins of their model calls and downloads,
+  and answer with the same Server-Timing header.
+
+Usage:
+    uvicorn asgi:app --host 0.0.0.0 --port 5000 --workers 4
+"""
+from asgiref.sync import async_to_sync, sync_to_async
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from config import Config
+from time import perf_counter
+from typing import Any, Dict, Optional, Tuple
+from PIL import Image
+import asyncio
+import httpx
+import io
+import json
+import os
+import sys
+import tempfile
+
+from app import create_app
+from services import admission, firebase_service, gemini_service, metrics, prefetch_service, tracing
+from services.enrichment_service import fetch_analysis_image
+from services.image_service import derivative_url, object_path_from_url
+from routes import ai as ai_routes
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, payload: Dict[str, Any], headers=None):
+        super().__init__(payload.get('error'))
+        self.status = status
+        self.payload = payload
+        self.headers = headers or {}
+
+
+class PooledWsgiToAsgi:
+    """Serves a WSGI app to ASGI HTTP requests on a bounded thread pool.
+
+    asgiref's WsgiToAsgi runs every request on its single thread-sensitive
+    thread, which would serialize the Flask app. This adapter builds the
+    PEP 3333 environ itself and runs the app with sync_to_async on our own
+    executor; the response is sent back with async_to_sync, chunk by chunk,
+    so streamed responses (exports) stay streamed.
+    """
+
+    def __init__(self, wsgi_application, threads: int):
+        self.wsgi_application = wsgi_application
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='wsgi')
+
+    async def __call__(self, scope, receive, send, extra_environ=None, max_body=None):
+        """Raises HttpError(413) before the app runs if the body exceeds `max_body`."""
+        if max_body is not None:
+            declared = dict(scope.get('headers', [])).get(b'content-length', b'')
+            if declared.isdigit() and int(declared) > max_body:
+                raise HttpError(413, {'error': 'Request body too large'})
+        # Spooled like asgiref does: small bodies stay in memory. Read here on
+        # the event loop, so a slow upload never holds a pool thread
+        body = tempfile.SpooledTemporaryFile(max_size=65536)
+        try:
+            size = 0
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                chunk = message.get('body', b'')
+                size += len(chunk)
+                # Also covers chunked bodies and a wrong Content-Length
+                if max_body is not None and size > max_body:
+                    raise HttpError(413, {'error': 'Request body too large'})
+                body.write(chunk)
+                if not message.get('more_body'):
+                    break
+            body.seek(0)
+            run = sync_to_async(self.run_wsgi_app, thread_sensitive=False, executor=self.executor)
+            environ = self.environ(scope, body)
+            environ.update(extra_environ or {})
+            await run(environ, send)
+        finally:
+            body.close()
+
+    @staticmethod
+    def environ(scope, body) -> Dict[str, Any]:
+        root_path = scope.get('root_path', '')
+        path = scope['path']
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': root_path.encode('utf8').decode('latin1'),
+            'PATH_INFO': path.encode('utf8').decode('latin1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('ascii'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1] or 80),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        if scope.get('client'):
+            environ['REMOTE_ADDR'] = scope['client'][0]
+            environ['REMOTE_PORT'] = str(scope['client'][1])
+        for raw_name, raw_value in scope.get('headers', []):
+            name = raw_name.decode('latin1').upper().replace('-', '_')
+            value = raw_value.decode('latin1')
+            if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+                environ[name] = value
+                continue
+            key = f'HTTP_{name}'
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+        return environ
+
+    def run_wsgi_app(self, environ, send):
+        """Runs on a pool thread: call the app and relay its response."""
+        send_sync = async_to_sync(send)
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['start'] = {
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin1'), value.encode('latin1'))
+                            for name, value in headers],
+            }
+
+        result = self.wsgi_application(environ, start_response)
+        try:
+            for chunk in result:
+                if not response.get('sent'):
+                    send_sync(response['start'])
+                    response['sent'] = True
+                if chunk:
+                    send_sync({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            if not response.get('sent'):
+                send_sync(response['start'])
+            send_sync({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+
+class Request:
+    def __init__(self, headers: Dict[str, str], body: bytes, ip: Optional[str] = None):
+        self.headers = headers
+        self.body = body
+        self.ip = ip
+        self.user = None
+
+    @property
+    def json(self) -> Dict[str, Any]:
+        # Same leniency as Flask's get_json(silent=True)
+        try:
+            data = json.loads(self.body or b'{}')
+        except ValueError:
+            return {}
+        return data if isinstance(data, dict) else {}
+
+
+# --------------------- Async helpers ---------------------
+
+_http: Optional[httpx.AsyncClient] = None
+
+
+def http_client() -> httpx.AsyncClient:
+    global _http
+    if _http is None:
+        # No redirects: only Storage URLs are fetched, and they never redirect
+        _http = httpx.AsyncClient(timeout=10)
+    return _http
+
+
+async def fetch_image_async(url: str, timeout: float = 10):
+    with metrics.timer('image_fetch', 'get'):
+        resp = await http_client().get(url, timeout=timeout)
+        resp.raise_for_status()
+    return Image.open(io.BytesIO(resp.content))
+
+
+async def fetch_analysis_image_async(url: str, timeout: float = 10):
+    """Async twin of enrichment_service.fetch_analysis_image."""
+    small = derivative_url(url, 'analysis')
+    if small:
+        try:
+            return await fetch_image_async(small, timeout)
+        except Exception:
+            pass
+    return await fetch_image_async(url, timeout)
+
+
+async def authenticate(request: Request) -> Dict[str, Any]:
+    token = request.headers.get('authorization')
+    if not token:
+        raise HttpError(401, {'error': 'No token provided'})
+    if token.startswith('Bearer '):
+        token = token[7:]
+    # Usually a cache hit; a miss does blocking certificate work
+    decoded = await asyncio.to_thread(firebase_service.verify_token, token)
+    if not decoded:
+        raise HttpError(401, {'error': 'Invalid or expired token'})
+    request.user = decoded
+    return decoded
+
+
+async def check_rates(route_class: str, uid: Optional[str] = None, ip: Optional[str] = None):
+    if not Config.ADMISSION_ENABLED:
+        return
+    if admission.get_store().remote:
+        await asyncio.to_thread(admission.check_rates, route_class, uid, ip)
+    else:
+        admission.check_rates(route_class, uid, ip)
+
+
+@asynccontextmanager
+async def gate_slot(route_class: str, route: str):
+    """Hold an admission gate slot for `route`, waiting on the event loop."""
+    if not Config.ADMISSION_ENABLED:
+        yield
+        return
+    await admission.gate.acquire_async(route_class, route)
+    try:
+        yield
+    finally:
+        admission.gate.release(route)
+
+
+async def prefetched_prediction(path: Optional[str], photo_url: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Async twin of routes.ai.prefetched_prediction; awaits without holding a thread."""
+    path = path or object_path_from_url(photo_url)
+    if not path:
+        return None
+    future = prefetch_service.pending(path)
+    if future is not None:
+        try:
+            # shield: timing out must not cancel the shared prefetch job
+            prediction = await asyncio.wait_for(
+                asyncio.shield(asyncio.wrap_future(future)), Config.AI_PREFETCH_WAIT_SECONDS)
+            if prediction:
+                return dict(prediction)
+        except Exception:
+            pass
+    return await asyncio.to_thread(prefetch_service.get_prediction, path, None, 0)
+
+
+# --------------------- Native AI handlers ---------------------
+# The request functions in routes/ai.py, with their blocking steps awaited
+
+# Steps of the request functions -> async twins; anything else runs on a thread
+ASYNC_STEPS = {
+    gemini_service.predict_issue_type: gemini_service.predict_issue_type_async,
+    gemini_service.generate_summary_and_priority: gemini_service.generate_summary_and_priority_async,
+    gemini_service.chatbot_response: gemini_service.chatbot_response_async,
+    fetch_analysis_image: fetch_analysis_image_async,
+    ai_routes.prefetched_prediction: prefetched_prediction,
+}
+
+
+async def run_request_async(gen) -> Tuple[int, Dict[str, Any]]:
+    """Async counterpart of routes.ai.run_request."""
+    try:
+        step = next(gen)
+        while True:
+            function, *args = step
+            twin = ASYNC_STEPS.get(function)
+            result = await twin(*args) if twin else await asyncio.to_thread(function, *args)
+            step = gen.send(result)
+    except StopIteration as done:
+        return done.value
+
+
+async def predict_type(request: Request) -> Tuple[int, Dict[str, Any]]:
+    return await run_request_async(ai_routes.predict_type_request(request.json, request.user['uid']))
+
+
+async def generate_summary(request: Request) -> Tuple[int, Dict[str, Any]]:
+    return await run_request_async(ai_routes.generate_summary_request(request.json))
+
+
+async def chatbot(request: Request) -> Tuple[int, Dict[str, Any]]:
+    return await run_request_async(ai_routes.chatbot_request(request.json))
+
+
+# (method, path) -> (limit name, handler)
+NATIVE_ROUTES = {
+    ('POST', '/api/ai/predict-type'): ('predict-type', predict_type),
+    ('POST', '/api/ai/generate-summary'): ('generate-summary', generate_summary),
+    ('POST', '/api/ai/chatbot'): ('chatbot', chatbot),
+}
+
+# Native routes answered without a Firebase token
+ANONYMOUS_ROUTES = {'chatbot'}
+
+# Admission-control route class per route (default 'ai')
+ROUTE_CLASSES = {'chatbot': 'chatbot', 'complaints-new': 'report'}
+
+# Flask views that call Gemini; their gate slot is taken before they get a thread
+LIMITED_ROUTES = {
+    ('POST', '/api/ai/process-issue'): 'process-issue',
+    ('GET', '/api/ai/insights'): 'insights',
+    ('POST', '/api/ai/verify-resolution'): 'verify-resolution',
+    ('POST', '/api/complaints/new'): 'complaints-new',
+}
+
+# Flask views whose body cap is not the app-wide MAX_CONTENT_LENGTH
+BODY_LIMITS = {
+    ('POST', '/api/complaints/upload-batch'): 'UPLOAD_BATCH_MAX_BYTES',
+}
+
+ALLOWED_ORIGINS = {'http://localhost:3000', 'http://localhost:5000', Config.FRONTEND_URL}
+
+
+# --------------------- ASGI app ---------------------
+
+class CityFixASGI:
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = PooledWsgiToAsgi(flask_app, Config.ASGI_WSGI_THREADS)
+        # Record native routes under the same endpoint names Flask uses
+        adapter = flask_app.url_map.bind('localhost')
+        self.endpoints = {key: adapter.match(key[1], method=key[0])[0] for key in NATIVE_ROUTES}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+
+        key = (scope['method'], scope['path'].rstrip('/') or '/')
+        headers = {k.decode('latin1').lower(): v.decode('latin1') for k, v in scope['headers']}
+        if key == ('GET', '/api/_debug/ai-limits'):
+            return await self._send_json(send, 200, admission.gate.stats(), headers.get('origin'))
+        native = NATIVE_ROUTES.get(key)
+        is_json = headers.get('content-type', '').split(';')[0].strip() == 'application/json'
+
+        if native and is_json:
+            route, handler = native
+            extra = {}
+            start = perf_counter()
+            metrics.HTTP_IN_FLIGHT.inc()
+            route_class = ROUTE_CLASSES.get(route, 'ai')
+            with tracing.task_trace() as trace:
+                try:
+                    body = await self._read_body(receive)
+                    client = scope.get('client') or (None, None)
+                    request = Request(headers, body, admission.client_ip(
+                        client[0], headers.get('x-forwarded-for')))
+                    # Same order as the Flask decorators: token, rates, gate slot
+                    if route not in ANONYMOUS_ROUTES:
+                        await authenticate(request)
+                    await check_rates(route_class, (request.user or {}).get('uid'), request.ip)
+                    async with gate_slot(route_class, route):
+                        status, payload = await handler(request)
+                except (HttpError, admission.Rejected) as e:
+                    status, payload, extra = e.status, e.payload, e.headers
+                except Exception as e:
+                    print(f"Async AI route error ({route}): {e}")
+                    status, payload = 500, {'error': str(e)}
+                finally:
+                    metrics.HTTP_IN_FLIGHT.dec()
+            if Config.TRACING_ENABLED:
+                # Same header the Flask views get from tracing.init_app
+                extra = {**extra, 'Server-Timing': tracing.server_timing(trace)}
+            metrics.observe_request(self.endpoints[key], key[0], status, perf_counter() - start)
+            return await self._send_json(send, status, payload, headers.get('origin'), extra)
+
+        route = native[0] if native else LIMITED_ROUTES.get(key)
+        max_body = self.flask_app.config.get(BODY_LIMITS.get(key, 'MAX_CONTENT_LENGTH'))
+        try:
+            if route:
+                async with gate_slot(ROUTE_CLASSES.get(route, 'ai'), route):
+                    # The view's admit() checks the rates but skips the gate
+                    await self.wsgi(scope, receive, send, {admission.SLOT_HELD_ENVIRON: route}, max_body)
+            else:
+                await self.wsgi(scope, receive, send, max_body=max_body)
+        except (HttpError, admission.Rejected) as e:
+            await self._send_json(send, e.status, e.payload, headers.get('origin'), e.headers)
+
+    async def _read_body(self, receive) -> bytes:
+        chunks, size = [], 0
+        while True:
+            message = await receive()
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > Config.ASGI_MAX_BODY_BYTES:
+                raise HttpError(413, {'error': 'Request body too large'})
+            chunks.append(chunk)
+            if not message.get('more_body'):
+                return b''.join(chunks)
+
+    async def _send_json(self, send, status, payload, origin=None, extra=None):
+        body = json.dumps(payload).encode('utf-8')
+        headers = {
+            'content-type': 'application/json',
+            'content-length': str(len(body)),
+            # Same CORS headers the Flask app adds
+            'access-control-allow-origin': origin if origin in ALLOWED_ORIGINS else 'http://localhost:3000',
+            'access-control-allow-headers': 'Content-Type,Authorization,Idempotency-Key',
+            'access-control-allow-methods': 'GET,POST,PUT,PATCH,DELETE,OPTIONS',
+            'access-control-allow-credentials': 'true',
+            **{k.lower(): v for k, v in (extra or {}).items()},
+        }
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(k.encode('latin1'), v.encode('latin1')) for k, v in headers.items()]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _lifespan(self, receive, send):
+        global _http
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                http_client()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if _http is not None:
+                    await _http.aclose()
+                    _http = None
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+app = CityFixASGI(create_app(os.getenv('FLASK_ENV', 'development')))
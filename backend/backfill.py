@@ -0,0 +1,267 @@
+"""Resumable batch backfill of AI enrichment for historical documents.
+
+Scans `issues` and `complaints` in document-id order, enriches documents
+missing category, priority or description embeddings with bounded
+parallelism and a global request rate, and commits results through a
+Firestore BulkWriter. Progress is checkpointed after every committed page,
+so an interrupted run picks up where it stopped. Documents whose enrichment
+failed (Gemini errors) are listed in the checkpoint and retried first on the
+next run.
+
+With --needs-enrichment it only visits documents flagged
+`needs_enrichment` (AI skipped while the Gemini circuit breaker was open)
+and redoes exactly the skipped steps. That mode needs no checkpoint: the
+flag is cleared as documents are enriched, so a rerun continues naturally.
+
+Usage:
+    python backfill.py --collections issues complaints --workers 8 --rate 5
+    python backfill.py --dry-run            # report what would be enriched
+    python backfill.py --reset              # ignore the saved checkpoint
+    python backfill.py --needs-enrichment   # finish AI work deferred during an outage
+"""
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+import argparse
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+
+class RateLimiter:
+    """Thread-safe limiter allowing `rate` acquisitions per second on average."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Checkpoint:
+    """Last committed document id per collection, stored as JSON on disk."""
+
+    def __init__(self, path: str, reset: bool = False):
+        self.path = path
+        self.state = {}
+        if not reset and os.path.exists(path):
+            with open(path, 'r') as f:
+                self.state = json.load(f)
+
+    def last_id(self, collection: str):
+        return self.state.get(collection, {}).get('last_id')
+
+    def is_done(self, collection: str) -> bool:
+        return bool(self.state.get(collection, {}).get('done'))
+
+    def failed(self, collection: str):
+        """Ids whose enrichment failed in an earlier run, to retry."""
+        return list(self.state.get(collection, {}).get('failed') or [])
+
+    def save(self, collection: str, last_id, done: bool = False, failed=()):
+        self.state[collection] = {'last_id': last_id, 'done': done, 'failed': sorted(failed),
+                                  'saved_at': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp, self.path)
+
+
+class Progress:
+    def __init__(self, total=None, every: float = 10.0):
+        self.total = total
+        self.every = every
+        self.started = time.monotonic()
+        self.last_report = 0.0
+        self.scanned = 0
+        self.enriched = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def add(self, scanned=0, enriched=0, failed=0):
+        with self.lock:
+            self.scanned += scanned
+            self.enriched += enriched
+            self.failed += failed
+
+    def report(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self.last_report < self.every:
+            return
+        self.last_report = now
+        elapsed = max(1e-6, now - self.started)
+        rate = self.scanned / elapsed
+        eta = ''
+        if self.total and rate > 0:
+            remaining = max(0, self.total - self.scanned) / rate
+            eta = f", ETA {int(remaining // 3600)}h{int(remaining % 3600 // 60):02d}m"
+        total = f"/{self.total}" if self.total else ''
+        print(f"[backfill] scanned {self.scanned}{total}, enriched {self.enriched}, "
+              f"failed {self.failed}, {rate:.1f} docs/s, "
+              f"{self.enriched / elapsed:.2f} enriched/s{eta}", flush=True)
+
+
+def _count(query):
+    try:
+        result = query.count().get()
+        return int(result[0][0].value)
+    except Exception:
+        return None
+
+
+def _pages(db, collection: str, page_size: int, after_id=None, flagged_only=False):
+    query = db.collection(collection)
+    if flagged_only:
+        query = query.where('needs_enrichment', '==', True)
+    query = query.order_by('__name__')
+    while True:
+        page = query.limit(page_size)
+        if after_id:
+            page = page.start_after({'__name__': after_id})
+        docs = list(page.stream())
+        if not docs:
+            return
+        yield docs
+        after_id = docs[-1].id
+        if len(docs) < page_size:
+            return
+
+
+def backfill_collection(db, collection: str, args, checkpoint: Checkpoint,
+                        progress: Progress, pool: ThreadPoolExecutor,
+                        limiter: RateLimiter):
+    from services.enrichment_service import missing_fields, enrich_document, enrich_deferred
+    from firebase_admin import firestore
+
+    deferred = args.needs_enrichment
+    failed_ids = set() if deferred else set(checkpoint.failed(collection))
+    if not deferred and checkpoint.is_done(collection) and not failed_ids:
+        print(f"[backfill] {collection}: already complete (use --reset to rerun)")
+        return
+
+    def work(doc, fields):
+        try:
+            limiter.acquire()
+            data = doc.to_dict() or {}
+            update = enrich_deferred(data, doc.id) if deferred else enrich_document(data, fields)
+            return doc, update, None
+        except Exception as e:
+            return doc, None, e
+
+    writer = None if args.dry_run else db.bulk_writer()
+    last_id = None if deferred else checkpoint.last_id(collection)
+    # (docs, whether the checkpoint may move past them)
+    pages = ((docs, True) for docs in
+             _pages(db, collection, args.page_size, last_id, flagged_only=deferred))
+    if failed_ids and not args.dry_run:
+        refs = [db.collection(collection).document(doc_id) for doc_id in sorted(failed_ids)]
+        retry = [snap for snap in db.get_all(refs) if snap.exists]
+        failed_ids.intersection_update(snap.id for snap in retry)
+        if retry:
+            pages = itertools.chain([(retry, False)], pages)
+    try:
+        for docs, advances in pages:
+            todo = []
+            for doc in docs:
+                data = doc.to_dict() or {}
+                if deferred:
+                    fields = data.get('ai_pending') or missing_fields(data) or ['flag']
+                else:
+                    fields = [f for f in missing_fields(data) if f in args.fields]
+                if fields:
+                    todo.append((doc, fields))
+
+            if args.dry_run:
+                for doc, fields in todo:
+                    print(f"  would enrich {collection}/{doc.id}: {', '.join(fields)}")
+                progress.add(scanned=len(docs), enriched=len(todo))
+            else:
+                enriched = failed = 0
+                failed_ids.difference_update(doc.id for doc in docs)
+                for doc, update, error in pool.map(lambda t: work(*t), todo):
+                    if error is not None or not update:
+                        failed += 1
+                        if error is not None:
+                            print(f"  {collection}/{doc.id}: {error}")
+                            failed_ids.add(doc.id)
+                        continue
+                    update['updated_at'] = firestore.SERVER_TIMESTAMP
+                    writer.update(doc.reference, update)
+                    enriched += 1
+                writer.flush()
+
+                if not deferred:
+                    last_id = docs[-1].id if advances else checkpoint.last_id(collection)
+                    checkpoint.save(collection, last_id, failed=failed_ids)
+                progress.add(scanned=len(docs), enriched=enriched, failed=failed)
+            progress.report()
+            if args.limit and progress.scanned >= args.limit:
+                return
+        if not args.dry_run and not deferred:
+            checkpoint.save(collection, checkpoint.last_id(collection), done=True,
+                            failed=failed_ids)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--collections', nargs='+', default=['issues', 'complaints'])
+    parser.add_argument('--fields', nargs='+', default=['category', 'priority', 'embedding'],
+                        choices=['category', 'priority', 'embedding'])
+    parser.add_argument('--workers', type=int, default=8,
+                        help='concurrent AI enrichments')
+    parser.add_argument('--rate', type=float, default=5.0,
+                        help='max documents sent to Gemini per second (0 = unlimited)')
+    parser.add_argument('--page-size', type=int, default=200)
+    parser.add_argument('--limit', type=int, default=0,
+                        help='stop after scanning this many documents')
+    parser.add_argument('--checkpoint', default='.backfill_checkpoint.json')
+    parser.add_argument('--reset', action='store_true', help='ignore saved checkpoint')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='scan and report without calling Gemini or writing')
+    parser.add_argument('--needs-enrichment', action='store_true',
+                        help='only redo AI steps deferred while Gemini was unavailable')
+    args = parser.parse_args(argv)
+
+    from services.firebase_service import initialize_firebase, get_firestore
+    initialize_firebase(Config.FIREBASE_CREDENTIALS_PATH)
+    db = get_firestore()
+
+    checkpoint = Checkpoint(args.checkpoint, reset=args.reset)
+    total = None
+    counts = [_count(db.collection(c)) for c in args.collections]
+    if all(c is not None for c in counts):
+        total = sum(counts)
+    progress = Progress(total=total)
+    limiter = RateLimiter(args.rate)
+
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        try:
+            for collection in args.collections:
+                if args.limit and progress.scanned >= args.limit:
+                    break
+                backfill_collection(db, collection, args, checkpoint,
+                                    progress, pool, limiter)
+        except KeyboardInterrupt:
+            print("[backfill] interrupted; rerun to resume from the checkpoint")
+            return 130
+        finally:
+            progress.report(force=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,493 @@
+"""API benchmark: throughput and latency percentiles per endpoint, fully offline.
+
+Builds the app with `create_app` against either the in-process Firestore and
+Storage fakes in benchmarks/fakes.py (the default) or the Firebase emulators,
+seeds complaints, issues and users, and stubs Gemini (each model call takes
+--ai-latency seconds), image downloads (--fetch-latency) and token
+verification. Closed-loop worker threads then drive a weighted mix of
+`/new`, complaint list, admin stats, `process-issue` and chatbot requests.
+
+Results are written as JSON with the git commit they were measured at, so
+two runs can be compared:
+
+Usage:
+    python benchmarks/bench_api.py run
+    python benchmarks/bench_api.py run --concurrency 32 --duration 30 --ai-latency 0.5
+    python benchmarks/bench_api.py run --backend emulator   # needs FIRESTORE_EMULATOR_HOST
+    python benchmarks/bench_api.py compare results/old.json results/new.json
+"""
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+DEFAULT_MIX = 'new=15,list=40,stats=10,process_issue=10,chatbot=25'
+CATEGORIES = ['pothole', 'garbage', 'streetlight', 'water', 'graffiti']
+CENTER = (12.9716, 77.5946)
+DESCRIPTIONS = [
+    'Large pothole near the bus stop, cars swerving around it',
+    'Garbage has not been collected for a week and is spilling onto the road',
+    'Streetlight flickering and off most of the night',
+    'Water leaking from a broken pipe under the footpath',
+    'Graffiti sprayed across the wall of the community hall',
+]
+CHAT_QUERIES = [
+    'How do I report a pothole?',
+    'How long does it take to fix a streetlight?',
+    'Can I track the status of my complaint?',
+]
+
+
+def configure_environment(args):
+    """Settings that must be in place before config.py is imported."""
+    os.environ.update({
+        'RUN_SCHEDULER_IN_WEB': 'False',
+        'TRACE_SAMPLE_RATE': '0',
+        'FLASK_DEBUG': 'False',
+        # Quotas would turn the measured traffic into 429s
+        'ADMISSION_ENABLED': 'True' if args.admission else 'False',
+    })
+    if args.backend == 'emulator':
+        os.environ.setdefault('GOOGLE_CLOUD_PROJECT', args.project)
+
+
+# --------------------- Dependencies ---------------------
+
+def _answer(prompt: str) -> str:
+    """A plausible reply for each prompt the backend sends to Gemini."""
+    category = random.choice(CATEGORIES)
+    if 'classify it into ONE of these categories' in prompt:
+        return category
+    if 'SUMMARY:' in prompt:
+        return 'SUMMARY: Reported civic issue needing attention.\nPRIORITY: Medium - affects daily commute'
+    if 'Classify this civic complaint' in prompt:
+        return json.dumps({'category': category, 'confidence': 0.82})
+    if 'severity rating' in prompt:
+        return json.dumps({'severity': 'medium', 'reason': 'Moderate impact on residents'})
+    if "'similarity'" in prompt or '"similarity"' in prompt:
+        return json.dumps({'similarity': 0.3})
+    if 'partially_resolved' in prompt:
+        return json.dumps({'status': 'resolved', 'confidence': 0.9,
+                           'explanation': 'The issue is no longer visible.'})
+    return 'You can report issues from the CityFix app and track them from your profile.'
+
+
+def _embedding(text: str, dims: int = 64):
+    digest = hashlib.sha256((text or '').encode('utf-8')).digest()
+    rng = random.Random(digest)
+    return [rng.uniform(-1, 1) for _ in range(dims)]
+
+
+def stub_dependencies(args):
+    """Offline stand-ins for Gemini, image downloads and token verification."""
+    import google.generativeai as genai
+    from PIL import Image
+
+    class _Response:
+        def __init__(self, text):
+            self.text = text
+
+    def _prompt_of(contents):
+        parts = contents if isinstance(contents, (list, tuple)) else [contents]
+        return '\n'.join(p for p in parts if isinstance(p, str))
+
+    class _Model:
+        def __init__(self, *a, **kw):
+            pass
+
+        def generate_content(self, contents, *a, **kw):
+            time.sleep(args.ai_latency)
+            return _Response(_answer(_prompt_of(contents)))
+
+        async def generate_content_async(self, contents, *a, **kw):
+            await asyncio.sleep(args.ai_latency)
+            return _Response(_answer(_prompt_of(contents)))
+
+    def _embed_content(model=None, content='', **kw):
+        time.sleep(args.ai_latency / 4)
+        return {'embedding': _embedding(content if isinstance(content, str) else str(content))}
+
+    genai.GenerativeModel = _Model
+    genai.embed_content = _embed_content
+
+    buf = BytesIO()
+    Image.new('RGB', (640, 480), (120, 110, 100)).save(buf, format='JPEG')
+    image_bytes = buf.getvalue()
+
+    def _fetch_image(url, timeout=15):
+        time.sleep(args.fetch_latency)
+        return Image.open(BytesIO(image_bytes))
+
+    from services import enrichment_service, firebase_service
+    from routes import auth
+    enrichment_service.fetch_image = _fetch_image
+
+    def _verify(token, check_revoked=None):
+        if token == 'admin':
+            return {'uid': 'bench-admin', 'email': 'admin@example.com', 'role': 'admin'}
+        if token and token.startswith('user-'):
+            return {'uid': token, 'email': f'{token}@example.com'}
+        return None
+
+    firebase_service.verify_token = _verify
+    auth.verify_token = _verify
+
+
+def connect_backend(args):
+    """Point firebase_service at the fakes or at the emulators."""
+    if args.backend == 'fake':
+        from benchmarks import fakes
+        fakes.install(firestore_latency=args.firestore_latency)
+        return
+    if not os.getenv('FIRESTORE_EMULATOR_HOST'):
+        raise SystemExit('--backend emulator needs FIRESTORE_EMULATOR_HOST (and STORAGE_EMULATOR_HOST)')
+    from google.auth.credentials import AnonymousCredentials
+    from google.cloud import firestore, storage
+    from services import firebase_service
+    from services.metrics import instrument_google_clients
+    instrument_google_clients()
+    firebase_service._firebase_initialized = True
+    firebase_service.db = firestore.Client(project=args.project, credentials=AnonymousCredentials())
+    client = storage.Client(project=args.project, credentials=AnonymousCredentials())
+    firebase_service.bucket = client.bucket(f'{args.project}.appspot.com')
+
+
+def seed(args):
+    """Complaints, issues (with embeddings) and users clustered around one city."""
+    from services.firebase_service import get_firestore
+    from services.enrichment_service import EMBEDDING_FIELD
+    db = get_firestore()
+    rng = random.Random(args.seed)
+    now = datetime.now(timezone.utc)
+    bucket_name = os.getenv('FIREBASE_STORAGE_BUCKET', 'bench-bucket')
+
+    def near():
+        return (CENTER[0] + rng.uniform(-0.01, 0.01), CENTER[1] + rng.uniform(-0.01, 0.01))
+
+    def photo(i):
+        return (f'https://firebasestorage.googleapis.com/v0/b/{bucket_name}/o/'
+                f'complaints%2Fbench%2F{i}.jpg?alt=media')
+
+    batch = db.batch()
+    pending = 0
+
+    def add(ref, data):
+        nonlocal batch, pending
+        batch.set(ref, data)
+        pending += 1
+        if pending >= 400:
+            batch.commit()
+            batch, pending = db.batch(), 0
+
+    for u in range(args.users):
+        add(db.collection('users').document(f'user-{u}'),
+            {'uid': f'user-{u}', 'email': f'user-{u}@example.com', 'role': 'user', 'created_at': now})
+    add(db.collection('users').document('bench-admin'),
+        {'uid': 'bench-admin', 'email': 'admin@example.com', 'role': 'admin', 'created_at': now})
+
+    for i in range(args.complaints):
+        lat, lng = near()
+        add(db.collection('complaints').document(f'c{i}'), {
+            'user_id': f'user-{rng.randrange(args.users)}',
+            'type': rng.choice(CATEGORIES),
+            'description': rng.choice(DESCRIPTIONS),
+            'photo_url': photo(i),
+            'location': {'lat': lat, 'lng': lng},
+            'status': rng.choice(['pending', 'pending', 'in_progress', 'resolved']),
+            'priority': rng.choice(['Low', 'Medium', 'High']),
+            'created_at': now - timedelta(minutes=i),
+            'updated_at': now - timedelta(minutes=i),
+        })
+
+    for i in range(args.issues):
+        lat, lng = near()
+        description = rng.choice(DESCRIPTIONS)
+        add(db.collection('issues').document(f'i{i}'), {
+            'userId': f'user-{rng.randrange(args.users)}',
+            'description': description,
+            'photoUrl': photo(f'i{i}'),
+            'location': {'lat': lat, 'lon': lng},
+            'status': 'Pending',
+            EMBEDDING_FIELD: _embedding(description),
+            'createdAt': now - timedelta(minutes=i),
+        })
+    if pending:
+        batch.commit()
+
+
+# --------------------- Traffic ---------------------
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in SCENARIOS:
+            raise SystemExit(f"Unknown scenario '{name}'; choose from {', '.join(SCENARIOS)}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def _new(client, rng, args):
+    lat = CENTER[0] + rng.uniform(-0.01, 0.01)
+    lng = CENTER[1] + rng.uniform(-0.01, 0.01)
+    return client.post('/api/complaints/new', headers=_auth(f'user-{rng.randrange(args.users)}'), json={
+        'description': rng.choice(DESCRIPTIONS),
+        'photo_url': f'https://example.com/bench/{rng.randrange(10 ** 6)}.jpg',
+        'location': {'lat': lat, 'lng': lng},
+    })
+
+
+def _list(client, rng, args):
+    params = {'limit': 50}
+    if rng.random() < 0.3:
+        params['status'] = 'pending'
+    return client.get('/api/complaints/', query_string=params)
+
+
+def _stats(client, rng, args):
+    return client.get('/api/admin/stats', headers=_auth('admin'))
+
+
+def _process_issue(client, rng, args):
+    return client.post('/api/ai/process-issue', headers=_auth(f'user-{rng.randrange(args.users)}'),
+                       json={'issue_id': f'i{rng.randrange(args.issues)}'})
+
+
+def _chatbot(client, rng, args):
+    return client.post('/api/ai/chatbot', json={'query': rng.choice(CHAT_QUERIES)})
+
+
+def _auth(token):
+    return {'Authorization': f'Bearer {token}'}
+
+
+SCENARIOS = {
+    'new': _new,
+    'list': _list,
+    'stats': _stats,
+    'process_issue': _process_issue,
+    'chatbot': _chatbot,
+}
+
+
+def drive(app, args, mix):
+    """Closed loop: each worker sends its next request as soon as the last returns."""
+    names = list(mix)
+    weights = [mix[n] for n in names]
+    samples = {name: [] for name in names}   # (seconds, status) per request
+    lock = threading.Lock()
+    start = time.monotonic()
+    measure_from = start + args.warmup
+    deadline = measure_from + args.duration
+
+    def worker(index):
+        rng = random.Random(args.seed * 1000 + index)
+        client = app.test_client()
+        local = {name: [] for name in names}
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            name = rng.choices(names, weights)[0]
+            t0 = time.perf_counter()
+            try:
+                status = SCENARIOS[name](client, rng, args).status_code
+            except Exception as e:
+                print(f"[bench] {name} raised {e}")
+                status = 0
+            elapsed = time.perf_counter() - t0
+            if now >= measure_from:
+                local[name].append((elapsed, status))
+        with lock:
+            for name, rows in local.items():
+                samples[name].extend(rows)
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return samples
+
+
+# --------------------- Reporting ---------------------
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(rows, duration):
+    latencies = [lat for lat, status in rows if 0 < status < 500]
+    statuses = {}
+    for _, status in rows:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    def ms(value):
+        return round(value * 1000, 2) if value is not None else None
+
+    return {
+        'requests': len(rows),
+        'errors': sum(1 for _, status in rows if status >= 500 or status == 0),
+        'statuses': statuses,
+        'throughput_rps': round(len(rows) / duration, 2) if duration else None,
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'max_ms': ms(max(latencies)) if latencies else None,
+        'mean_ms': ms(sum(latencies) / len(latencies)) if latencies else None,
+    }
+
+
+def git_info():
+    def git(*cmd):
+        try:
+            return subprocess.run(['git', *cmd], cwd=BACKEND_DIR, capture_output=True,
+                                  text=True, timeout=10).stdout.strip()
+        except Exception:
+            return ''
+    return {'commit': git('rev-parse', '--short', 'HEAD') or None,
+            'dirty': bool(git('status', '--porcelain', '--untracked-files=no'))}
+
+
+def print_report(results):
+    print(f"\n{'endpoint':<15}{'reqs':>7}{'err':>6}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    rows = list(results['endpoints'].items()) + [('overall', results['overall'])]
+    for name, r in rows:
+        print(f"{name:<15}{r['requests']:>7}{r['errors']:>6}{r['throughput_rps'] or 0:>9.1f}"
+              f"{r['p50_ms'] or 0:>10.1f}{r['p95_ms'] or 0:>10.1f}{r['p99_ms'] or 0:>10.1f}")
+
+
+def run(args):
+    configure_environment(args)
+    mix = parse_mix(args.mix)
+    stub_dependencies(args)
+    connect_backend(args)
+
+    import logging
+    from app import create_app
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    app = create_app()
+
+    seed(args)
+    print(f"[bench] {args.backend} backend, {args.concurrency} workers, "
+          f"{args.warmup:g}s warmup + {args.duration:g}s, mix {args.mix}")
+    samples = drive(app, args, mix)
+
+    all_rows = [row for rows in samples.values() for row in rows]
+    results = {
+        'meta': {
+            **git_info(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'args': {k: v for k, v in vars(args).items() if k != 'func'},
+        },
+        'endpoints': {name: summarize(rows, args.duration) for name, rows in samples.items()},
+        'overall': summarize(all_rows, args.duration),
+    }
+    print_report(results)
+
+    out = args.out
+    if not out:
+        stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        out = os.path.join(BACKEND_DIR, 'benchmarks', 'results',
+                           f"{stamp}-{results['meta']['commit'] or 'nogit'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\n[bench] results written to {out}")
+    return 0
+
+
+def compare(args):
+    """Per-endpoint deltas; exits 1 when a latency or throughput regressed past the threshold."""
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print(f"old: {old['meta'].get('commit')} ({old['meta'].get('timestamp')})")
+    print(f"new: {new['meta'].get('commit')} ({new['meta'].get('timestamp')})")
+
+    regressions = []
+    names = [n for n in new['endpoints'] if n in old['endpoints']] + ['overall']
+    print(f"\n{'endpoint':<15}{'metric':<16}{'old':>10}{'new':>10}{'change':>10}")
+    for name in names:
+        before = old['overall'] if name == 'overall' else old['endpoints'][name]
+        after = new['overall'] if name == 'overall' else new['endpoints'][name]
+        for metric, higher_is_better in (('throughput_rps', True), ('p50_ms', False),
+                                         ('p95_ms', False), ('p99_ms', False)):
+            a, b = before.get(metric), after.get(metric)
+            if not a or b is None:
+                continue
+            change = (b - a) / a * 100
+            worse = -change if higher_is_better else change
+            flag = ''
+            if worse > args.threshold:
+                flag = '  REGRESSION'
+                regressions.append(f'{name} {metric}')
+            print(f"{name:<15}{metric:<16}{a:>10.1f}{b:>10.1f}{change:>+9.1f}%{flag}")
+        if after.get('errors', 0) > before.get('errors', 0):
+            regressions.append(f'{name} errors')
+            print(f"{name:<15}{'errors':<16}{before.get('errors', 0):>10}{after['errors']:>10}  REGRESSION")
+
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) beyond {args.threshold:g}%: {', '.join(regressions)}")
+        return 1
+    print(f"\nNo regressions beyond {args.threshold:g}%")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('run', help='run the benchmark and write results JSON')
+    p.add_argument('--backend', choices=['fake', 'emulator'], default='fake',
+                   help='in-process fakes, or the Firestore/Storage emulators')
+    p.add_argument('--project', default='demo-cityfix', help='emulator project id')
+    p.add_argument('--concurrency', type=int, default=16)
+    p.add_argument('--duration', type=float, default=20, help='measured seconds')
+    p.add_argument('--warmup', type=float, default=3, help='unmeasured seconds before measuring')
+    p.add_argument('--mix', default=DEFAULT_MIX, help='weighted scenarios, e.g. list=3,chatbot=1')
+    p.add_argument('--ai-latency', type=float, default=0.3, help='stubbed seconds per Gemini call')
+    p.add_argument('--fetch-latency', type=float, default=0.05, help='stubbed seconds per image download')
+    p.add_argument('--firestore-latency', type=float, default=0.002,
+                   help='simulated seconds per Firestore round trip (fake backend)')
+    p.add_argument('--complaints', type=int, default=500)
+    p.add_argument('--issues', type=int, default=200)
+    p.add_argument('--users', type=int, default=50)
+    p.add_argument('--seed', type=int, default=42)
+    p.add_argument('--admission', action='store_true',
+                   help='keep admission control (rate limits, AI concurrency cap) on')
+    p.add_argument('--out', help='results file (default benchmarks/results/<time>-<commit>.json)')
+    p.set_defaults(func=run)
+
+    p = sub.add_parser('compare', help='compare two results files')
+    p.add_argument('old')
+    p.add_argument('new')
+    p.add_argument('--threshold', type=float, default=10,
+                   help='percent change that counts as a regression')
+    p.set_defaults(func=compare)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,584 @@
+"""In-process stand-ins for Firestore and Cloud Storage, for offline benchmarks.
+
+Covers the client surface the backend uses: documents and (sub)collections,
+queries (where/order_by/limit/offset/select/start_after, count), get_all,
+batches, BulkWriter, transactions, snapshot listeners (never fire), and the
+SERVER_TIMESTAMP / DELETE_FIELD / ArrayUnion / ArrayRemove / Increment
+sentinels. Storage blobs live in a dict. Every operation can be given a
+simulated round-trip latency, so concurrency behaves roughly like the real
+services.
+
+    from benchmarks import fakes
+    db, bucket = fakes.install(firestore_latency=0.005)
+"""
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+import base64
+import copy
+import hashlib
+import threading
+import time
+import uuid
+
+from google.cloud.firestore_v1 import transforms
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+_MISSING = object()
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def _get_path(data: Dict[str, Any], path: str):
+    cur: Any = data
+    for part in path.split('.'):
+        if not isinstance(cur, dict) or part not in cur:
+            return _MISSING
+        cur = cur[part]
+    return cur
+
+
+def _apply(doc: Dict[str, Any], path: str, value):
+    """Write one (dotted) field, resolving sentinels against the old value."""
+    parts = path.split('.')
+    cur = doc
+    for part in parts[:-1]:
+        nxt = cur.get(part)
+        if not isinstance(nxt, dict):
+            nxt = cur[part] = {}
+        cur = nxt
+    key = parts[-1]
+    old = cur.get(key)
+    if value is transforms.DELETE_FIELD:
+        cur.pop(key, None)
+    elif value is transforms.SERVER_TIMESTAMP:
+        cur[key] = _now()
+    elif isinstance(value, transforms.ArrayUnion):
+        items = list(old) if isinstance(old, list) else []
+        cur[key] = items + [v for v in value.values if v not in items]
+    elif isinstance(value, transforms.ArrayRemove):
+        cur[key] = [v for v in (old if isinstance(old, list) else []) if v not in value.values]
+    elif isinstance(value, transforms.Increment):
+        cur[key] = (old if isinstance(old, (int, float)) else 0) + value.value
+    elif isinstance(value, dict):
+        cur[key] = {}
+        for k, v in value.items():
+            _apply(cur[key], k, v)
+    else:
+        cur[key] = copy.deepcopy(value)
+
+
+def _merge(doc: Dict[str, Any], data: Dict[str, Any]):
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(doc.get(key), dict):
+            _merge(doc[key], value)
+        else:
+            _apply(doc, key, value)
+
+
+def _project(data: Dict[str, Any], fields: Optional[List[str]]) -> Dict[str, Any]:
+    if not fields:
+        return copy.deepcopy(data)
+    out: Dict[str, Any] = {}
+    for field in fields:
+        value = _get_path(data, field)
+        if value is not _MISSING:
+            _apply(out, field, value)
+    return out
+
+
+class AlreadyExists(Exception):
+    pass
+
+
+class NotFound(Exception):
+    pass
+
+
+class DocumentSnapshot:
+    def __init__(self, reference: 'DocumentReference', data: Optional[Dict[str, Any]]):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path: str):
+        value = _get_path(self._data or {}, field_path)
+        if value is _MISSING:
+            raise KeyError(field_path)
+        return value
+
+
+class DocumentReference:
+    def __init__(self, db: 'FakeFirestore', path: str):
+        self._db = db
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+        self._path = tuple(path.split('/'))
+
+    @property
+    def parent(self) -> 'CollectionReference':
+        return CollectionReference(self._db, self.path.rsplit('/', 1)[0])
+
+    def collection(self, name: str) -> 'CollectionReference':
+        return CollectionReference(self._db, f'{self.path}/{name}')
+
+    def get(self, field_paths=None, transaction=None, **kwargs) -> DocumentSnapshot:
+        self._db._rpc()
+        with self._db._lock:
+            data = self._db._docs.get(self.path)
+            return DocumentSnapshot(self, _project(data, field_paths) if data is not None else None)
+
+    def _write(self, op: str, data=None, merge=False):
+        docs = self._db._docs
+        if op == 'create':
+            if self.path in docs:
+                raise AlreadyExists(f'Document already exists: {self.path}')
+            op = 'set'
+        if op == 'set':
+            doc = copy.deepcopy(docs[self.path]) if merge and self.path in docs else {}
+            (_merge if merge else lambda d, v: [_apply(d, k, x) for k, x in v.items()])(doc, data)
+            docs[self.path] = doc
+        elif op == 'update':
+            if self.path not in docs:
+                raise NotFound(f'No document to update: {self.path}')
+            doc = copy.deepcopy(docs[self.path])
+            for key, value in data.items():
+                _apply(doc, key, value)
+            docs[self.path] = doc
+        elif op == 'delete':
+            docs.pop(self.path, None)
+
+    def set(self, document_data, merge=False, **kwargs):
+        self._db._rpc()
+        with self._db._lock:
+            self._write('set', document_data, merge)
+
+    def create(self, document_data, **kwargs):
+        self._db._rpc()
+        with self._db._lock:
+            self._write('create', document_data)
+
+    def update(self, field_updates, **kwargs):
+        self._db._rpc()
+        with self._db._lock:
+            self._write('update', field_updates)
+
+    def delete(self, **kwargs):
+        self._db._rpc()
+        with self._db._lock:
+            self._write('delete')
+
+
+_OPS = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    'in': lambda a, b: a in b,
+    'not-in': lambda a, b: a not in b,
+    'array_contains': lambda a, b: isinstance(a, list) and b in a,
+    'array_contains_any': lambda a, b: isinstance(a, list) and any(x in a for x in b),
+}
+
+
+class AggregationResult:
+    def __init__(self, alias: str, value):
+        self.alias = alias
+        self.value = value
+
+
+class AggregationQuery:
+    def __init__(self, query: 'Query', alias: str):
+        self._query = query
+        self._alias = alias
+
+    def get(self, **kwargs):
+        return [[AggregationResult(self._alias, len(self._query._matching()))]]
+
+
+class _Watch:
+    def unsubscribe(self):
+        pass
+
+
+class Query:
+    def __init__(self, db: 'FakeFirestore', path: str, filters=(), orders=(), limit=None,
+                 offset=0, fields=None, after=None):
+        self._db = db
+        self._collection_path = path
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._offset = offset
+        self._fields = fields
+        self._after = after
+
+    @property
+    def _parent(self):
+        return CollectionReference(self._db, self._collection_path)
+
+    def _clone(self, **changes) -> 'Query':
+        state = dict(filters=self._filters, orders=self._orders, limit=self._limit,
+                     offset=self._offset, fields=self._fields, after=self._after)
+        state.update(changes)
+        return Query(self._db, self._collection_path, **state)
+
+    def where(self, field_path=None, op_string=None, value=None, *, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._clone(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path, direction='ASCENDING'):
+        return self._clone(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count):
+        return self._clone(limit=count)
+
+    def offset(self, num_to_skip):
+        return self._clone(offset=num_to_skip)
+
+    def select(self, field_paths):
+        return self._clone(fields=list(field_paths))
+
+    def start_after(self, document_fields_or_snapshot):
+        return self._clone(after=document_fields_or_snapshot)
+
+    def count(self, alias=None):
+        return AggregationQuery(self, alias or 'field_1')
+
+    def on_snapshot(self, callback):
+        return _Watch()
+
+    def _matching(self):
+        prefix = self._collection_path + '/'
+        depth = prefix.count('/')
+        with self._db._lock:
+            rows = [(path, data) for path, data in self._db._docs.items()
+                    if path.startswith(prefix) and path.count('/') == depth]
+        out = []
+        for path, data in rows:
+            ok = True
+            for field, op, value in self._filters:
+                actual = _get_path(data, field)
+                try:
+                    if actual is _MISSING or not _OPS[op](actual, value):
+                        ok = False
+                        break
+                except TypeError:
+                    ok = False
+                    break
+            if ok:
+                out.append((path, data))
+
+        out.sort(key=lambda row: row[0])
+        for field, direction in reversed(self._orders):
+            if field == '__name__':
+                out.sort(key=lambda row: row[0], reverse=direction == 'DESCENDING')
+                continue
+            # Firestore leaves out documents without the ordered field
+            out = [row for row in out if _get_path(row[1], field) is not _MISSING]
+            out.sort(key=lambda row: _get_path(row[1], field), reverse=direction == 'DESCENDING')
+
+        if self._after is not None:
+            after_id = self._after.id if hasattr(self._after, 'id') else self._after.get('__name__')
+            ids = [path.rsplit('/', 1)[-1] for path, _ in out]
+            out = out[ids.index(after_id) + 1:] if after_id in ids else \
+                [row for row in out if row[0].rsplit('/', 1)[-1] > str(after_id)]
+        out = out[self._offset:]
+        if self._limit is not None:
+            out = out[:self._limit]
+        return out
+
+    def stream(self, transaction=None, **kwargs):
+        self._db._rpc()
+        for path, data in self._matching():
+            yield DocumentSnapshot(DocumentReference(self._db, path), _project(data, self._fields))
+
+    def get(self, transaction=None, **kwargs):
+        return list(self.stream())
+
+
+class CollectionReference(Query):
+    def __init__(self, db: 'FakeFirestore', path: str, **state):
+        super().__init__(db, path, **state)
+        self.id = path.rsplit('/', 1)[-1]
+        self._path = tuple(path.split('/'))
+
+    def document(self, document_id: Optional[str] = None) -> DocumentReference:
+        return DocumentReference(self._db, f'{self._collection_path}/{document_id or uuid.uuid4().hex[:20]}')
+
+    def add(self, document_data, document_id=None, **kwargs):
+        ref = self.document(document_id)
+        ref.create(document_data)
+        return _now(), ref
+
+    def list_documents(self, **kwargs):
+        return [snap.reference for snap in self.stream()]
+
+
+class WriteBatch:
+    def __init__(self, db: 'FakeFirestore'):
+        self._db = db
+        self._writes = []
+
+    def set(self, reference, document_data, merge=False):
+        self._writes.append((reference, 'set', document_data, merge))
+
+    def create(self, reference, document_data):
+        self._writes.append((reference, 'create', document_data, False))
+
+    def update(self, reference, field_updates, **kwargs):
+        self._writes.append((reference, 'update', field_updates, False))
+
+    def delete(self, reference, **kwargs):
+        self._writes.append((reference, 'delete', None, False))
+
+    def commit(self, **kwargs):
+        self._db._rpc()
+        with self._db._lock:
+            # All-or-nothing, like a real batch
+            backup = dict(self._db._docs)
+            try:
+                for reference, op, data, merge in self._writes:
+                    reference._write(op, data, merge)
+            except Exception:
+                self._db._docs = backup
+                raise
+        results = [_now()] * len(self._writes)
+        self._writes = []
+        return results
+
+
+class BulkWriter(WriteBatch):
+    """Writes apply immediately; failures are reported to on_write_error."""
+
+    def __init__(self, db: 'FakeFirestore'):
+        super().__init__(db)
+        self._on_error = None
+        self._on_result = None
+
+    def on_write_error(self, callback):
+        self._on_error = callback
+
+    def on_write_result(self, callback):
+        self._on_result = callback
+
+    def _one(self, reference, op, data=None, merge=False):
+        self._db._rpc()
+        try:
+            with self._db._lock:
+                reference._write(op, data, merge)
+            if self._on_result:
+                self._on_result(reference, _now(), self)
+        except Exception as e:
+            if self._on_error:
+                self._on_error(e, self)
+            else:
+                print(f"BulkWriter error for {reference.path}: {e}")
+
+    def set(self, reference, document_data, merge=False):
+        self._one(reference, 'set', document_data, merge)
+
+    def create(self, reference, document_data):
+        self._one(reference, 'create', document_data)
+
+    def update(self, reference, field_updates, **kwargs):
+        self._one(reference, 'update', field_updates)
+
+    def delete(self, reference, **kwargs):
+        self._one(reference, 'delete')
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Transaction(WriteBatch):
+    """Reads see committed data; writes apply when the transactional function returns."""
+
+    def get(self, ref_or_query, **kwargs):
+        if isinstance(ref_or_query, DocumentReference):
+            return ref_or_query.get()
+        return ref_or_query.stream()
+
+    def get_all(self, references, **kwargs):
+        return self._db.get_all(references)
+
+
+def transactional(to_wrap):
+    """Replacement for firestore.transactional: runs serialized under the DB lock."""
+    def wrapper(transaction: Transaction, *args, **kwargs):
+        with transaction._db._lock:
+            result = to_wrap(transaction, *args, **kwargs)
+            transaction.commit()
+        return result
+    return wrapper
+
+
+class FakeFirestore:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self._docs: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.RLock()
+        self.rpcs = 0
+
+    def _rpc(self):
+        self.rpcs += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def collection(self, path: str) -> CollectionReference:
+        return CollectionReference(self, path)
+
+    def document(self, path: str) -> DocumentReference:
+        return DocumentReference(self, path)
+
+    def batch(self) -> WriteBatch:
+        return WriteBatch(self)
+
+    def bulk_writer(self, **kwargs) -> BulkWriter:
+        return BulkWriter(self)
+
+    def transaction(self, **kwargs) -> Transaction:
+        return Transaction(self)
+
+    def get_all(self, references, field_paths=None, transaction=None, **kwargs):
+        self._rpc()
+        with self._lock:
+            snaps = []
+            for ref in references:
+                data = self._docs.get(ref.path)
+                snaps.append(DocumentSnapshot(ref, _project(data, field_paths) if data is not None else None))
+        return iter(snaps)
+
+
+# --------------------- Storage ---------------------
+
+class FakeBlob:
+    def __init__(self, bucket: 'FakeBucket', name: str, chunk_size=None):
+        self.bucket = bucket
+        self.name = name
+        self.chunk_size = chunk_size
+        self.metadata = None
+        self.content_type = None
+        self.cache_control = None
+        self.size = None
+        self.md5_hash = None
+
+    def _store(self, data: bytes, content_type):
+        self.bucket._rpc()
+        with self.bucket._lock:
+            self.bucket.objects[self.name] = {
+                'data': data, 'content_type': content_type,
+                'metadata': dict(self.metadata or {}), 'cache_control': self.cache_control,
+            }
+        self.size = len(data)
+        self.content_type = content_type
+        self.md5_hash = base64.b64encode(hashlib.md5(data).digest()).decode()
+
+    def upload_from_file(self, file_obj, size=None, content_type=None, **kwargs):
+        self._store(file_obj.read() if size is None else file_obj.read(size), content_type)
+
+    def upload_from_string(self, data, content_type='text/plain', **kwargs):
+        self._store(data.encode('utf-8') if isinstance(data, str) else data, content_type)
+
+    def _object(self):
+        obj = self.bucket.objects.get(self.name)
+        if obj is None:
+            raise NotFound(f'No such object: {self.bucket.name}/{self.name}')
+        return obj
+
+    def exists(self, **kwargs) -> bool:
+        self.bucket._rpc()
+        return self.name in self.bucket.objects
+
+    def reload(self, **kwargs):
+        self.bucket._rpc()
+        obj = self._object()
+        self.size = len(obj['data'])
+        self.content_type = obj['content_type']
+        self.metadata = dict(obj['metadata'] or {})
+        self.cache_control = obj['cache_control']
+        self.md5_hash = base64.b64encode(hashlib.md5(obj['data']).digest()).decode()
+
+    def patch(self, **kwargs):
+        self.bucket._rpc()
+        self._object()['metadata'] = dict(self.metadata or {})
+
+    def download_as_bytes(self, **kwargs) -> bytes:
+        self.bucket._rpc()
+        return self._object()['data']
+
+    def delete(self, **kwargs):
+        self.bucket._rpc()
+        with self.bucket._lock:
+            if self.bucket.objects.pop(self.name, None) is None:
+                raise NotFound(f'No such object: {self.bucket.name}/{self.name}')
+
+    def make_public(self, **kwargs):
+        pass
+
+    @property
+    def public_url(self) -> str:
+        return f'https://storage.googleapis.com/{self.bucket.name}/{self.name}'
+
+    def generate_signed_url(self, version='v4', expiration=None, method='GET',
+                            content_type=None, headers=None, **kwargs) -> str:
+        return f'https://storage.googleapis.com/{self.bucket.name}/{self.name}?X-Goog-Signature=fake'
+
+
+class FakeBucket:
+    def __init__(self, name: str = 'bench-bucket', latency: float = 0.0):
+        self.name = name
+        self.latency = latency
+        self.objects: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def _rpc(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def exists(self, **kwargs) -> bool:
+        return True
+
+    def blob(self, blob_name: str, chunk_size=None, **kwargs) -> FakeBlob:
+        return FakeBlob(self, blob_name, chunk_size)
+
+    def get_blob(self, blob_name: str, **kwargs) -> Optional[FakeBlob]:
+        if blob_name not in self.objects:
+            return None
+        blob = FakeBlob(self, blob_name)
+        blob.reload()
+        return blob
+
+    def list_blobs(self, prefix: str = '', **kwargs):
+        return [self.get_blob(name) for name in sorted(self.objects) if name.startswith(prefix)]
+
+
+def install(firestore_latency: float = 0.0, storage_latency: float = 0.0):
+    """Point services.firebase_service at fresh fakes. Returns (db, bucket)."""
+    from firebase_admin import firestore
+    from services import firebase_service
+
+    db = FakeFirestore(latency=firestore_latency)
+    bucket = FakeBucket(latency=storage_latency)
+    firebase_service.db = db
+    firebase_service.bucket = bucket
+    # create_app's initialize_firebase becomes a no-op
+    firebase_service._firebase_initialized = True
+    firebase_service._bucket_health.update({'exists': True, 'error': None, 'checked_at': time.time()})
+    # Services decorate transaction functions at call time via this name
+    firestore.transactional = transactional
+    return db, bucket
+
+
+__all__ = ['FakeFirestore', 'FakeBucket', 'FieldFilter', 'install', 'transactional']
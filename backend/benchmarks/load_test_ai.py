@@ -0,0 +1,218 @@
+"""Load test: cheap endpoints stay fast while AI endpoints are saturated.
+
+Floods an AI route with concurrent requests while probing a cheap endpoint
+at a steady rate, then reports latency percentiles for both.
+
+Self-hosted mode (the default) runs fully offline: Gemini and token
+verification are stubbed (each model call takes --ai-latency seconds), and
+the app is served twice in-process, first behind a fixed pool of
+--threads threads (what a threaded WSGI worker does), then through
+asgi.py under uvicorn. With a real server, pass --base-url.
+
+Usage:
+    python benchmarks/load_test_ai.py
+    python benchmarks/load_test_ai.py --ai-concurrency 64 --duration 20
+    python benchmarks/load_test_ai.py --base-url http://localhost:5000
+"""
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def stub_dependencies(ai_latency: float):
+    """Offline stand-ins for Gemini and Firebase token verification."""
+    import google.generativeai as genai
+
+    class _Response:
+        text = 'Stubbed model answer.'
+
+    class _Model:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def generate_content(self, *args, **kwargs):
+            time.sleep(ai_latency)
+            return _Response()
+
+        async def generate_content_async(self, *args, **kwargs):
+            await asyncio.sleep(ai_latency)
+            return _Response()
+
+    genai.GenerativeModel = _Model
+
+    from services import firebase_service
+    firebase_service.verify_token = lambda token, check_revoked=None: (
+        {'uid': 'loadtest', 'email': 'loadtest@example.com'} if token else None)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def serve_wsgi(flask_app, port: int, threads: int):
+    """Flask on a fixed-size thread pool, like one threaded WSGI worker."""
+    from werkzeug.serving import BaseWSGIServer
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    class PooledServer(BaseWSGIServer):
+        pool = ThreadPoolExecutor(max_workers=threads)
+
+        def process_request(self, request, client_address):
+            self.pool.submit(self._handle, request, client_address)
+
+        def _handle(self, request, client_address):
+            try:
+                self.finish_request(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    server = PooledServer('127.0.0.1', port, flask_app)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.shutdown
+
+
+def serve_asgi(asgi_app, port: int):
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(asgi_app, host='127.0.0.1', port=port,
+                                           log_level='warning', lifespan='on'))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+
+    def stop():
+        server.should_exit = True
+    return stop
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(latencies, statuses):
+    ok = [lat for lat, status in zip(latencies, statuses) if status < 500]
+    return {
+        'requests': len(latencies),
+        'errors': sum(1 for s in statuses if s >= 500 or s == 0),
+        'rejected_503': sum(1 for s in statuses if s == 503),
+        'p50_ms': round(percentile(ok, 50) * 1000, 1) if ok else None,
+        'p95_ms': round(percentile(ok, 95) * 1000, 1) if ok else None,
+        'p99_ms': round(percentile(ok, 99) * 1000, 1) if ok else None,
+        'max_ms': round(max(ok) * 1000, 1) if ok else None,
+    }
+
+
+async def run_load(base_url, args):
+    import httpx
+    ai = {'lat': [], 'status': []}
+    cheap = {'lat': [], 'status': []}
+    headers = {'Authorization': f'Bearer {args.token}'} if args.token else {}
+    ai_body = json.loads(args.ai_body)
+    deadline = time.monotonic() + args.duration
+    limits = httpx.Limits(max_connections=args.ai_concurrency + 16)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=60, limits=limits) as client:
+        async def timed(bucket, method, path, **kwargs):
+            start = time.monotonic()
+            try:
+                resp = await client.request(method, path, headers=headers, **kwargs)
+                status = resp.status_code
+            except Exception:
+                status = 0
+            bucket['lat'].append(time.monotonic() - start)
+            bucket['status'].append(status)
+
+        async def ai_worker():
+            while time.monotonic() < deadline:
+                await timed(ai, 'POST', args.ai_path, json=ai_body)
+
+        async def cheap_prober():
+            interval = 1.0 / args.cheap_rps
+            probes = []
+            while time.monotonic() < deadline:
+                probes.append(asyncio.create_task(timed(cheap, 'GET', args.cheap_path)))
+                await asyncio.sleep(interval)
+            await asyncio.gather(*probes)
+
+        # Let the AI flood build up before probing
+        workers = [asyncio.create_task(ai_worker()) for _ in range(args.ai_concurrency)]
+        await asyncio.sleep(min(1.0, args.duration / 4))
+        await cheap_prober()
+        await asyncio.gather(*workers)
+
+    return {'ai': summarize(ai['lat'], ai['status']),
+            'cheap': summarize(cheap['lat'], cheap['status'])}
+
+
+def print_report(label, result):
+    print(f"\n== {label}")
+    for name in ('cheap', 'ai'):
+        r = result[name]
+        print(f"  {name:<6} n={r['requests']:<5} p50={r['p50_ms']}ms p95={r['p95_ms']}ms "
+              f"p99={r['p99_ms']}ms max={r['max_ms']}ms errors={r['errors']} "
+              f"(503: {r['rejected_503']})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--base-url', help='test a running server instead of self-hosting')
+    parser.add_argument('--mode', choices=['wsgi', 'asgi', 'both'], default='both',
+                        help='self-hosted servers to compare')
+    parser.add_argument('--token', default='loadtest', help='bearer token sent with every request')
+    parser.add_argument('--ai-path', default='/api/ai/chatbot')
+    parser.add_argument('--ai-body', default='{"query": "How do I report a pothole?"}')
+    parser.add_argument('--cheap-path', default='/api/health')
+    parser.add_argument('--ai-concurrency', type=int, default=32)
+    parser.add_argument('--ai-latency', type=float, default=2.0,
+                        help='stubbed seconds per Gemini call (self-hosted only)')
+    parser.add_argument('--cheap-rps', type=float, default=20)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--threads', type=int, default=8,
+                        help='worker threads for the self-hosted WSGI server')
+    parser.add_argument('--json', dest='json_out', help='write results to this file')
+    args = parser.parse_args(argv)
+
+    results = {}
+    if args.base_url:
+        results['remote'] = asyncio.run(run_load(args.base_url, args))
+        print_report(args.base_url, results['remote'])
+    else:
+        os.environ.setdefault('ASGI_WSGI_THREADS', str(args.threads))
+        stub_dependencies(args.ai_latency)
+        import asgi
+
+        if args.mode in ('wsgi', 'both'):
+            port = free_port()
+            stop = serve_wsgi(asgi.app.flask_app, port, args.threads)
+            results['wsgi'] = asyncio.run(run_load(f'http://127.0.0.1:{port}', args))
+            stop()
+            print_report(f'Flask on {args.threads} threads', results['wsgi'])
+        if args.mode in ('asgi', 'both'):
+            port = free_port()
+            stop = serve_asgi(asgi.app, port)
+            results['asgi'] = asyncio.run(run_load(f'http://127.0.0.1:{port}', args))
+            stop()
+            print_report(f'asgi.py (uvicorn, {args.threads} WSGI threads)', results['asgi'])
+
+    if args.json_out:
+        with open(args.json_out, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
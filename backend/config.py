@@ -22,12 +22,154 @@ class Config:
     # CORS
     FRONTEND_URL = os.getenv('FRONTEND_URL', 'http://localhost:3000')
 
+    # Auth: decoded ID-token cache
+    AUTH_TOKEN_CACHE_SIZE = int(os.getenv('AUTH_TOKEN_CACHE_SIZE', 10000))
+    AUTH_TOKEN_CACHE_MARGIN_SECONDS = int(
+        os.getenv('AUTH_TOKEN_CACHE_MARGIN_SECONDS', 30))
+    # When enabled, tokens are re-checked for revocation at least this often
+    AUTH_CHECK_REVOKED = os.getenv('AUTH_CHECK_REVOKED', 'False') == 'True'
+    AUTH_REVOCATION_RECHECK_SECONDS = int(
+        os.getenv('AUTH_REVOCATION_RECHECK_SECONDS', 300))
+
+    # Role/profile cache for admin_required
+    ROLE_CACHE_TTL_SECONDS = int(os.getenv('ROLE_CACHE_TTL_SECONDS', 60))
+    ROLE_FROM_CLAIMS = os.getenv('ROLE_FROM_CLAIMS', 'True') == 'True'
+    SYNC_ROLE_CLAIMS = os.getenv('SYNC_ROLE_CLAIMS', 'False') == 'True'
+    # Coalescing window for last-seen/profile touches from /api/auth/verify
+    PROFILE_WRITE_BEHIND_SECONDS = int(
+        os.getenv('PROFILE_WRITE_BEHIND_SECONDS', 30))
+
     # Google Maps
     GOOGLE_MAPS_API_KEY = os.getenv('GOOGLE_MAPS_API_KEY')
 
     # Upload settings
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+    # Resumable upload chunk (must be a multiple of 256 KB)
+    STORAGE_UPLOAD_CHUNK_SIZE = int(
+        os.getenv('STORAGE_UPLOAD_CHUNK_SIZE', 1024 * 1024))
+    # 'token' (Firebase download token URLs) or 'public_prefix' (bucket IAM)
+    STORAGE_PUBLIC_MODE = os.getenv('STORAGE_PUBLIC_MODE', 'token')
+    STORAGE_HEALTH_INTERVAL_SECONDS = int(
+        os.getenv('STORAGE_HEALTH_INTERVAL_SECONDS', 300))
+    STORAGE_WRITE_WORKERS = int(os.getenv('STORAGE_WRITE_WORKERS', 8))
+
+    # Direct-to-Storage uploads (V4 signed PUT URLs)
+    SIGNED_UPLOAD_TTL_SECONDS = int(os.getenv('SIGNED_UPLOAD_TTL_SECONDS', 900))
+    UPLOAD_MAX_BYTES = int(os.getenv('UPLOAD_MAX_BYTES', 15 * 1024 * 1024))
+    UPLOAD_CONTENT_TYPES = os.getenv(
+        'UPLOAD_CONTENT_TYPES', 'image/jpeg,image/png,image/webp,image/heic').split(',')
+    UPLOAD_BATCH_MAX_FILES = int(os.getenv('UPLOAD_BATCH_MAX_FILES', 10))
+    UPLOAD_BATCH_MAX_BYTES = int(os.getenv('UPLOAD_BATCH_MAX_BYTES', 60 * 1024 * 1024))
+    UPLOAD_BATCH_WORKERS = int(os.getenv('UPLOAD_BATCH_WORKERS', 4))
+    # dHash bits two photos may differ by and still be reported as similar
+    UPLOAD_PHASH_MAX_DISTANCE = int(os.getenv('UPLOAD_PHASH_MAX_DISTANCE', 6))
+
+    # Gemini circuit breaker: opens when failure_rate (or slow_rate of calls
+    # over SLOW_SECONDS) of the last WINDOW calls fail, probes after OPEN_SECONDS
+    GEMINI_BREAKER_WINDOW = int(os.getenv('GEMINI_BREAKER_WINDOW', 20))
+    GEMINI_BREAKER_MIN_CALLS = int(os.getenv('GEMINI_BREAKER_MIN_CALLS', 5))
+    GEMINI_BREAKER_FAILURE_RATE = float(os.getenv('GEMINI_BREAKER_FAILURE_RATE', 0.5))
+    GEMINI_BREAKER_SLOW_SECONDS = float(os.getenv('GEMINI_BREAKER_SLOW_SECONDS', 15))
+    GEMINI_BREAKER_SLOW_RATE = float(os.getenv('GEMINI_BREAKER_SLOW_RATE', 0.8))
+    GEMINI_BREAKER_OPEN_SECONDS = float(os.getenv('GEMINI_BREAKER_OPEN_SECONDS', 30))
+
+    # Admission control for AI routes (services/admission.py)
+    ADMISSION_ENABLED = os.getenv('ADMISSION_ENABLED', 'True') == 'True'
+    # class=requests/seconds token buckets, per user and per client IP
+    ADMISSION_USER_RATES = os.getenv('ADMISSION_USER_RATES', 'ai=30/60,report=10/60')
+    ADMISSION_IP_RATES = os.getenv('ADMISSION_IP_RATES', 'ai=60/60,chatbot=30/60,report=20/60')
+    ADMISSION_STORE = os.getenv('ADMISSION_STORE', 'memory')  # memory | firestore
+    AI_MAX_CONCURRENCY = int(os.getenv('AI_MAX_CONCURRENCY', 16))
+    # Per-route caps inside AI_MAX_CONCURRENCY
+    AI_ROUTE_CONCURRENCY = os.getenv(
+        'AI_ROUTE_CONCURRENCY',
+        'predict-type=8,generate-summary=16,verify-resolution=4,chatbot=16,'
+        'insights=2,process-issue=4,complaints-new=8')
+    AI_MAX_QUEUE = int(os.getenv('AI_MAX_QUEUE', 32))
+    AI_QUEUE_WAIT_SECONDS = float(os.getenv('AI_QUEUE_WAIT_SECONDS', 2))
+    # X-Forwarded-For entries added by our own proxies (0 = use the socket address)
+    TRUST_PROXY_HOPS = int(os.getenv('TRUST_PROXY_HOPS', 0))
+
+    # Idempotency-Key replay for complaint creation and process-issue (services/idempotency.py)
+    IDEMPOTENCY_ENABLED = os.getenv('IDEMPOTENCY_ENABLED', 'True') == 'True'
+    IDEMPOTENCY_STORE = os.getenv('IDEMPOTENCY_STORE', 'memory')  # memory | firestore
+    IDEMPOTENCY_TTL_SECONDS = int(os.getenv('IDEMPOTENCY_TTL_SECONDS', 24 * 3600))
+    # How long a duplicate waits for the original request before getting 409
+    IDEMPOTENCY_WAIT_SECONDS = float(os.getenv('IDEMPOTENCY_WAIT_SECONDS', 10))
+    # An execution that never finished (crashed) stops blocking its key after this
+    IDEMPOTENCY_LOCK_SECONDS = int(os.getenv('IDEMPOTENCY_LOCK_SECONDS', 120))
+
+    # ASGI serving (asgi.py): the Flask thread pool and native route body cap
+    ASGI_WSGI_THREADS = int(os.getenv('ASGI_WSGI_THREADS', 16))
+    ASGI_MAX_BODY_BYTES = int(os.getenv('ASGI_MAX_BODY_BYTES', 20 * 1024 * 1024))
+
+    # Speculative image classification right after upload
+    AI_PREFETCH_ENABLED = os.getenv('AI_PREFETCH_ENABLED', 'True') == 'True'
+    AI_PREFETCH_WORKERS = int(os.getenv('AI_PREFETCH_WORKERS', 4))
+    AI_PREFETCH_WAIT_SECONDS = float(os.getenv('AI_PREFETCH_WAIT_SECONDS', 8))
+    AI_PREFETCH_MAX_ENTRIES = int(os.getenv('AI_PREFETCH_MAX_ENTRIES', 1000))
+    AI_PREFETCH_TTL_SECONDS = int(os.getenv('AI_PREFETCH_TTL_SECONDS', 3600))
+
+    # Image derivatives (longest edge in px)
+    IMAGE_THUMB_SIZE = int(os.getenv('IMAGE_THUMB_SIZE', 256))
+    IMAGE_MEDIUM_SIZE = int(os.getenv('IMAGE_MEDIUM_SIZE', 1024))
+    IMAGE_ANALYSIS_SIZE = int(os.getenv('IMAGE_ANALYSIS_SIZE', 768))
+    IMAGE_POOL_WORKERS = int(os.getenv('IMAGE_POOL_WORKERS', 2))
+    IMAGE_DERIVE_TIMEOUT_SECONDS = int(
+        os.getenv('IMAGE_DERIVE_TIMEOUT_SECONDS', 20))
+
+    # Resolution verification (services/resolution_service.py)
+    RESOLUTION_IMAGE_SIZE = int(os.getenv('RESOLUTION_IMAGE_SIZE', 512))
+    RESOLUTION_CACHE_SIZE = int(os.getenv('RESOLUTION_CACHE_SIZE', 32))  # before photos
+    RESOLUTION_FETCH_WORKERS = int(os.getenv('RESOLUTION_FETCH_WORKERS', 4))
+    RESOLUTION_FETCH_TIMEOUT = float(os.getenv('RESOLUTION_FETCH_TIMEOUT', 10))
+    # After photos at least this similar are answered not_resolved without Gemini
+    RESOLUTION_SSIM_THRESHOLD = float(os.getenv('RESOLUTION_SSIM_THRESHOLD', 0.95))
+    RESOLUTION_PIXEL_THRESHOLD = float(os.getenv('RESOLUTION_PIXEL_THRESHOLD', 0.02))
+
+    # Analytics rollups (hourly/daily buckets per category, status, geocell)
+    ROLLUP_HOURLY_WINDOW = int(os.getenv('ROLLUP_HOURLY_WINDOW', 24 * 14))
+    ROLLUP_DAILY_WINDOW = int(os.getenv('ROLLUP_DAILY_WINDOW', 365))
+    ROLLUP_GEOCELL_PRECISION = int(os.getenv('ROLLUP_GEOCELL_PRECISION', 2))
+    ROLLUP_SNAPSHOT_MINUTES = int(os.getenv('ROLLUP_SNAPSHOT_MINUTES', 5))
+
+    # Map tiles (clustered issue locations)
+    TILE_CLUSTER_GRID = int(os.getenv('TILE_CLUSTER_GRID', 8))
+    TILE_CACHE_SIZE = int(os.getenv('TILE_CACHE_SIZE', 4096))
+    TILE_INDEX_TTL_SECONDS = int(os.getenv('TILE_INDEX_TTL_SECONDS', 300))
+
+    # Coordinated background jobs (services/scheduler_service.py). Disable
+    # in the web workers when running `python scheduler.py` separately.
+    RUN_SCHEDULER_IN_WEB = os.getenv('RUN_SCHEDULER_IN_WEB', 'True') == 'True'
+    WEEKLY_SUMMARY_INTERVAL_HOURS = int(
+        os.getenv('WEEKLY_SUMMARY_INTERVAL_HOURS', 24))
+    SCHEDULER_JITTER_SECONDS = int(os.getenv('SCHEDULER_JITTER_SECONDS', 300))
+    SCHEDULER_LEASE_SECONDS = int(os.getenv('SCHEDULER_LEASE_SECONDS', 1800))
+    SCHEDULER_POLL_SECONDS = int(os.getenv('SCHEDULER_POLL_SECONDS', 15))
+
+    # Request tracing: Server-Timing header and sampled slow-request log
+    TRACING_ENABLED = os.getenv('TRACING_ENABLED', 'True') == 'True'
+    TRACE_SLOW_MS = float(os.getenv('TRACE_SLOW_MS', 1000))
+    TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 1.0))
+    # JSON-lines file (rotated at 5 MB); empty logs to stdout
+    TRACE_LOG_PATH = os.getenv('TRACE_LOG_PATH', 'slow_requests.jsonl')
+    TRACE_MAX_SPANS = int(os.getenv('TRACE_MAX_SPANS', 256))
+
+    # Bearer token required by GET /metrics (open when unset)
+    METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+    # Response compression (brotli when installed, else gzip)
+    COMPRESSION_ENABLED = os.getenv('COMPRESSION_ENABLED', 'True') == 'True'
+    COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', 1024))
+    GZIP_LEVEL = int(os.getenv('GZIP_LEVEL', 6))
+    BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', 4))
+
+    # Streaming exports
+    EXPORT_PAGE_SIZE = int(os.getenv('EXPORT_PAGE_SIZE', 500))
+
+    # Bulk admin operations
+    BULK_MAX_ITEMS = int(os.getenv('BULK_MAX_ITEMS', 5000))
 
 
 class DevelopmentConfig(Config):
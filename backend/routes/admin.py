@@ -1,8 +1,13 @@
 """Admin routes."""
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, Response, stream_with_context, current_app
 from routes.auth import admin_required
-from services.firebase_service import get_firestore, get_storage
-from services.gemini_service import verify_resolution, generate_insights
+from services.firebase_service import get_firestore, get_storage, get_document, get_documents
+from services.gemini_service import generate_insights
+from services import (
+    timeseries_service, tile_service, export_service, scheduler_service, resolution_service
+)
+from services.serialization import negotiated
+from services.image_service import object_path_from_url
 from firebase_admin import firestore
 from datetime import datetime
 import traceback
@@ -12,6 +17,36 @@ from PIL import Image
 
 admin_bp = Blueprint('admin', __name__)
 
+# Reporter fields shown next to each complaint in admin lists
+USER_SUMMARY_FIELDS = ['name', 'email']
+
+
+def _attach_users(complaints):
+    """Add each complaint's reporter as `user`, reading all of them in one batch."""
+    users = get_documents('users', [c.get('user_id') for c in complaints], USER_SUMMARY_FIELDS)
+    for complaint in complaints:
+        profile = users.get(complaint.get('user_id'))
+        complaint['user'] = {'uid': complaint['user_id'], **profile} if profile is not None else None
+    return complaints
+
+
+def _filtered_complaints_query(db, args):
+    """Complaints query with the admin list filters (status, type, priority)."""
+    query = db.collection('complaints')
+
+    status = args.get('status')
+    issue_type = args.get('type')
+    priority = args.get('priority')
+
+    if status:
+        query = query.where('status', '==', status)
+    if issue_type:
+        query = query.where('type', '==', issue_type)
+    if priority:
+        query = query.where('priority', '==', priority)
+
+    return query.order_by('created_at', direction='DESCENDING')
+
 
 @admin_bp.route('/complaints', methods=['GET'])
 @admin_required
@@ -19,21 +54,7 @@ def admin_get_complaints():
     """Get all complaints for admin dashboard."""
     try:
         db = get_firestore()
-        query = db.collection('complaints')
-
-        # Apply filters
-        status = request.args.get('status')
-        issue_type = request.args.get('type')
-        priority = request.args.get('priority')
-
-        if status:
-            query = query.where('status', '==', status)
-        if issue_type:
-            query = query.where('type', '==', issue_type)
-        if priority:
-            query = query.where('priority', '==', priority)
-
-        query = query.order_by('created_at', direction='DESCENDING')
+        query = _filtered_complaints_query(db, request.args)
 
         complaints = []
         for doc in query.stream():
@@ -41,10 +62,46 @@ def admin_get_complaints():
             complaint['id'] = doc.id
             complaints.append(complaint)
 
-        return jsonify(complaints), 200
+        return negotiated(_attach_users(complaints)), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@admin_bp.route('/complaints/export', methods=['GET'])
+@admin_required
+def export_complaints():
+    """Stream all complaints matching the admin list filters.
+
+    Query params: format (ndjson|csv|parquet), status, type, priority.
+    """
+    fmt = request.args.get('format', 'ndjson').lower()
+    if fmt not in export_service.FORMATS:
+        return jsonify({'error': f'format must be one of {list(export_service.FORMATS)}'}), 400
+    if fmt == 'parquet' and not export_service.parquet_available():
+        return jsonify({'error': 'Parquet export requires pyarrow on the server'}), 400
+
+    try:
+        db = get_firestore()
+        query = _filtered_complaints_query(db, request.args)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+    encoders = {
+        'ndjson': export_service.ndjson_stream,
+        'csv': export_service.csv_stream,
+        'parquet': export_service.parquet_stream,
+    }
+    rows = (export_service.flatten(doc)
+            for doc in export_service.iter_documents(query))
+    filename = f"complaints-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.{fmt}"
+    return Response(
+        stream_with_context(encoders[fmt](rows)),
+        mimetype=export_service.FORMATS[fmt],
+        headers={
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            'X-Accel-Buffering': 'no',
+        })
+
 
 @admin_bp.route('/complaints/<complaint_id>', methods=['PUT'])
 @admin_required
@@ -69,13 +126,127 @@ def update_complaint_status(complaint_id):
         if 'resolution_confidence' in data:
             update_data['resolution_confidence'] = data['resolution_confidence']
 
-        db.collection('complaints').document(complaint_id).update(update_data)
+        complaint_ref = db.collection('complaints').document(complaint_id)
+        previous = None
+        if 'status' in data or 'priority' in data:
+            previous = get_document('complaints', complaint_id)
+        if 'priority' in data and 'priority' in ((previous or {}).get('ai_pending') or []):
+            # Deferred enrichment must not replace the admin's priority
+            update_data['ai_pending'] = firestore.ArrayRemove(['priority'])
+
+        complaint_ref.update(update_data)
+
+        if previous is not None and 'status' in data:
+            timeseries_service.record_status_change(previous, data['status'])
+            tile_service.on_issue_changed(
+                complaint_id, {**previous, 'status': data['status']})
 
         return jsonify({'message': 'Complaint updated successfully'}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+BULK_FIELDS = ('status', 'priority', 'admin_remarks')
+BATCH_LIMIT = 500  # Firestore max writes per batch
+
+
+@admin_bp.route('/complaints/bulk', methods=['POST'])
+@admin_required
+def bulk_update_complaints():
+    """Apply status/priority/remarks changes to many complaints at once.
+
+    Body: {"updates": [{"id", "status"?, "priority"?, "admin_remarks"?}, ...]}
+       or {"ids": [...], "status"?, "priority"?, "admin_remarks"?}
+
+    Writes go out in batches of 500. Documents that already hold the
+    requested values are reported as unchanged and not rewritten, so a
+    retried request is a no-op for everything that succeeded the first time.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        if 'updates' in data:
+            items = data.get('updates') or []
+        else:
+            shared = {f: data[f] for f in BULK_FIELDS if f in data}
+            items = [{'id': cid, **shared} for cid in data.get('ids') or []]
+
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': 'updates or ids required'}), 400
+        if len(items) > current_app.config['BULK_MAX_ITEMS']:
+            return jsonify({'error': f"At most {current_app.config['BULK_MAX_ITEMS']} complaints per request"}), 400
+
+        # Last change wins when an id appears more than once
+        changes = {}
+        for item in items:
+            cid = item.get('id') if isinstance(item, dict) else None
+            if not cid or not isinstance(cid, str):
+                return jsonify({'error': 'Every update needs a string id'}), 400
+            fields = {f: item[f] for f in BULK_FIELDS if f in item}
+            if not fields:
+                return jsonify({'error': f'No changes given for {cid}'}), 400
+            changes.setdefault(cid, {}).update(fields)
+
+        db = get_firestore()
+        collection = db.collection('complaints')
+        results = {}
+        transitions = []
+        ids = list(changes)
+        for start in range(0, len(ids), BATCH_LIMIT):
+            chunk = ids[start:start + BATCH_LIMIT]
+            snaps = {snap.id: snap for snap in db.get_all(
+                [collection.document(cid) for cid in chunk])}
+
+            batch = db.batch()
+            pending = []
+            for cid in chunk:
+                snap = snaps.get(cid)
+                if snap is None or not snap.exists:
+                    results[cid] = {'status': 'not_found'}
+                    continue
+                current = snap.to_dict() or {}
+                diff = {f: v for f, v in changes[cid].items()
+                        if current.get(f) != v}
+                if not diff:
+                    results[cid] = {'status': 'unchanged'}
+                    continue
+                update = {**diff, 'updated_at': datetime.utcnow()}
+                if 'priority' in diff and 'priority' in (current.get('ai_pending') or []):
+                    update['ai_pending'] = firestore.ArrayRemove(['priority'])
+                batch.update(snap.reference, update)
+                pending.append((cid, current, diff))
+
+            if not pending:
+                continue
+            try:
+                batch.commit()
+            except Exception as e:
+                for cid, _, _ in pending:
+                    results[cid] = {'status': 'failed', 'error': str(e)}
+                continue
+            for cid, current, diff in pending:
+                results[cid] = {'status': 'updated',
+                                'fields': sorted(diff)}
+                if 'status' in diff:
+                    transitions.append((cid, current, diff['status']))
+
+        for cid, current, new_status in transitions:
+            timeseries_service.record_status_change(current, new_status)
+            tile_service.on_issue_changed(
+                cid, {**current, 'status': new_status})
+
+        summary = {}
+        for r in results.values():
+            summary[r['status']] = summary.get(r['status'], 0) + 1
+        return jsonify({
+            'summary': summary,
+            'results': results
+        }), 200
+    except Exception as e:
+        print(f"Bulk update error: {str(e)}")
+        traceback.print_exc()
+        return jsonify({'error': 'Bulk update failed', 'details': str(e)}), 500
+
+
 @admin_bp.route('/stats', methods=['GET'])
 @admin_required
 def get_stats():
@@ -83,8 +254,9 @@ def get_stats():
     try:
         db = get_firestore()
 
-        # Get total counts
-        all_complaints = list(db.collection('complaints').stream())
+        # Get total counts (only the fields counted below)
+        all_complaints = list(db.collection('complaints').select(
+            ['status', 'type', 'priority']).stream())
 
         stats = {
             'total': len(all_complaints),
@@ -106,7 +278,7 @@ def get_stats():
             stats['by_priority'][priority] = stats['by_priority'].get(
                 priority, 0) + 1
 
-        return jsonify(stats), 200
+        return negotiated(stats), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -114,9 +286,13 @@ def get_stats():
 @admin_bp.route('/verify-resolution', methods=['POST'])
 @admin_required
 def verify_resolution_endpoint():
-    """Verify issue resolution using AI image comparison."""
+    """Verify issue resolution by comparing the complaint photo with an after photo.
+
+    Body: {"complaint_id", "after_image_url"}. The result (with similarity
+    scores and stage timings) is stored on the complaint as `ai_verification`.
+    """
     try:
-        data = request.get_json()
+        data = request.get_json(silent=True) or {}
 
         # Validate required fields
         if 'complaint_id' not in data or 'after_image_url' not in data:
@@ -124,35 +300,40 @@ def verify_resolution_endpoint():
 
         complaint_id = data['complaint_id']
         after_image_url = data['after_image_url']
+        # Only photos stored by this backend; never fetch arbitrary URLs
+        if not isinstance(after_image_url, str) or object_path_from_url(after_image_url) is None:
+            return jsonify({'error': 'after_image_url must be a photo uploaded to CityFix'}), 400
 
         # Get complaint
         db = get_firestore()
         complaint_ref = db.collection('complaints').document(complaint_id)
-        complaint_doc = complaint_ref.get()
+        complaint_data = get_document('complaints', complaint_id)
 
-        if not complaint_doc.exists:
+        if complaint_data is None:
             return jsonify({'error': 'Complaint not found'}), 404
 
-        complaint_data = complaint_doc.to_dict()
         before_image_url = complaint_data.get('photo_url')
 
         if not before_image_url:
             return jsonify({'error': 'Original complaint photo not found'}), 400
 
-        # Call Gemini AI to verify resolution
-        verification_result = verify_resolution(
-            before_image_url, after_image_url)
+        verification_result = resolution_service.verify(
+            complaint_data.get('type'), before_url=before_image_url, after_url=after_image_url)
+        if verification_result.get('error'):
+            return jsonify({'error': 'Failed to verify resolution',
+                            'details': verification_result['error']}), 500
 
         # Update complaint with verification results
         update_data = {
             'resolution_photo_url': after_image_url,
             'ai_verification': verification_result,
-            'resolution_confidence': verification_result.get('confidence', 0.0),
+            'resolution_confidence': verification_result['confidence'],
+            'ai_verified_at': firestore.SERVER_TIMESTAMP,
             'updated_at': firestore.SERVER_TIMESTAMP
         }
 
         # If AI says it's resolved with high confidence, suggest status change
-        if verification_result.get('resolved') and verification_result.get('confidence', 0) > 0.7:
+        if verification_result['resolved'] and verification_result['confidence'] > 0.7:
             update_data['ai_suggested_status'] = 'Resolved'
 
         complaint_ref.update(update_data)
@@ -173,31 +354,100 @@ def verify_resolution_endpoint():
 def get_insights():
     """Generate AI insights from complaint data."""
     try:
-        db = get_firestore()
-
-        # Get recent complaints (last 100)
-        complaints_query = db.collection('complaints').order_by(
-            'created_at', direction='DESCENDING').limit(100)
-        complaints = []
-
-        for doc in complaints_query.stream():
-            complaint_data = doc.to_dict()
-            complaints.append({
-                'type': complaint_data.get('type'),
-                'status': complaint_data.get('status'),
-                'priority': complaint_data.get('priority'),
-                'location': complaint_data.get('location'),
-                'created_at': complaint_data.get('created_at')
-            })
-
-        # Generate AI insights
-        insights = generate_insights(complaints)
+        days = int(request.args.get('days', 14))
+    except ValueError:
+        return jsonify({'error': 'days must be an integer'}), 400
+    if days < 1:
+        return jsonify({'error': 'days must be positive'}), 400
+    # Rollups only reach back as far as the daily ring buffer
+    days = min(days, timeseries_service.GRANULARITIES['daily'][1])
+    try:
+        # Feed Gemini pre-aggregated rollups instead of raw documents
+        summary = timeseries_service.insight_summary(days=days)
+        insights = generate_insights(summary)
 
         return jsonify({
             'insights': insights,
-            'data_points': len(complaints)
+            'data_points': sum(summary['status_totals'].values())
         }), 200
 
     except Exception as e:
         print(f"Get insights error: {str(e)}")
         return jsonify({'error': 'Failed to generate insights', 'details': str(e)}), 500
+
+
+@admin_bp.route('/timeseries', methods=['GET'])
+@admin_required
+def get_timeseries():
+    """Pre-aggregated issue counts per bucket.
+
+    Query params: granularity (hourly|daily), days, category, status,
+    geocell, group_by (category|status|geocell).
+    """
+    try:
+        granularity = request.args.get('granularity', 'daily')
+        days = float(request.args.get('days', 30))
+        group_by = request.args.get('group_by')
+        if group_by and group_by not in timeseries_service.KEY_FIELDS:
+            return jsonify({'error': f'group_by must be one of {list(timeseries_service.KEY_FIELDS)}'}), 400
+        filters = {
+            'category': request.args.get('category'),
+            'status': (request.args.get('status') or '').lower() or None,
+            'geocell': request.args.get('geocell'),
+        }
+        result = timeseries_service.get_series(
+            granularity, days, filters, group_by)
+        return jsonify(result), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@admin_bp.route('/timeseries/rebuild', methods=['POST'])
+@admin_required
+def rebuild_timeseries():
+    """Recompute rollups from the source collections."""
+    try:
+        counted = timeseries_service.rebuild_from_firestore()
+        return jsonify({'message': 'Rollups rebuilt', 'documents': counted}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@admin_bp.route('/generate-report', methods=['POST'])
+@admin_required
+def generate_report():
+    """Queue a weekly summary run; the scheduler executes it shortly."""
+    try:
+        run = scheduler_service.enqueue('weekly_summary',
+                                        requested_by=request.user['uid'])
+        return jsonify(run), 202
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@admin_bp.route('/job-runs', methods=['GET'])
+@admin_required
+def list_job_runs():
+    """Most recent scheduled and manual job runs."""
+    try:
+        limit = min(int(request.args.get('limit', 20)), 100)
+        return jsonify(scheduler_service.recent_runs(limit=limit)), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@admin_bp.route('/job-runs/<run_id>', methods=['GET'])
+@admin_required
+def get_job_run(run_id):
+    """Status of one job run (poll after generate-report)."""
+    try:
+        run = scheduler_service.get_run(run_id)
+        if run is None:
+            return jsonify({'error': 'Run not found'}), 404
+        return jsonify(run), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
@@ -4,152 +4,219 @@ from routes.auth import token_required
 from services.gemini_service import (
     predict_issue_type,
     generate_summary_and_priority,
-    verify_resolution,
     generate_insights,
     chatbot_response,
-    classify_issue,
     get_text_embedding,
-    cosine_similarity,
-    image_similarity_score,
-    assess_severity
+    ai_available
 )
+from firebase_admin import firestore
 import base64
 from PIL import Image
 import io
-import requests
-from io import BytesIO
-from services.firebase_service import get_firestore, get_nearby_documents
+from services.firebase_service import (
+    get_firestore, get_document, finalize_upload
+)
+from services import timeseries_service, tile_service, prefetch_service, resolution_service, tracing
+from services.image_service import object_path_from_url
+from services.admission import admit
+from services.idempotency import idempotent
+from services.enrichment_service import (
+    EMBEDDING_FIELD,
+    classify_and_prioritize,
+    complaint_type_from,
+    fetch_analysis_image,
+    find_duplicate
+)
 
 ai_bp = Blueprint('ai', __name__)
 
+# --------------------- Shared request logic ---------------------
+#
+# The Flask views below and the native async routes in asgi.py run the same
+# request functions. A request function is a generator returning (status,
+# body): it yields `(function, *args)` for each blocking step (model calls,
+# downloads, Storage lookups) and is sent the result. `run_request` calls the
+# functions inline; asgi.py awaits their async twins instead.
+
+def run_request(gen):
+    """Run a request function synchronously; returns (status, body)."""
+    try:
+        step = next(gen)
+        while True:
+            function, *args = step
+            step = gen.send(function(*args))
+    except StopIteration as done:
+        return done.value
+
+
+def prefetched_prediction(path, photo_url):
+    """Upload-time classification of a photo, if there is one."""
+    return prefetch_service.get_prediction(path=path, photo_url=photo_url)
+
+
+def predict_type_request(data, uid, image=None):
+    """Request function for predict-type; `image` is an already opened upload."""
+    if data.get('path') or data.get('photo_url'):
+        path, photo_url = data.get('path'), data.get('photo_url')
+        if photo_url and (not isinstance(photo_url, str) or object_path_from_url(photo_url) is None):
+            # Fetched below on a prefetch miss: never an arbitrary URL
+            return 400, {'error': 'photo_url must be a photo uploaded to CityFix'}
+        for own in (path, object_path_from_url(photo_url)):
+            if own and (not isinstance(own, str) or not own.startswith(f"complaints/{uid}/")):
+                return 400, {'error': 'Invalid upload path'}
+        prediction = yield prefetched_prediction, path, photo_url
+        if prediction is None:
+            # Nothing prefetched (other instance restarted, feature off): classify now
+            if not photo_url:
+                photo_url = ((yield finalize_upload, path) or {}).get('url')
+            if not photo_url:
+                return 404, {'error': 'Uploaded object not found'}
+            img = yield fetch_analysis_image, photo_url, 10
+            prediction = complaint_type_from((yield predict_issue_type, img))
+        if not prediction or not prediction.get('predicted_type'):
+            return 404, {'error': 'No prediction available for this photo'}
+        return 200, {'predicted_type': prediction['predicted_type'],
+                     'type': prediction['type']}
+
+    if image is None and 'image_base64' in data:
+        image = Image.open(io.BytesIO(base64.b64decode(data['image_base64'])))
+    if image is None:
+        return 400, {'error': 'No image provided'}
+
+    result = yield predict_issue_type, image
+    if result['success']:
+        return 200, {'predicted_type': result['result'].strip().lower()}
+    return 500, {'error': result['error']}
+
+
+def generate_summary_request(data):
+    """Request function for generate-summary."""
+    description = data.get('description')
+    issue_type = data.get('type')
+    if not description or not issue_type:
+        return 400, {'error': 'Description and type required'}
+
+    result = yield generate_summary_and_priority, description, issue_type
+    if result['success']:
+        return 200, {'analysis': result['result']}
+    return 500, {'error': result['error']}
+
+
+def chatbot_request(data):
+    """Request function for the chatbot."""
+    query = data.get('query')
+    if not query:
+        return 400, {'error': 'Query required'}
+
+    result = yield chatbot_response, query, str(data.get('context', {}))
+    if result['success']:
+        return 200, {'response': result['result']}
+    return 500, {'error': result['error']}
+
 
 @ai_bp.route('/predict-type', methods=['POST'])
 @token_required
+@admit('ai', 'predict-type')
 def predict_type():
-    """Predict issue type from uploaded image."""
+    """Predict issue type from uploaded image.
+
+    Accepts a file, base64 image, or the `path`/`photo_url` of a photo
+    already uploaded through `/api/complaints/upload*`, which is usually
+    answered from the classification started at upload time.
+    """
     try:
-        # Get image from request (base64 or file upload)
         data = request.get_json(silent=True) or {}
-        if 'image' in request.files:
-            image_file = request.files['image']
-            image_data = Image.open(image_file.stream)
-        elif 'image_base64' in data:
-            image_base64 = data['image_base64']
-            image_bytes = base64.b64decode(image_base64)
-            image_data = Image.open(io.BytesIO(image_bytes))
-        else:
-            return jsonify({'error': 'No image provided'}), 400
-
-        result = predict_issue_type(image_data)
-
-        if result['success']:
-            return jsonify({'predicted_type': result['result'].strip().lower()}), 200
-        else:
-            return jsonify({'error': result['error']}), 500
+        image = Image.open(request.files['image'].stream) if 'image' in request.files else None
+        status, payload = run_request(predict_type_request(data, request.user['uid'], image))
+        return jsonify(payload), status
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
 @ai_bp.route('/generate-summary', methods=['POST'])
 @token_required
+@admit('ai', 'generate-summary')
 def generate_summary():
     """Generate summary and priority from complaint description."""
     try:
         data = request.get_json(silent=True) or {}
-        description = data.get('description')
-        issue_type = data.get('type')
-
-        if not description or not issue_type:
-            return jsonify({'error': 'Description and type required'}), 400
-
-        result = generate_summary_and_priority(description, issue_type)
-
-        if result['success']:
-            # Parse the response
-            response_text = result['result']
-            return jsonify({'analysis': response_text}), 200
-        else:
-            return jsonify({'error': result['error']}), 500
+        status, payload = run_request(generate_summary_request(data))
+        return jsonify(payload), status
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
 @ai_bp.route('/verify-resolution', methods=['POST'])
 @token_required
+@admit('ai', 'verify-resolution')
 def verify_resolution_route():
-    """Verify issue resolution by comparing before/after images."""
+    """Verify issue resolution by comparing before/after images.
+
+    Body: {"issue_type", "before_url" | "before_image", "after_url" | "after_image"}.
+    URLs must be photos uploaded through this backend; `*_image` fields take
+    base64 for clients that still send the bytes.
+    """
     try:
         data = request.get_json(silent=True) or {}
-        before_image_b64 = data.get('before_image')
-        after_image_b64 = data.get('after_image')
-        issue_type = data.get('issue_type')
-
-        if not all([before_image_b64, after_image_b64, issue_type]):
-            return jsonify({'error': 'Both images and issue type required'}), 400
-
-        # Decode images
-        if not isinstance(before_image_b64, str) or not isinstance(after_image_b64, str):
-            return jsonify({'error': 'Images must be base64 strings'}), 400
-        before_bytes = base64.b64decode(before_image_b64)
-        after_bytes = base64.b64decode(after_image_b64)
-        before_image = Image.open(io.BytesIO(before_bytes))
-        after_image = Image.open(io.BytesIO(after_bytes))
-
-        result = verify_resolution(before_image, after_image, issue_type)
-
-        if result['success']:
-            return jsonify({'verification': result['result']}), 200
-        else:
-            return jsonify({'error': result['error']}), 500
+        status, payload = verify_resolution_request(data)
+        return jsonify(payload), status
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+def verify_resolution_request(data):
+    """(status, body) for a verify-resolution JSON body."""
+    issue_type = data.get('issue_type')
+    sources = {}
+    for side in ('before', 'after'):
+        url, b64 = data.get(f'{side}_url'), data.get(f'{side}_image')
+        if url:
+            if not isinstance(url, str) or object_path_from_url(url) is None:
+                return 400, {'error': f'{side}_url must be a photo uploaded to CityFix'}
+            sources[f'{side}_url'] = url
+        elif b64:
+            if not isinstance(b64, str):
+                return 400, {'error': 'Images must be base64 strings'}
+            sources[f'{side}_image'] = Image.open(io.BytesIO(base64.b64decode(b64)))
+    if len(sources) != 2 or not issue_type:
+        return 400, {'error': 'Both images and issue type required'}
+
+    result = resolution_service.verify(issue_type, **sources)
+    if result.get('error'):
+        return 500, {'error': result['error']}
+    return 200, {'verification': result}
+
+
 @ai_bp.route('/chatbot', methods=['POST'])
+@admit('chatbot', 'chatbot')
 def chatbot():
     """AI chatbot for user queries."""
     try:
         data = request.get_json(silent=True) or {}
-        query = data.get('query')
-        context = data.get('context', {})
-
-        if not query:
-            return jsonify({'error': 'Query required'}), 400
-
-        result = chatbot_response(query, str(context))
-
-        if result['success']:
-            return jsonify({'response': result['result']}), 200
-        else:
-            return jsonify({'error': result['error']}), 500
+        status, payload = run_request(chatbot_request(data))
+        return jsonify(payload), status
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
 @ai_bp.route('/insights', methods=['GET'])
 @token_required
+@admit('ai', 'insights')
 def get_insights():
     """Generate AI insights from complaints data."""
     try:
-        from services.firebase_service import get_firestore
-        db = get_firestore()
-
-        # Get recent complaints
-        complaints = db.collection('complaints').order_by(
-            'created_at', direction='DESCENDING').limit(100).stream()
-
-        # Prepare data for AI
-        complaints_summary = []
-        for doc in complaints:
-            data = doc.to_dict()
-            complaints_summary.append({
-                'type': data.get('type'),
-                'status': data.get('status'),
-                'priority': data.get('priority'),
-                'location': data.get('location', {}).get('address', 'Unknown')
-            })
+        days = int(request.args.get('days', 14))
+    except ValueError:
+        return jsonify({'error': 'days must be an integer'}), 400
+    if days < 1:
+        return jsonify({'error': 'days must be positive'}), 400
+    # Rollups only reach back as far as the daily ring buffer
+    days = min(days, timeseries_service.GRANULARITIES['daily'][1])
+    try:
+        # Pre-aggregated rollups keep the prompt tiny and history-aware
+        summary = timeseries_service.insight_summary(days=days)
 
-        result = generate_insights(str(complaints_summary))
+        result = generate_insights(summary)
 
         if result['success']:
             return jsonify({'insights': result['result']}), 200
@@ -161,6 +228,8 @@ def get_insights():
 
 @ai_bp.route('/process-issue', methods=['POST'])
 @token_required
+@idempotent('process_issue')
+@admit('ai', 'process-issue')
 def process_issue():
     """Post-create AI processing for an 'issues' document.
 
@@ -177,11 +246,9 @@ def process_issue():
 
         db = get_firestore()
         doc_ref = db.collection('issues').document(issue_id)
-        snap = doc_ref.get()
-        if not snap.exists:
+        issue = get_document('issues', issue_id)
+        if issue is None:
             return jsonify({'error': 'Issue not found'}), 404
-
-        issue = snap.to_dict() or {}
         description = issue.get('description') or ''
         photo_url = issue.get('photoUrl') or issue.get('photo_url')
         loc = issue.get('location') or {}
@@ -191,77 +258,57 @@ def process_issue():
         if not (photo_url and isinstance(lat, (int, float)) and isinstance(lng, (int, float))):
             return jsonify({'error': 'Issue missing photo or location'}), 400
 
-        # Load image
-        img_resp = requests.get(photo_url, timeout=15)
-        img = Image.open(BytesIO(img_resp.content))
-
-        # 1) Category + confidence
-        cat = classify_issue(img, description)
-        category = cat.get('category', 'Other')
-        confidence = float(cat.get('confidence', 0.0))
-
-        # 2) Severity + reason (maps to Priority for UI)
-        sev = assess_severity(description, category)
-        severity = sev.get('severity', 'Medium')
-        reason = sev.get('reason', '')
-        priority_map = {
-            'Low': 'Low',
-            'Medium': 'Medium',
-            'High': 'High'
-        }
-        priority = priority_map.get(severity, 'Medium')
+        # Gemini circuit open: don't wait on it; backfill.py --needs-enrichment
+        # finishes the issue once the model is back
+        if not ai_available():
+            doc_ref.update({'needs_enrichment': True,
+                            'updated_at': firestore.SERVER_TIMESTAMP})
+            if not issue.get('category') and not issue.get('needs_enrichment'):
+                # Counted without a category until the next rollup rebuild
+                timeseries_service.record_issue(issue)
+            tile_service.on_issue_changed(issue_id, issue)
+            return jsonify({
+                'issue_id': issue_id,
+                'needs_enrichment': True,
+                'message': 'AI temporarily unavailable; issue queued for enrichment'
+            }), 202
+
+        # Load image (analysis-size variant when available)
+        with tracing.span('load_image'):
+            img = fetch_analysis_image(photo_url)
+
+        # 1) Category + confidence, 2) Severity + reason (maps to Priority for UI)
+        enriched = classify_and_prioritize(img, description)
+        category = enriched['category']
+        confidence = enriched['category_confidence']
+        priority = enriched['priority']
+        reason = enriched['ai_reason']
 
         # 3) Duplicate detection (100 meters radius)
-        nearby = get_nearby_documents('issues', float(lat), float(lng), 100.0,
-                                      lat_field='location.lat', lng_field='location.lon')
-        # Exclude itself
-        nearby = [d for d in nearby if d.get('id') != issue_id]
-        # Sort by distance for efficiency
-        nearby.sort(key=lambda x: x.get('_distance_km', 0))
-        # Prepare embedding for current description once
-        emb_main = get_text_embedding(description) or []
-
-        duplicate_of = None
-        best_score = 0.0
-        for candidate in nearby[:8]:  # cap to 8 closest
-            try:
-                # Text similarity
-                cand_desc = (candidate.get('description') or '')
-                emb_c = get_text_embedding(cand_desc) or []
-                text_sim = cosine_similarity(
-                    emb_main, emb_c) if emb_main and emb_c else 0.0
-
-                # Image similarity (optional, network-heavy)
-                cand_photo = candidate.get(
-                    'photoUrl') or candidate.get('photo_url')
-                img2 = None
-                if cand_photo:
-                    r2 = requests.get(cand_photo, timeout=10)
-                    img2 = Image.open(BytesIO(r2.content))
-                img_sim = image_similarity_score(
-                    img, img2) if img2 is not None else 0.0
-
-                score = (text_sim + img_sim) / 2.0
-                if score > 0.8 and score > best_score:
-                    best_score = score
-                    duplicate_of = candidate['id']
-            except Exception:
-                continue
+        # Prepare embedding for current description once (reuse a stored one)
+        emb_main = issue.get(EMBEDDING_FIELD) or get_text_embedding(description) or []
+        duplicate_of, best_score = find_duplicate(issue_id, issue, img, emb_main)
 
         # Update Firestore doc with AI fields
         update = {
-            'category': category,
-            'category_confidence': confidence,
-            'priority': priority,
-            'ai_reason': reason,
-            'updated_at': __import__('firebase_admin').firestore.SERVER_TIMESTAMP
+            **enriched,
+            'updated_at': firestore.SERVER_TIMESTAMP
         }
+        if issue.get('needs_enrichment'):
+            update['needs_enrichment'] = firestore.DELETE_FIELD
+        if emb_main and not issue.get(EMBEDDING_FIELD):
+            update[EMBEDDING_FIELD] = emb_main
         if duplicate_of:
             update['duplicate_of'] = duplicate_of
             update['duplicate_similarity'] = best_score
 
         doc_ref.update(update)
 
+        # Issues are written by the frontend directly; count them on first enrichment
+        if not issue.get('category') and not issue.get('needs_enrichment'):
+            timeseries_service.record_issue({**issue, 'category': category})
+        tile_service.on_issue_changed(issue_id, {**issue, 'category': category})
+
         return jsonify({
             'issue_id': issue_id,
             'category': category,
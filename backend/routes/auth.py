@@ -1,30 +1,48 @@
 """Authentication routes."""
 from flask import Blueprint, request, jsonify
 from services.firebase_service import verify_token, get_firestore
+from services.user_service import (
+    get_user_profile,
+    peek_user_profile,
+    invalidate_user,
+    role_from_claims,
+    touch_user
+)
 from functools import wraps
 
 auth_bp = Blueprint('auth', __name__)
 
 
-def token_required(f):
-    """Decorator to protect routes with token verification."""
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        token = request.headers.get('Authorization')
+def authenticate_request():
+    """Verify the request's bearer token.
+
+    Returns (decoded_token, None) on success or (None, error_response).
+    """
+    token = request.headers.get('Authorization')
 
-        if not token:
-            return jsonify({'error': 'No token provided'}), 401
+    if not token:
+        return None, (jsonify({'error': 'No token provided'}), 401)
+
+    # Remove 'Bearer ' prefix if present
+    if token.startswith('Bearer '):
+        token = token[7:]
+
+    decoded_token = verify_token(token)
+    if not decoded_token:
+        return None, (jsonify({'error': 'Invalid or expired token'}), 401)
 
-        # Remove 'Bearer ' prefix if present
-        if token.startswith('Bearer '):
-            token = token[7:]
+    # Add user info to request context
+    request.user = decoded_token
+    return decoded_token, None
 
-        decoded_token = verify_token(token)
-        if not decoded_token:
-            return jsonify({'error': 'Invalid or expired token'}), 401
 
-        # Add user info to request context
-        request.user = decoded_token
+def token_required(f):
+    """Decorator to protect routes with token verification."""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        _, error = authenticate_request()
+        if error:
+            return error
         return f(*args, **kwargs)
 
     return decorated
@@ -36,14 +54,20 @@ def admin_required(f):
     @token_required
     def decorated(*args, **kwargs):
         try:
-            db = get_firestore()
-            user_doc = db.collection('users').document(
-                request.user['uid']).get()
-
-            if not user_doc.exists:
+            uid = request.user['uid']
+            # A cached profile (kept current by the admin listener) wins over
+            # the token claim; the claim itself only counts for users the
+            # listener still reports as admins, so demotions apply at once.
+            found, user_data = peek_user_profile(uid)
+            if not found and role_from_claims(request.user) == 'admin':
+                user_data = {'uid': uid, 'email': request.user.get('email'),
+                             'role': 'admin'}
+            elif not found:
+                user_data = get_user_profile(uid)
+
+            if user_data is None:
                 return jsonify({'error': 'User not found'}), 404
 
-            user_data = user_doc.to_dict()
             if user_data.get('role') != 'admin':
                 return jsonify({'error': 'Admin access required'}), 403
 
@@ -67,31 +91,13 @@ def verify():
     if not decoded_token:
         return jsonify({'error': 'Invalid token'}), 401
 
-    # Ensure user profile exists in Firestore
+    # Ensure user profile exists; updates to existing users are write-behind
     try:
-        db = get_firestore()
         uid = decoded_token['uid']
         email = decoded_token.get('email')
         name = decoded_token.get('name') or (
             email.split('@')[0] if email else None)
-
-        user_ref = db.collection('users').document(uid)
-        user_doc = user_ref.get()
-        if not user_doc.exists:
-            user_ref.set({
-                'uid': uid,
-                'email': email,
-                'name': name,
-                'role': 'user',
-                'created_at': __import__('firebase_admin').firestore.SERVER_TIMESTAMP,
-                'updated_at': __import__('firebase_admin').firestore.SERVER_TIMESTAMP,
-            })
-        else:
-            user_ref.update({
-                'email': email,
-                'name': name,
-                'updated_at': __import__('firebase_admin').firestore.SERVER_TIMESTAMP,
-            })
+        touch_user(uid, email, name)
     except Exception as e:
         # Log but don't fail verify; profile endpoint can still read later
         print(f"User upsert error during verify: {str(e)}")
@@ -110,13 +116,11 @@ def verify():
 def get_profile():
     """Get user profile."""
     try:
-        db = get_firestore()
-        user_doc = db.collection('users').document(request.user['uid']).get()
+        user_data = get_user_profile(request.user['uid'])
 
-        if not user_doc.exists:
+        if user_data is None:
             return jsonify({'error': 'User not found'}), 404
 
-        user_data = user_doc.to_dict()
         return jsonify(user_data), 200
     except Exception as e:
         print(f"Profile error: {str(e)}")
@@ -139,6 +143,7 @@ def update_profile():
             data.pop(field, None)
 
         db.collection('users').document(request.user['uid']).update(data)
+        invalidate_user(request.user['uid'])
         return jsonify({'message': 'Profile updated successfully'}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -1,19 +1,102 @@
 """Complaints routes."""
-from flask import Blueprint, request, jsonify
-from routes.auth import token_required
-from services.firebase_service import get_firestore, get_storage
-from services.gemini_service import predict_issue_type, generate_summary_and_priority
+from flask import Blueprint, request, jsonify, current_app
+from routes.auth import token_required, authenticate_request
+from services.firebase_service import (
+    get_firestore, get_storage, bucket_health, upload_stream,
+    signed_upload_url, finalize_upload, delete_object, get_document
+)
+from services import timeseries_service, tile_service, upload_index, prefetch_service
+from services.admission import admit
+from services.idempotency import idempotent
+from services.serialization import negotiated
+from services.image_service import (
+    HashingReader, expected_derivatives, job_pool, upload_pool
+)
+from services.enrichment_service import (
+    fetch_analysis_image, predict_complaint_type, summarize_complaint
+)
+from services.gemini_service import ai_available
 from firebase_admin import firestore as fa_firestore
 from google.cloud.firestore import SERVER_TIMESTAMP
 from datetime import datetime
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.utils import secure_filename
 import traceback
-import requests
-from io import BytesIO
-from PIL import Image
+import uuid
 
 complaints_bp = Blueprint('complaints', __name__)
 
 
+def _object_path(user_id, original_name):
+    """Storage path for a new upload, always under complaints/{uid}/."""
+    timestamp = datetime.now().timestamp()
+    safe_name = secure_filename(original_name or '') or 'photo.jpg'
+    # The random part keeps same-second uploads of one filename from colliding
+    return f"complaints/{user_id}/{int(timestamp)}_{uuid.uuid4().hex[:8]}_{safe_name}"
+
+
+def _bucket_unavailable():
+    """503 response when the bucket is known to be missing, else None."""
+    health = bucket_health()
+    if health['exists'] is False:
+        # Return a clear, actionable error instead of a mysterious 500 from GCS
+        return jsonify({
+            'error': 'Firebase Storage bucket is not provisioned',
+            'bucket': getattr(get_storage(), 'name', None),
+            'hint': "Open Firebase Console → Build → Storage → 'Get started' to create the default bucket, then restart the backend.",
+        }), 503
+    return None
+
+
+def _store_upload(user_id, original_name, stream, content_type, size=None):
+    """Store one uploaded photo; returns the upload response payload.
+
+    Runs outside the request context too (batch uploads call it from a
+    thread pool), so it takes everything it needs as arguments.
+    """
+    # Generate unique filename
+    filename = _object_path(user_id, original_name)
+
+    # Hash the bytes as they stream out; nothing beyond one chunk is kept
+    hashed = HashingReader(stream)
+    stored = upload_stream(filename, hashed, content_type, size=size)
+    photo_url = stored['url']
+
+    # Index the hash now so re-uploads are caught at once; derivatives and
+    # the dHash are rendered in the background from the stored object, as
+    # for direct uploads. Their URLs are known already.
+    derivatives = expected_derivatives(photo_url)
+    existing = upload_index.lookup(hashed.sha256)
+    if existing is None and not upload_index.record(
+            hashed.sha256, hashed.md5, stored, derivatives, None, user_id):
+        # A concurrent upload of the same bytes may have been indexed first
+        existing = upload_index.lookup(hashed.sha256)
+    if existing and existing['path'] != filename:
+        # Identical bytes were stored before: keep one copy and reuse its results
+        delete_object(filename)
+        print(f"Duplicate upload: {filename} -> {existing['path']}")
+        if not (existing.get('ai') or {}).get('type'):
+            prefetch_service.start_prefetch(existing['path'], existing['url'],
+                                            existing['content_hash'])
+        return upload_index.duplicate_payload(existing, user_id)
+
+    job_pool().submit(upload_index.index_stored_object, filename, stored, user_id)
+    # Classify while the user is still typing the description
+    prefetch_service.start_prefetch(filename, photo_url, hashed.sha256)
+
+    print(f"Upload successful: {filename}")
+
+    return {
+        'success': True,
+        'photo_url': photo_url,
+        'filename': filename,
+        'derivatives': derivatives,
+        'derivatives_pending': True,
+        'content_hash': hashed.sha256,
+        'duplicate': False
+    }
+
+
 @complaints_bp.route('/upload', methods=['POST', 'OPTIONS'])
 def upload_image():
     """Upload image to Firebase Storage (avoids CORS issues)."""
@@ -21,93 +104,218 @@ def upload_image():
     if request.method == 'OPTIONS':
         return '', 204
 
-    # For POST request, require authentication
-    from routes.auth import verify_token
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or not auth_header.startswith('Bearer '):
-        return jsonify({'error': 'Authorization required'}), 401
-
-    token = auth_header.split(' ')[1]
-    decoded_token = verify_token(token)
-    if not decoded_token:
-        return jsonify({'error': 'Invalid token'}), 401
+    # For POST request, require authentication (shares the cached token path)
+    decoded_token, error = authenticate_request()
+    if error:
+        return error
 
     try:
-        print(f"Upload request received. Files: {request.files}")
-        print(f"Content-Type: {request.content_type}")
+        user_id = decoded_token['uid']
 
-        if 'image' not in request.files:
-            return jsonify({'error': 'No image file provided'}), 400
+        # Raw image bodies are streamed straight from the socket; multipart
+        # files are read from Werkzeug's spooled temp file. Either way the
+        # upload to Storage proceeds one resumable chunk at a time.
+        if request.mimetype and request.mimetype.startswith('image/'):
+            original_name = request.headers.get(
+                'X-Filename') or request.args.get('filename') or 'photo.jpg'
+            stream = request.stream
+            content_type = request.mimetype.lower()
+            size = request.content_length
+        else:
+            if 'image' not in request.files:
+                return jsonify({'error': 'No image file provided'}), 400
+
+            file = request.files['image']
+            if file.filename == '':
+                return jsonify({'error': 'No file selected'}), 400
+            original_name = file.filename
+            stream = file.stream
+            content_type = (file.mimetype or 'image/jpeg').lower()
+            size = None
+
+        # Same allowlist as /upload-batch and /upload-url: the object is served
+        # from a public URL with this type, so no SVG or other active content
+        allowed = current_app.config['UPLOAD_CONTENT_TYPES']
+        if content_type not in allowed:
+            return jsonify({'error': f'Unsupported content type (allowed: {", ".join(allowed)})'}), 415
+
+        # Bucket health is checked at startup and refreshed in the background
+        unavailable = _bucket_unavailable()
+        if unavailable:
+            return unavailable
+
+        return jsonify(_store_upload(user_id, original_name, stream, content_type, size)), 200
 
-        file = request.files['image']
-        if file.filename == '':
-            return jsonify({'error': 'No file selected'}), 400
+    except Exception as e:
+        print(f"Upload error: {str(e)}")
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
 
-        print(
-            f"File received: {file.filename}, Content-Type: {file.content_type}")
 
-        # Get user ID from token
-        user_id = decoded_token['uid']
+@complaints_bp.route('/upload-batch', methods=['POST'])
+@token_required
+def upload_images_batch():
+    """Upload several photos (multipart `images` fields) in one request.
 
-        # Generate unique filename
-        timestamp = datetime.now().timestamp()
-        file_extension = file.filename.split(
-            '.')[-1] if file.filename else 'jpg'
-        filename = f"complaints/{user_id}/{int(timestamp)}_{file.filename}"
+    Files are stored concurrently on a bounded pool; every file gets its
+    own result, so one bad file does not fail the batch.
+    """
+    try:
+        max_files = current_app.config['UPLOAD_BATCH_MAX_FILES']
+        max_bytes = current_app.config['UPLOAD_BATCH_MAX_BYTES']
+
+        # Reject oversized batches before Werkzeug spools the body to disk
+        if request.content_length and request.content_length > max_bytes:
+            return jsonify({'error': f'Batch exceeds {max_bytes} bytes'}), 413
+        # The app-wide MAX_CONTENT_LENGTH is sized for one photo; a batch
+        # gets its own cap (also enforced on bodies without Content-Length)
+        request.max_content_length = max_bytes
+
+        files = [f for f in request.files.getlist('images') + request.files.getlist('image')
+                 if f and f.filename]
+        if not files:
+            return jsonify({'error': 'No image files provided'}), 400
+        if len(files) > max_files:
+            return jsonify({'error': f'At most {max_files} files per batch'}), 400
+
+        allowed = current_app.config['UPLOAD_CONTENT_TYPES']
+        sizes = []
+        for f in files:
+            f.stream.seek(0, 2)
+            sizes.append(f.stream.tell())
+            f.stream.seek(0)
+        if sum(sizes) > max_bytes:
+            return jsonify({'error': f'Batch exceeds {max_bytes} bytes'}), 413
+
+        unavailable = _bucket_unavailable()
+        if unavailable:
+            return unavailable
 
-        # Upload to Firebase Storage
-        bucket = get_storage()
-        try:
-            print(f"Storage bucket resolved: {bucket.name}")
+        user_id = request.user['uid']
+        results = [None] * len(files)
+        futures = {}
+        for i, (f, size) in enumerate(zip(files, sizes)):
+            content_type = (f.content_type or 'image/jpeg').lower()
+            if content_type not in allowed:
+                results[i] = {'success': False, 'error': f'Unsupported content type {content_type}'}
+            elif size > current_app.config['UPLOAD_MAX_BYTES']:
+                results[i] = {'success': False, 'error': 'File too large'}
+            else:
+                futures[i] = upload_pool().submit(
+                    _store_upload, user_id, f.filename, f.stream, content_type, size)
+
+        for i, future in futures.items():
             try:
-                exists = bucket.exists()
-            except Exception:
-                exists = False
-            if not exists:
-                # Return a clear, actionable error instead of a mysterious 500 from GCS
-                return jsonify({
-                    'error': 'Firebase Storage bucket is not provisioned',
-                    'bucket': getattr(bucket, 'name', None),
-                    'hint': "Open Firebase Console → Build → Storage → 'Get started' to create the default bucket, then restart the backend.",
-                }), 503
-        except Exception:
-            pass
-        blob = bucket.blob(filename)
-
-        # Read file content
-        file_content = file.read()
-        content_type = file.content_type or 'image/jpeg'
-
-        print(
-            f"Uploading to Storage: {filename}, size: {len(file_content)} bytes")
-
-        blob.upload_from_string(
-            file_content,
-            content_type=content_type
-        )
-
-        # Make the blob publicly readable
-        blob.make_public()
-
-        # Get public URL
-        photo_url = blob.public_url
-
-        print(f"Upload successful! URL: {photo_url}")
+                results[i] = future.result()
+            except Exception as e:
+                print(f"Batch upload error ({files[i].filename}): {e}")
+                results[i] = {'success': False, 'error': str(e)}
+
+        for f, result in zip(files, results):
+            result['original_name'] = f.filename
+        uploaded = sum(1 for r in results if r.get('success'))
+        return jsonify({
+            'results': results,
+            'uploaded': uploaded,
+            'failed': len(results) - uploaded,
+            'total_bytes': sum(sizes)
+        }), 200
+
+    except RequestEntityTooLarge:
+        return jsonify({'error': f'Batch exceeds {max_bytes} bytes'}), 413
+    except Exception as e:
+        print(f"Batch upload error: {str(e)}")
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+
+@complaints_bp.route('/upload-url', methods=['POST'])
+@token_required
+def create_upload_url():
+    """Issue a short-lived signed URL so the client uploads straight to Storage."""
+    try:
+        data = request.get_json(silent=True) or {}
+        content_type = (data.get('content_type') or 'image/jpeg').lower()
+        allowed = current_app.config['UPLOAD_CONTENT_TYPES']
+        if content_type not in allowed:
+            return jsonify({'error': f'Unsupported content type (allowed: {", ".join(allowed)})'}), 400
+
+        max_bytes = current_app.config['UPLOAD_MAX_BYTES']
+        size = data.get('size')
+        if size is not None and (not isinstance(size, int) or size <= 0 or size > max_bytes):
+            return jsonify({'error': f'size must be between 1 and {max_bytes} bytes'}), 400
+
+        unavailable = _bucket_unavailable()
+        if unavailable:
+            return unavailable
+
+        path = _object_path(request.user['uid'], data.get('filename'))
+        return jsonify(signed_upload_url(path, content_type, max_bytes)), 200
+
+    except Exception as e:
+        print(f"Signed upload URL error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
+@complaints_bp.route('/upload-complete', methods=['POST'])
+@token_required
+def complete_upload():
+    """Validate a directly-uploaded object and start derivative processing."""
+    try:
+        data = request.get_json(silent=True) or {}
+        path = data.get('path') or ''
+        prefix = f"complaints/{request.user['uid']}/"
+        name = path[len(prefix):]
+        if not path.startswith(prefix) or not name or '/' in name or '__' in name:
+            return jsonify({'error': 'Invalid upload path'}), 400
+
+        stored = finalize_upload(path)
+        if stored is None:
+            return jsonify({'error': 'Uploaded object not found'}), 404
+
+        # GCS enforced these on PUT; re-check in case the URL was misused
+        allowed = current_app.config['UPLOAD_CONTENT_TYPES']
+        if stored['content_type'] not in allowed or \
+                not stored['size'] or stored['size'] > current_app.config['UPLOAD_MAX_BYTES']:
+            delete_object(path)
+            return jsonify({'error': 'Uploaded object failed validation'}), 400
+
+        # GCS reports the MD5 for free, which is enough to spot an exact re-upload
+        existing = upload_index.lookup_md5(stored['md5'])
+        if existing and existing['path'] != path:
+            delete_object(path)
+            if not (existing.get('ai') or {}).get('type'):
+                prefetch_service.start_prefetch(existing['path'], existing['url'],
+                                                existing['content_hash'])
+            return jsonify(upload_index.duplicate_payload(existing, request.user['uid'])), 200
+
+        # Classify while the user is still typing the description
+        prefetch_service.start_prefetch(path, stored['url'])
+
+        # Hashing, derivatives and indexing run in the background; the
+        # derivative URLs are known now
+        job_pool().submit(upload_index.index_stored_object, path, stored,
+                          request.user['uid'])
 
         return jsonify({
             'success': True,
-            'photo_url': photo_url,
-            'filename': filename
+            'photo_url': stored['url'],
+            'filename': path,
+            'derivatives': expected_derivatives(stored['url']),
+            'derivatives_pending': True,
+            'duplicate': False
         }), 200
 
     except Exception as e:
-        print(f"Upload error: {str(e)}")
+        print(f"Upload completion error: {str(e)}")
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
 
 @complaints_bp.route('/new', methods=['POST'])
 @token_required
+@idempotent('new_complaint')
+@admit('report', 'complaints-new')
 def create_new_complaint():
     """Create a new complaint with AI auto-tagging (Phase 3 endpoint)."""
     try:
@@ -129,70 +337,69 @@ def create_new_complaint():
         complaint_type = data.get('type', 'auto')
         description = data['description']
 
+        # Photos uploaded through this backend are indexed by content hash;
+        # AI results already computed for the same bytes are reused
+        indexed = upload_index.lookup_by_url(photo_url)
+        cached_ai = (indexed or {}).get('ai') or {}
+        computed_ai = {}
+
         # AI Analysis: Predict issue type from image if type is 'auto'
         ai_tags = []
         predicted_type = None
+        # AI steps skipped or failed; backfill.py --needs-enrichment redoes them
+        ai_pending = []
 
         if complaint_type == 'auto' or not complaint_type:
-            try:
-                # Download image for AI analysis
-                response = requests.get(photo_url, timeout=10)
-                img = Image.open(BytesIO(response.content))
-
-                # Predict type using Gemini
-                prediction = predict_issue_type(img)
-                if prediction.get('success'):
-                    predicted_type = prediction.get(
-                        'result', '').strip().lower()
-                    # Normalize to proper case
-                    type_mapping = {
-                        'pothole': 'Pothole',
-                        'streetlight': 'Street Light',
-                        'street light': 'Street Light',
-                        'garbage': 'Garbage',
-                        'drainage': 'Drainage',
-                        'water_supply': 'Water Supply',
-                        'road_damage': 'Road Damage',
-                        'graffiti': 'Graffiti',
-                        'road sign': 'Road Sign',
-                        'tree': 'Tree',
-                        'other': 'Other'
-                    }
-                    complaint_type = type_mapping.get(predicted_type, 'Other')
-                    ai_tags.append(predicted_type)
-                else:
-                    complaint_type = 'Other'
-            except Exception as e:
-                print(f"AI prediction error (non-critical): {str(e)}")
+            # Usually classified already: cached for these bytes, or
+            # prefetched right after upload (possibly still finishing)
+            prefetched = cached_ai if cached_ai.get('type') else \
+                prefetch_service.get_prediction(photo_url=photo_url)
+            if prefetched:
+                complaint_type = prefetched['type']
+                predicted_type = prefetched.get('predicted_type')
+                ai_tags = list(prefetched.get('ai_tags') or [])
+            elif not ai_available():
+                # Gemini circuit open: don't wait on it
                 complaint_type = 'Other'
+            else:
+                try:
+                    # Download image for AI analysis (analysis-size variant when available)
+                    img = fetch_analysis_image(photo_url, timeout=10)
+
+                    # Predict type using Gemini
+                    prediction = predict_complaint_type(img)
+                    complaint_type = prediction['type']
+                    predicted_type = prediction['predicted_type']
+                    ai_tags = prediction['ai_tags']
+                    if predicted_type:
+                        computed_ai.update(prediction)
+                except Exception as e:
+                    print(f"AI prediction error (non-critical): {str(e)}")
+                    complaint_type = 'Other'
+            if not predicted_type:
+                ai_pending.append('type')
 
-        # AI Summary and Priority
+        # AI Summary and Priority (reused only for the same description and type)
         priority = 'Normal'
         ai_summary = None
-        try:
-            summary_result = generate_summary_and_priority(
-                description, complaint_type)
-            if summary_result.get('success'):
-                result_text = summary_result.get('result', '')
-                # Parse the result
-                if 'PRIORITY:' in result_text:
-                    priority_line = [line for line in result_text.split(
-                        '\n') if 'PRIORITY:' in line][0]
-                    priority_val = priority_line.split(
-                        ':')[1].strip().split()[0].lower()
-                    priority_mapping = {
-                        'low': 'Low',
-                        'medium': 'Normal',
-                        'normal': 'Normal',
-                        'high': 'High',
-                        'critical': 'Critical'
-                    }
-                    priority = priority_mapping.get(priority_val, 'Normal')
-                if 'SUMMARY:' in result_text:
-                    ai_summary = [line for line in result_text.split(
-                        '\n') if 'SUMMARY:' in line][0].split(':')[1].strip()
-        except Exception as e:
-            print(f"AI summary error (non-critical): {str(e)}")
+        description_hash = upload_index.description_hash(description)
+        if cached_ai.get('description_hash') == description_hash and \
+                cached_ai.get('summary_type') == complaint_type:
+            priority = cached_ai.get('priority', 'Normal')
+            ai_summary = cached_ai.get('ai_summary')
+        elif ai_available():
+            try:
+                summary = summarize_complaint(description, complaint_type)
+                priority = summary['priority']
+                ai_summary = summary['ai_summary']
+                if ai_summary:
+                    computed_ai.update(summary, description_hash=description_hash,
+                                       summary_type=complaint_type)
+            except Exception as e:
+                print(f"AI summary error (non-critical): {str(e)}")
+        if not ai_summary:
+            # 'priority': the Normal placeholder may be replaced until an admin sets one
+            ai_pending.extend(['summary', 'priority'])
 
         # Create complaint document
         db = get_firestore()
@@ -214,17 +421,45 @@ def create_new_complaint():
             'created_at': SERVER_TIMESTAMP,
             'updated_at': SERVER_TIMESTAMP
         }
+        if ai_pending:
+            complaint_data['needs_enrichment'] = True
+            complaint_data['ai_pending'] = ai_pending
+        possible_duplicate_of = []
+        own_duplicates = []
+        if indexed:
+            # Near-identical photos (re-encoded, resized) too, once the
+            # background job has computed this one's dHash
+            for entry in [indexed] + upload_index.similar(indexed.get('phash'),
+                                                          exclude=indexed['content_hash']):
+                possible_duplicate_of += [c for c in entry.get('complaint_ids', [])
+                                          if c not in possible_duplicate_of]
+                own_duplicates += [c for c in upload_index.own_complaints(entry, user_id)
+                                   if c not in own_duplicates]
+            complaint_data['content_hash'] = indexed['content_hash']
+            if possible_duplicate_of:
+                complaint_data['possible_duplicate_of'] = possible_duplicate_of
 
         # Add to Firestore
         complaint_ref = db.collection('complaints').document()
         complaint_ref.set(complaint_data)
+        timeseries_service.record_issue(complaint_data)
+        tile_service.on_issue_changed(complaint_ref.id, complaint_data)
+        if indexed:
+            upload_index.remember_ai(indexed['content_hash'],
+                                     computed_ai or None,
+                                     complaint_ref.id, user_id)
+        prefetch_service.discard(photo_url=photo_url)
 
         return jsonify({
             'message': 'Complaint created successfully',
             'complaint_id': complaint_ref.id,
             'predicted_type': predicted_type,
             'ai_tags': ai_tags,
-            'priority': priority
+            'priority': priority,
+            # Only the reporter's own earlier complaints; the full list is
+            # stored for admins
+            'possible_duplicate_of': own_duplicates,
+            'needs_enrichment': bool(ai_pending)
         }), 201
 
     except Exception as e:
@@ -260,7 +495,30 @@ def get_complaints():
             complaint['id'] = doc.id
             complaints.append(complaint)
 
-        return jsonify(complaints), 200
+        return negotiated(complaints), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@complaints_bp.route('/tiles/<int:z>/<int:x>/<int:y>', methods=['GET'])
+def get_complaint_tile(z, x, y):
+    """Clustered issue counts for one slippy-map tile (public).
+
+    Query params: status, type, mode (clusters|heat).
+    """
+    try:
+        mode = request.args.get('mode', 'clusters')
+        if mode not in ('clusters', 'heat'):
+            return jsonify({'error': 'mode must be clusters or heat'}), 400
+        tile = tile_service.get_tile(z, x, y,
+                                     status=request.args.get('status'),
+                                     itype=request.args.get('type'),
+                                     mode=mode)
+        response = jsonify(tile)
+        response.headers['Cache-Control'] = 'public, max-age=30'
+        return response, 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -269,14 +527,12 @@ def get_complaints():
 def get_complaint(complaint_id):
     """Get single complaint by ID."""
     try:
-        db = get_firestore()
-        doc = db.collection('complaints').document(complaint_id).get()
+        complaint = get_document('complaints', complaint_id)
 
-        if not doc.exists:
+        if complaint is None:
             return jsonify({'error': 'Complaint not found'}), 404
 
-        complaint = doc.to_dict()
-        complaint['id'] = doc.id
+        complaint['id'] = complaint_id
 
         return jsonify(complaint), 200
     except Exception as e:
@@ -316,6 +572,8 @@ def create_complaint():
         # Add to Firestore
         doc_ref = db.collection('complaints').add(complaint_data)
         complaint_id = doc_ref[1].id
+        timeseries_service.record_issue(complaint_data)
+        tile_service.on_issue_changed(complaint_id, complaint_data)
 
         return jsonify({
             'message': 'Complaint created successfully',
@@ -341,6 +599,6 @@ def get_user_complaints():
             complaint['id'] = doc.id
             complaints.append(complaint)
 
-        return jsonify(complaints), 200
+        return negotiated(complaints), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -0,0 +1,48 @@
+"""Standalone scheduler for coordinated background jobs.
+
+Runs the weekly summary and executes manually queued runs outside the web
+workers. Set RUN_SCHEDULER_IN_WEB=False for the web workers when using it.
+Several instances may run; the Firestore lease in
+services/scheduler_service.py still executes each run once.
+
+Usage:
+    python scheduler.py                       # run until interrupted
+    python scheduler.py --run weekly_summary  # run one job now and exit
+"""
+from config import Config
+import argparse
+import sys
+
+
+def main(argv=None):
+    from services import scheduler_service
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--run', choices=sorted(scheduler_service.JOBS),
+                        help='run this job once (ignoring its schedule) and exit')
+    args = parser.parse_args(argv)
+
+    from services.firebase_service import initialize_firebase
+    initialize_firebase(Config.FIREBASE_CREDENTIALS_PATH)
+
+    if args.run:
+        run_id = scheduler_service.run_job(args.run, trigger='cli', force=True)
+        if run_id is None:
+            print(f"[scheduler] {args.run} is already running elsewhere")
+            return 1
+        run = scheduler_service.get_run(run_id) or {}
+        print(f"[scheduler] {args.run} {run.get('status')} in {run.get('duration_ms')} ms (run {run_id})")
+        return 0 if run.get('status') == 'succeeded' else 1
+
+    from apscheduler.schedulers.blocking import BlockingScheduler
+    scheduler = BlockingScheduler(timezone='UTC')
+    scheduler_service.register_jobs(scheduler)
+    print(f"[scheduler] started as {scheduler_service.worker_id()}; jobs: {', '.join(scheduler_service.JOBS)}")
+    try:
+        scheduler.start()
+    except (KeyboardInterrupt, SystemExit):
+        print("[scheduler] stopped")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,392 @@
+"""Admission control for the AI endpoints.
+
+Two checks run before a view does any Gemini work:
+
+- Token buckets per route class ('ai', 'chatbot', 'report'), one per user
+  and one per client IP (ADMISSION_USER_RATES / ADMISSION_IP_RATES, e.g.
+  `ai=30/60` = bursts of 30, refilled at 30 per minute). Both buckets are
+  checked before either is spent, so a request refused by one costs nothing
+  from the other. An empty bucket answers 429 with Retry-After set to when
+  the next token arrives.
+- A process-wide cap on concurrent AI requests (AI_MAX_CONCURRENCY), with
+  per-route sub-limits inside it (AI_ROUTE_CONCURRENCY, e.g. `insights=2`).
+  Up to AI_MAX_QUEUE further requests wait, for at most
+  AI_QUEUE_WAIT_SECONDS. Requests beyond that get an immediate 503 with
+  Retry-After.
+
+Buckets live in memory by default. With several instances, set
+ADMISSION_STORE=firestore so all instances share them, or pass any object
+with a `take(buckets)` method to `set_store`. The concurrency cap always
+stays per process, since it protects that process's threads.
+
+Flask views use the `admit(route_class, route)` decorator (below
+`token_required`, so the user is known); asgi.py calls `check_rates` and
+`gate` directly. When asgi.py already holds a gate slot for a Flask view it
+says so in the WSGI environ (SLOT_HELD_ENVIRON) and the decorator only
+checks the rates.
+"""
+from collections import OrderedDict, deque
+from config import Config
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+from typing import Any, Dict, List, Optional, Tuple
+from flask import jsonify, request
+import asyncio
+import math
+import threading
+import time
+
+from services import metrics
+
+RATE_LIMITS_COLLECTION = 'rate_limits'
+
+# WSGI environ key set by asgi.py when it has taken the gate slot itself
+SLOT_HELD_ENVIRON = 'cityfix.admission_slot'
+
+REJECTED = metrics.counter('cityfix_admission_rejected_total',
+                           'Requests refused by admission control',
+                           ('route_class', 'reason'))
+
+
+class Rejected(Exception):
+    """Refused admission; carries the HTTP status, body and Retry-After."""
+
+    def __init__(self, status: int, error: str, retry_after: float, **details):
+        super().__init__(error)
+        self.status = status
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.payload = {'error': error, 'retry_after': self.retry_after, **details}
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        return {'Retry-After': str(self.retry_after)}
+
+
+def parse_rates(spec: str) -> Dict[str, Tuple[int, float]]:
+    """'ai=30/60,chatbot=20/60' -> {'ai': (30, 60.0), 'chatbot': (20, 60.0)}."""
+    rates = {}
+    for item in (spec or '').split(','):
+        name, _, value = item.partition('=')
+        if not name.strip() or not value.strip():
+            continue
+        count, _, period = value.partition('/')
+        rates[name.strip()] = (int(count), float(period or 60))
+    return rates
+
+
+def parse_limits(spec: str) -> Dict[str, int]:
+    """'predict-type=8,chatbot=16' -> {'predict-type': 8, 'chatbot': 16}."""
+    limits = {}
+    for item in (spec or '').split(','):
+        name, _, value = item.partition('=')
+        if name.strip() and value.strip():
+            limits[name.strip()] = int(value)
+    return limits
+
+
+# --------------------- Token bucket stores ---------------------
+
+def _refill(tokens: float, updated: float, now: float, capacity: int, period: float) -> float:
+    return min(capacity, tokens + (now - updated) * capacity / period)
+
+
+def _spend(levels: List[float], buckets) -> Tuple[List[float], List[float]]:
+    """Take one token from every bucket, or none if any is short.
+
+    Returns the new levels and, per bucket, seconds until it has a token.
+    """
+    waits = [0.0 if tokens >= 1 else (1 - tokens) * period / capacity
+             for tokens, (_, capacity, period) in zip(levels, buckets)]
+    if not any(waits):
+        levels = [tokens - 1 for tokens in levels]
+    return levels, waits
+
+
+class MemoryStore:
+    """Buckets in this process, least recently used evicted past max_keys."""
+    remote = False
+
+    def __init__(self, max_keys: int = 10000):
+        self.max_keys = max_keys
+        self._buckets: 'OrderedDict[str, Tuple[float, float]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, buckets: List[Tuple[str, int, float]]) -> List[float]:
+        """Spend one token from each (key, capacity, period) bucket, all or nothing.
+
+        Returns the wait per bucket; all zeros means the tokens were spent.
+        """
+        now = time.monotonic()
+        with self._lock:
+            levels = []
+            for key, capacity, period in buckets:
+                tokens, updated = self._buckets.pop(key, (capacity, now))
+                levels.append(_refill(tokens, updated, now, capacity, period))
+            levels, waits = _spend(levels, buckets)
+            for tokens, (key, _, _) in zip(levels, buckets):
+                self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return waits
+
+
+class FirestoreStore:
+    """Buckets shared by all instances, one `rate_limits` document per key."""
+    remote = True
+
+    def take(self, buckets: List[Tuple[str, int, float]]) -> List[float]:
+        from firebase_admin import firestore
+        from services.firebase_service import get_firestore
+        db = get_firestore()
+        refs = [db.collection(RATE_LIMITS_COLLECTION).document(key.replace('/', '_'))
+                for key, _, _ in buckets]
+
+        @firestore.transactional
+        def take(transaction):
+            # All reads before any write, as Firestore transactions require
+            snaps = [ref.get(transaction=transaction) for ref in refs]
+            now = time.time()
+            levels = []
+            for snap, (_, capacity, period) in zip(snaps, buckets):
+                state = (snap.to_dict() or {}) if snap.exists else {}
+                levels.append(_refill(state.get('tokens', capacity), state.get('updated', now),
+                                      now, capacity, period))
+            levels, waits = _spend(levels, buckets)
+            for ref, tokens, (_, _, period) in zip(refs, levels, buckets):
+                # expires_at lets a Firestore TTL policy clean up idle buckets
+                transaction.set(ref, {'tokens': tokens, 'updated': now,
+                                      'expires_at': datetime.now(timezone.utc) + timedelta(seconds=period)})
+            return waits
+
+        return take(db.transaction())
+
+
+_store = None
+
+
+def set_store(store):
+    global _store
+    _store = store
+
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = FirestoreStore() if Config.ADMISSION_STORE == 'firestore' else MemoryStore()
+    return _store
+
+
+_user_rates = parse_rates(Config.ADMISSION_USER_RATES)
+_ip_rates = parse_rates(Config.ADMISSION_IP_RATES)
+
+
+def check_rates(route_class: str, uid: Optional[str], ip: Optional[str]):
+    """Spend a token from the user's and the IP's bucket; raises Rejected (429).
+
+    Neither bucket is charged unless both have a token.
+    """
+    buckets, scopes = [], []
+    for scope, key, rates in (('user', uid, _user_rates), ('ip', ip, _ip_rates)):
+        if not key or route_class not in rates:
+            continue
+        capacity, period = rates[route_class]
+        buckets.append((f'{route_class}:{scope}:{key}', capacity, period))
+        scopes.append(scope)
+    if not buckets:
+        return
+    try:
+        waits = get_store().take(buckets)
+    except Exception as e:
+        # Fail open: a store outage must not take the AI routes down
+        print(f"Admission store error: {e}")
+        return
+    for scope, wait in zip(scopes, waits):
+        if wait > 0:
+            REJECTED.inc(route_class, f'{scope}_rate')
+            raise Rejected(429, 'Rate limit exceeded, retry later', wait,
+                           route_class=route_class, scope=scope)
+
+
+def client_ip(remote_addr: Optional[str], forwarded_for: Optional[str] = None) -> Optional[str]:
+    """Client address, trusting TRUST_PROXY_HOPS entries of X-Forwarded-For."""
+    hops = Config.TRUST_PROXY_HOPS
+    if hops and forwarded_for:
+        chain = [part.strip() for part in forwarded_for.split(',') if part.strip()]
+        if len(chain) >= hops:
+            return chain[-hops]
+    return remote_addr
+
+
+# --------------------- Concurrency gate ---------------------
+
+class _Waiter:
+    __slots__ = ('route', 'granted', 'event', 'loop', 'future')
+
+    def __init__(self, route: Optional[str], loop=None):
+        self.route = route
+        self.granted = False
+        self.loop = loop
+        self.event = None if loop else threading.Event()
+        self.future = loop.create_future() if loop else None
+
+    def wake(self):
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(
+                lambda: self.future.done() or self.future.set_result(None))
+
+
+class ConcurrencyGate:
+    """At most `limit` holders; up to `max_waiting` more wait FIFO for `timeout`.
+
+    `route_limits` caps individual routes inside the overall limit, so one
+    slow route cannot take every slot. Threads and coroutines share one gate:
+    Flask views block in `acquire`, asgi.py awaits `acquire_async`.
+    """
+
+    def __init__(self, limit: int, max_waiting: int, timeout: float,
+                 route_limits: Optional[Dict[str, int]] = None):
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.route_limits = dict(route_limits or {})
+        self.active = 0
+        self.rejected = 0
+        self.route_active = {name: 0 for name in self.route_limits}
+        self.route_rejected = {name: 0 for name in self.route_limits}
+        self._waiters: deque = deque()
+        self._lock = threading.Lock()
+
+    def _has_room(self, route: Optional[str]) -> bool:
+        if self.active >= self.limit:
+            return False
+        return route not in self.route_limits or self.route_active[route] < self.route_limits[route]
+
+    def _take(self, route: Optional[str]):
+        self.active += 1
+        if route in self.route_active:
+            self.route_active[route] += 1
+
+    def _reject(self, route_class: str, route: Optional[str], reason: str) -> Rejected:
+        self.rejected += 1
+        if route in self.route_rejected:
+            self.route_rejected[route] += 1
+        REJECTED.inc(route_class, reason)
+        details = {'route': route} if route else {}
+        return Rejected(503, 'AI capacity exhausted, retry shortly', self.timeout,
+                        route_class=route_class, **details)
+
+    def _enter(self, route_class: str, route: Optional[str], loop=None) -> Optional[_Waiter]:
+        with self._lock:
+            # Freed slots go straight to the first waiter that fits, so room
+            # here means no queued request could have used it
+            if self._has_room(route):
+                self._take(route)
+                return None
+            if len(self._waiters) >= self.max_waiting:
+                raise self._reject(route_class, route, 'queue_full')
+            waiter = _Waiter(route, loop)
+            self._waiters.append(waiter)
+            return waiter
+
+    def _gave_up(self, waiter: _Waiter, route_class: str):
+        with self._lock:
+            if waiter.granted:
+                return  # the slot arrived just as we timed out; keep it
+            self._waiters.remove(waiter)
+            raise self._reject(route_class, waiter.route, 'queue_timeout')
+
+    def acquire(self, route_class: str = 'ai', route: Optional[str] = None):
+        waiter = self._enter(route_class, route)
+        if waiter is not None and not waiter.event.wait(self.timeout):
+            self._gave_up(waiter, route_class)
+
+    async def acquire_async(self, route_class: str = 'ai', route: Optional[str] = None):
+        waiter = self._enter(route_class, route, asyncio.get_running_loop())
+        if waiter is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.timeout)
+        except asyncio.TimeoutError:
+            self._gave_up(waiter, route_class)
+        except asyncio.CancelledError:
+            # Client went away while queued: don't leak a slot handed to us
+            with self._lock:
+                granted = waiter.granted
+                if not granted:
+                    self._waiters.remove(waiter)
+            if granted:
+                self.release(route)
+            raise
+
+    def release(self, route: Optional[str] = None):
+        with self._lock:
+            self.active -= 1
+            if route in self.route_active:
+                self.route_active[route] -= 1
+            # Hand the slot to the oldest waiter whose route has room
+            for waiter in self._waiters:
+                if self._has_room(waiter.route):
+                    self._waiters.remove(waiter)
+                    self._take(waiter.route)
+                    waiter.granted = True
+                    waiter.wake()
+                    break
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            routes = {name: {'limit': limit, 'active': self.route_active[name],
+                             'waiting': sum(1 for w in self._waiters if w.route == name),
+                             'rejected': self.route_rejected[name]}
+                      for name, limit in self.route_limits.items()}
+            return {'limit': self.limit, 'active': self.active,
+                    'waiting': len(self._waiters), 'rejected': self.rejected,
+                    'routes': routes}
+
+
+gate = ConcurrencyGate(Config.AI_MAX_CONCURRENCY, Config.AI_MAX_QUEUE,
+                       Config.AI_QUEUE_WAIT_SECONDS, parse_limits(Config.AI_ROUTE_CONCURRENCY))
+
+
+def _gate_samples():
+    stats = gate.stats()
+    yield ('cityfix_ai_active', 'gauge', 'AI requests holding a concurrency slot', {}, stats['active'])
+    yield ('cityfix_ai_waiting', 'gauge', 'AI requests queued for a concurrency slot', {}, stats['waiting'])
+    for route, route_stats in stats['routes'].items():
+        labels = {'route': route}
+        yield ('cityfix_ai_route_active', 'gauge', 'AI route requests holding a slot',
+               labels, route_stats['active'])
+        yield ('cityfix_ai_route_waiting', 'gauge', 'AI route requests queued for a slot',
+               labels, route_stats['waiting'])
+
+
+metrics.register_collector('admission', _gate_samples)
+
+
+def admit(route_class: str, route: Optional[str] = None):
+    """Decorator for Flask AI views: rate-limit, then hold a gate slot while running.
+
+    `route` names the view's sub-limit in AI_ROUTE_CONCURRENCY.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if not Config.ADMISSION_ENABLED:
+                return f(*args, **kwargs)
+            user = getattr(request, 'user', None) or {}
+            held = request.environ.get(SLOT_HELD_ENVIRON)
+            try:
+                check_rates(route_class, user.get('uid'),
+                            client_ip(request.remote_addr, request.headers.get('X-Forwarded-For')))
+                if not held:
+                    gate.acquire(route_class, route)
+            except Rejected as e:
+                return jsonify(e.payload), e.status, e.headers
+            try:
+                return f(*args, **kwargs)
+            finally:
+                if not held:
+                    gate.release(route)
+        return decorated
+    return decorator
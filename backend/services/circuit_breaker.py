@@ -0,0 +1,179 @@
+"""Circuit breaker for slow or failing dependencies (used around Gemini).
+
+The breaker watches the last `window` calls. Once at least `min_calls` are
+recorded and the share of failures reaches `failure_rate`, or the share of
+calls slower than `slow_seconds` reaches `slow_rate`, it opens. While open,
+calls fail immediately with CircuitOpenError instead of waiting for a
+network timeout. After `open_seconds` it goes half-open and lets one probe
+call through at a time: a fast success closes it again, anything else
+re-opens it.
+
+    with breaker.guard():
+        response = model.generate_content(prompt)
+
+`guard()` works around `await` too, so sync and async callers share one
+breaker. State is per process.
+"""
+from collections import deque
+from typing import Any, Dict, Optional, Tuple, Type
+import threading
+import time
+
+from services import metrics
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+REJECTED = metrics.counter('cityfix_circuit_breaker_rejected_total',
+                           'Calls failed fast by an open circuit breaker', ('breaker',))
+TRANSITIONS = metrics.counter('cityfix_circuit_breaker_transitions_total',
+                              'Circuit breaker state changes', ('breaker', 'state'))
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, *, window: int = 20, min_calls: int = 5,
+                 failure_rate: float = 0.5, slow_seconds: float = 15.0,
+                 slow_rate: float = 0.8, open_seconds: float = 30.0,
+                 ignore: Tuple[Type[BaseException], ...] = ()):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_seconds = slow_seconds
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        # Errors caused by the request itself, not by the dependency
+        self.ignore = ignore
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.last_error = None
+        self._calls: deque = deque(maxlen=window)   # (failed, slow)
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _set_state(self, state: str):
+        if state == self.state:
+            return
+        self.state = state
+        TRANSITIONS.inc(self.name, state)
+        if state == OPEN:
+            self.opened_at = time.monotonic()
+            self._probing = False
+            print(f"Circuit breaker '{self.name}' opened: {self.last_error}")
+        elif state == CLOSED:
+            self._calls.clear()
+            print(f"Circuit breaker '{self.name}' closed")
+
+    def _current_state(self) -> str:
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.open_seconds:
+            self._set_state(HALF_OPEN)
+        return self.state
+
+    def available(self) -> bool:
+        """Whether a call now would be attempted (doesn't reserve the probe)."""
+        with self._lock:
+            state = self._current_state()
+            return state == CLOSED or (state == HALF_OPEN and not self._probing)
+
+    def before_call(self) -> bool:
+        """Admit a call (reserving the half-open probe), or raise CircuitOpenError."""
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return False
+            if state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+        REJECTED.inc(self.name)
+        raise CircuitOpenError(f"{self.name} unavailable (circuit open)")
+
+    def after_call(self, probe: bool, seconds: float, error: Optional[BaseException] = None):
+        if error is not None and not isinstance(error, Exception):
+            # Cancelled or interrupted: says nothing about the dependency
+            if probe:
+                with self._lock:
+                    self._probing = False
+            return
+        failed = error is not None and not isinstance(error, self.ignore)
+        slow = seconds >= self.slow_seconds
+        with self._lock:
+            if failed:
+                self.last_error = f"{type(error).__name__}: {error}"
+            if probe:
+                self._probing = False
+                if self.state == HALF_OPEN:
+                    self._set_state(OPEN if failed or slow else CLOSED)
+                return
+            if self.state != CLOSED:
+                return
+            self._calls.append((failed, slow))
+            calls = len(self._calls)
+            if calls < self.min_calls:
+                return
+            failures = sum(1 for f, _ in self._calls if f)
+            slows = sum(1 for _, s in self._calls if s)
+            if failures / calls >= self.failure_rate:
+                self._set_state(OPEN)
+            elif slows / calls >= self.slow_rate:
+                self.last_error = f"{slows}/{calls} calls slower than {self.slow_seconds:g}s"
+                self._set_state(OPEN)
+
+    def guard(self) -> '_Guard':
+        return _Guard(self)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            state = self._current_state()
+            calls = len(self._calls)
+            snap = {
+                'state': state,
+                'recent_calls': calls,
+                'recent_failures': sum(1 for f, _ in self._calls if f),
+                'recent_slow': sum(1 for _, s in self._calls if s),
+                'last_error': self.last_error,
+            }
+            if state == OPEN:
+                snap['retry_in_seconds'] = round(
+                    max(0.0, self.open_seconds - (time.monotonic() - self.opened_at)), 1)
+            return snap
+
+
+class _Guard:
+    __slots__ = ('breaker', 'probe', 'start')
+
+    def __init__(self, breaker: CircuitBreaker):
+        self.breaker = breaker
+
+    def __enter__(self):
+        self.probe = self.breaker.before_call()
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.breaker.after_call(self.probe, time.monotonic() - self.start, exc)
+        return False
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def register(breaker: CircuitBreaker) -> CircuitBreaker:
+    _breakers[breaker.name] = breaker
+    return breaker
+
+
+def states() -> Dict[str, Dict[str, Any]]:
+    return {name: breaker.snapshot() for name, breaker in _breakers.items()}
+
+
+def _samples():
+    for name, snap in states().items():
+        yield ('cityfix_circuit_breaker_state', 'gauge',
+               'Circuit breaker state (0 closed, 1 half-open, 2 open)',
+               {'breaker': name}, _STATE_VALUES[snap['state']])
+
+
+metrics.register_collector('circuit_breakers', _samples)
@@ -0,0 +1,295 @@
+"""Shared AI enrichment for `issues` and `complaints` documents.
+
+Both the post-create `/api/ai/process-issue` route and the offline backfill
+CLI use these helpers, so a document enriched either way carries the same
+fields: category, category_confidence, priority, ai_reason,
+description_embedding and, for issues, duplicate_of/duplicate_similarity.
+"""
+from services.gemini_service import (
+    classify_issue, assess_severity, get_text_embedding,
+    predict_issue_type, generate_summary_and_priority, ai_available,
+    cosine_similarity, image_similarity_score
+)
+from services import metrics, tracing
+from typing import Any, Dict, List, Optional, Tuple
+from io import BytesIO
+from PIL import Image
+import requests
+
+
+EMBEDDING_FIELD = 'description_embedding'
+
+# What duplicate scoring reads from each nearby issue
+DUPLICATE_FIELDS = ['description', EMBEDDING_FIELD, 'photoUrl', 'photo_url']
+
+PRIORITY_MAP = {
+    'Low': 'Low',
+    'Medium': 'Medium',
+    'High': 'High'
+}
+
+# Labels returned by predict_issue_type -> complaint `type`
+COMPLAINT_TYPE_MAP = {
+    'pothole': 'Pothole',
+    'streetlight': 'Street Light',
+    'street light': 'Street Light',
+    'garbage': 'Garbage',
+    'drainage': 'Drainage',
+    'water_supply': 'Water Supply',
+    'road_damage': 'Road Damage',
+    'graffiti': 'Graffiti',
+    'road sign': 'Road Sign',
+    'tree': 'Tree',
+    'other': 'Other'
+}
+
+# Priority words in generate_summary_and_priority output -> complaint `priority`
+COMPLAINT_PRIORITY_MAP = {
+    'low': 'Low',
+    'medium': 'Normal',
+    'normal': 'Normal',
+    'high': 'High',
+    'critical': 'Critical'
+}
+
+
+def fetch_image(url: str, timeout: float = 15):
+    """Download an image and open it with Pillow."""
+    with metrics.timer('image_fetch', 'get'):
+        resp = requests.get(url, timeout=timeout)
+        resp.raise_for_status()
+    return Image.open(BytesIO(resp.content))
+
+
+def fetch_analysis_image(url: str, timeout: float = 15):
+    """Prefer the pre-rendered analysis-size derivative, fall back to the original."""
+    from services.image_service import derivative_url
+    small = derivative_url(url, 'analysis')
+    if small:
+        try:
+            return fetch_image(small, timeout=timeout)
+        except Exception:
+            pass
+    return fetch_image(url, timeout=timeout)
+
+
+def predict_complaint_type(img) -> Dict[str, Any]:
+    """Image-only type prediction for the complaint form.
+
+    Returns {'type', 'predicted_type', 'ai_tags'}; 'Other' when Gemini fails.
+    """
+    return complaint_type_from(predict_issue_type(img))
+
+
+def complaint_type_from(prediction: Dict[str, Any]) -> Dict[str, Any]:
+    """Map a predict_issue_type(_async) result to complaint type fields."""
+    if not prediction.get('success'):
+        return {'type': 'Other', 'predicted_type': None, 'ai_tags': []}
+    predicted_type = prediction.get('result', '').strip().lower()
+    return {
+        'type': COMPLAINT_TYPE_MAP.get(predicted_type, 'Other'),
+        'predicted_type': predicted_type,
+        'ai_tags': [predicted_type],
+    }
+
+
+def summarize_complaint(description: str, complaint_type: str) -> Dict[str, Any]:
+    """Summary + priority for a complaint; {'priority': 'Normal', 'ai_summary': None} on failure."""
+    priority = 'Normal'
+    ai_summary = None
+    summary_result = generate_summary_and_priority(description, complaint_type)
+    if summary_result.get('success'):
+        result_text = summary_result.get('result', '')
+        # Parse the result
+        if 'PRIORITY:' in result_text:
+            priority_line = [line for line in result_text.split(
+                '\n') if 'PRIORITY:' in line][0]
+            priority_val = priority_line.split(
+                ':')[1].strip().split()[0].lower()
+            priority = COMPLAINT_PRIORITY_MAP.get(priority_val, 'Normal')
+        if 'SUMMARY:' in result_text:
+            ai_summary = [line for line in result_text.split(
+                '\n') if 'SUMMARY:' in line][0].split(':')[1].strip()
+    return {'priority': priority, 'ai_summary': ai_summary}
+
+
+def photo_url_of(data: Dict[str, Any]) -> Optional[str]:
+    return data.get('photoUrl') or data.get('photo_url')
+
+
+def missing_fields(data: Dict[str, Any]) -> List[str]:
+    """Which enrichment outputs a document is still missing."""
+    missing = []
+    if not data.get('category'):
+        missing.append('category')
+    if not data.get('priority'):
+        missing.append('priority')
+    if data.get('description') and not data.get(EMBEDDING_FIELD):
+        missing.append('embedding')
+    return missing
+
+
+def classify_and_prioritize(img, description: str) -> Dict[str, Any]:
+    """Category + confidence from image/text, then severity mapped to priority."""
+    cat = classify_issue(img, description)
+    category = cat.get('category', 'Other')
+    confidence = float(cat.get('confidence', 0.0))
+
+    sev = assess_severity(description, category)
+    severity = sev.get('severity', 'Medium')
+    return {
+        'category': category,
+        'category_confidence': confidence,
+        'priority': PRIORITY_MAP.get(severity, 'Medium'),
+        'ai_reason': sev.get('reason', ''),
+    }
+
+
+def find_duplicate(issue_id: str, issue: Dict[str, Any], img,
+                   embedding: List[float]) -> Tuple[Optional[str], float]:
+    """Closest issue within 100 m that reports the same problem.
+
+    Scores the 8 nearest issues by description embedding and photo
+    similarity. Returns (id, score) for the best score above 0.8, else
+    (None, 0.0).
+    """
+    from services.firebase_service import get_nearby_documents
+    loc = issue.get('location') or {}
+    lat = loc.get('lat')
+    lng = loc.get('lon') or loc.get('lng')
+    if not (isinstance(lat, (int, float)) and isinstance(lng, (int, float))):
+        return None, 0.0
+
+    # One geo query reads the scoring fields along with the coordinates
+    nearby = get_nearby_documents('issues', float(lat), float(lng), 100.0,
+                                  lat_field='location.lat', lng_field='location.lon',
+                                  fields=DUPLICATE_FIELDS)
+    # Exclude itself
+    nearby = [d for d in nearby if d.get('id') != issue_id]
+    # Sort by distance for efficiency
+    nearby.sort(key=lambda x: x.get('_distance_km', 0))
+    nearby = nearby[:8]  # cap to 8 closest
+
+    duplicate_of = None
+    best_score = 0.0
+    with tracing.span('duplicates', candidates=len(nearby)):
+        for candidate in nearby:
+            try:
+                with tracing.span('candidate', id=candidate.get('id')):
+                    # Text similarity
+                    cand_desc = (candidate.get('description') or '')
+                    emb_c = candidate.get(EMBEDDING_FIELD) or get_text_embedding(
+                        cand_desc) or []
+                    text_sim = cosine_similarity(
+                        embedding, emb_c) if embedding and emb_c else 0.0
+
+                    # Image similarity (optional, network-heavy)
+                    cand_photo = photo_url_of(candidate)
+                    img2 = None
+                    if cand_photo:
+                        with tracing.span('load_image'):
+                            img2 = fetch_analysis_image(cand_photo, timeout=10)
+                    img_sim = image_similarity_score(
+                        img, img2) if img is not None and img2 is not None else 0.0
+
+                score = (text_sim + img_sim) / 2.0
+                if score > 0.8 and score > best_score:
+                    best_score = score
+                    duplicate_of = candidate['id']
+            except Exception:
+                continue
+    return duplicate_of, best_score
+
+
+def enrich_document(data: Dict[str, Any], fields: Optional[List[str]] = None,
+                    img=None) -> Dict[str, Any]:
+    """Compute the update dict for the requested (or missing) enrichment fields.
+
+    Only the requested outputs are written, and an existing priority is never
+    replaced (it may have been set by an admin). Classification needs the
+    photo; severity uses the stored category when it isn't recomputed.
+    Raises RuntimeError when Gemini fails instead of returning its fallback
+    values, so the document is retried later.
+    """
+    fields = fields if fields is not None else missing_fields(data)
+    description = data.get('description') or ''
+    update: Dict[str, Any] = {}
+
+    if 'category' in fields:
+        photo_url = photo_url_of(data)
+        if img is None and photo_url:
+            img = fetch_analysis_image(photo_url)
+        if img is not None:
+            cat = classify_issue(img, description)
+            if cat.get('error'):
+                raise RuntimeError(f"classification failed: {cat['error']}")
+            update['category'] = cat.get('category', 'Other')
+            update['category_confidence'] = float(cat.get('confidence', 0.0))
+
+    if 'priority' in fields and not data.get('priority'):
+        category = update.get('category') or data.get('category') or data.get('type')
+        sev = assess_severity(description, category)
+        if sev.get('error'):
+            raise RuntimeError(f"severity failed: {sev['error']}")
+        update['priority'] = PRIORITY_MAP.get(sev.get('severity'), 'Medium')
+        update['ai_reason'] = sev.get('reason', '')
+
+    if 'embedding' in fields and description:
+        emb = get_text_embedding(description)
+        if emb:
+            update[EMBEDDING_FIELD] = emb
+
+    if update and not ai_available():
+        # Tripped while we were working: results may be fallbacks
+        raise RuntimeError('Gemini unavailable (circuit open)')
+    return update
+
+
+def enrich_deferred(data: Dict[str, Any], doc_id: str) -> Dict[str, Any]:
+    """Finish AI work skipped while Gemini was unavailable (`needs_enrichment`).
+
+    Complaints list the skipped steps in `ai_pending` ('type', 'summary',
+    and 'priority' while the stored priority is still the placeholder);
+    issues get the missing process-issue fields and duplicate detection. The
+    update clears the flag. Raises RuntimeError while Gemini still fails, so
+    the flag stays set.
+    """
+    from firebase_admin import firestore
+    if not ai_available():
+        raise RuntimeError('Gemini unavailable (circuit open)')
+
+    pending = data.get('ai_pending')
+    if pending is None:
+        photo_url = photo_url_of(data)
+        img = fetch_analysis_image(photo_url) if photo_url else None
+        update = enrich_document(data, img=img)
+        # process-issue skipped duplicate detection along with everything else
+        embedding = update.get(EMBEDDING_FIELD) or data.get(EMBEDDING_FIELD) or []
+        duplicate_of, score = find_duplicate(doc_id, data, img, embedding)
+        if duplicate_of:
+            update['duplicate_of'] = duplicate_of
+            update['duplicate_similarity'] = score
+    else:
+        update = {}
+        complaint_type = data.get('type')
+        if 'type' in pending:
+            prediction = predict_complaint_type(fetch_analysis_image(photo_url_of(data)))
+            if not prediction.get('predicted_type'):
+                raise RuntimeError('type prediction failed')
+            update.update(prediction)
+            complaint_type = prediction['type']
+        if 'summary' in pending:
+            summary = summarize_complaint(data.get('description') or '', complaint_type)
+            if not summary.get('ai_summary'):
+                raise RuntimeError('summary failed')
+            update['ai_summary'] = summary['ai_summary']
+            # Dropped from ai_pending once an admin sets the priority
+            if 'priority' in pending:
+                update['priority'] = summary['priority']
+        update['ai_pending'] = firestore.DELETE_FIELD
+
+    if not ai_available():
+        # Tripped while we were working: results may be fallbacks
+        raise RuntimeError('Gemini unavailable (circuit open)')
+    update['needs_enrichment'] = firestore.DELETE_FIELD
+    return update
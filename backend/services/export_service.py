@@ -0,0 +1,170 @@
+"""Streaming export helpers for large complaint dumps.
+
+Documents are paged from Firestore with `start_after` cursors and encoded
+row by row, so memory stays flat regardless of export size. Parquet output
+needs pyarrow and is written one row group per page.
+"""
+from config import Config
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+import csv
+import io
+import json
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Optional dependency; Parquet export is disabled without it
+    pa = None
+    pq = None
+
+
+EXPORT_COLUMNS = [
+    'id', 'user_id', 'type', 'category', 'status', 'priority', 'description',
+    'lat', 'lng', 'address', 'photo_url', 'ai_summary', 'admin_remarks',
+    'created_at', 'updated_at',
+]
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+
+def parquet_available() -> bool:
+    return pa is not None
+
+
+def iter_documents(query, page_size: Optional[int] = None) -> Iterator[Any]:
+    """Yield snapshots from `query` one page at a time using cursors."""
+    page_size = page_size or Config.EXPORT_PAGE_SIZE
+    last = None
+    while True:
+        page = query.limit(page_size)
+        if last is not None:
+            page = page.start_after(last)
+        count = 0
+        for doc in page.stream():
+            count += 1
+            last = doc
+            yield doc
+        if count < page_size:
+            return
+
+
+def _scalar(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+def flatten(doc) -> Dict[str, Any]:
+    """Project a complaint snapshot onto EXPORT_COLUMNS."""
+    data = doc.to_dict() or {}
+    loc = data.get('location') or {}
+    row = {
+        'id': doc.id,
+        'lat': loc.get('lat'),
+        'lng': loc.get('lng') if loc.get('lng') is not None else loc.get('lon'),
+        'address': loc.get('address'),
+        'photo_url': data.get('photo_url') or data.get('photoUrl'),
+        'created_at': data.get('created_at') or data.get('createdAt'),
+    }
+    for col in EXPORT_COLUMNS:
+        if col not in row:
+            row[col] = data.get(col)
+    return {col: _scalar(row[col]) for col in EXPORT_COLUMNS}
+
+
+def ndjson_stream(rows: Iterable[Dict[str, Any]]) -> Iterator[bytes]:
+    for row in rows:
+        yield (json.dumps(row, ensure_ascii=False) + '\n').encode('utf-8')
+
+
+def csv_stream(rows: Iterable[Dict[str, Any]]) -> Iterator[bytes]:
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=EXPORT_COLUMNS)
+    writer.writeheader()
+    # Header goes out before the first Firestore page is fetched
+    yield buf.getvalue().encode('utf-8')
+    for row in rows:
+        buf.seek(0)
+        buf.truncate()
+        writer.writerow(row)
+        yield buf.getvalue().encode('utf-8')
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object whose contents are drained by the generator."""
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        data = bytes(b)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self) -> bytes:
+        out = b''.join(self.chunks)
+        self.chunks.clear()
+        return out
+
+
+def parquet_stream(rows: Iterable[Dict[str, Any]],
+                   row_group_size: Optional[int] = None) -> Iterator[bytes]:
+    if pa is None:
+        raise RuntimeError('pyarrow is not installed')
+    row_group_size = row_group_size or Config.EXPORT_PAGE_SIZE
+    schema = pa.schema([
+        (col, pa.float64() if col in ('lat', 'lng') else pa.string())
+        for col in EXPORT_COLUMNS
+    ])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression='snappy')
+    columns: Dict[str, list] = {col: [] for col in EXPORT_COLUMNS}
+
+    def flush():
+        table = pa.table({
+            col: pa.array([_coerce(col, v) for v in values], type=schema.field(col).type)
+            for col, values in columns.items()
+        })
+        writer.write_table(table)
+        for values in columns.values():
+            values.clear()
+
+    pending = 0
+    for row in rows:
+        for col in EXPORT_COLUMNS:
+            columns[col].append(row[col])
+        pending += 1
+        if pending >= row_group_size:
+            flush()
+            pending = 0
+            yield sink.drain()
+    if pending:
+        flush()
+    writer.close()
+    yield sink.drain()
+
+
+def _coerce(col: str, value):
+    if value is None:
+        return None
+    if col in ('lat', 'lng'):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+    return str(value)
@@ -2,8 +2,18 @@
 import firebase_admin
 from firebase_admin import credentials, firestore, storage, auth
 from google.cloud.firestore import SERVER_TIMESTAMP
+from config import Config
+from services.tracing import traced
+from collections import OrderedDict
+from datetime import timedelta
+from urllib.parse import quote
+import copy
+import hashlib
 import os
 import json
+import threading
+import time
+import uuid
 
 
 _firebase_initialized = False
@@ -47,21 +57,26 @@ def initialize_firebase(credentials_path):
         else:
             firebase_admin.initialize_app(cred)
 
+        # Time every Firestore/Storage call made through these clients
+        from services.metrics import instrument_google_clients
+        instrument_google_clients()
+
         db = firestore.client()
         # If bucket_name is set, use it explicitly; else get default bucket
         bucket = storage.bucket(
             bucket_name) if bucket_name else storage.bucket()
-        try:
-            if bucket and hasattr(bucket, 'exists'):
-                if not bucket.exists():
-                    print("❗ Firebase Storage bucket not found.")
-                    print(
-                        "   Go to Firebase Console → Storage and click 'Get started' to provision the default bucket.")
-                    if bucket_name:
-                        print(f"   Expected bucket: {bucket_name}")
-        except Exception as e:
+        # Cache bucket health once here; uploads read the cached value
+        health = check_bucket_health()
+        if health['exists'] is False:
+            print("❗ Firebase Storage bucket not found.")
+            print(
+                "   Go to Firebase Console → Storage and click 'Get started' to provision the default bucket.")
+            if bucket_name:
+                print(f"   Expected bucket: {bucket_name}")
+        elif health.get('error'):
             # Non-fatal: existence check can fail if IAM or network issues; continue and let upload path handle errors
-            print(f"ℹ️  Could not verify bucket existence: {str(e)}")
+            print(f"ℹ️  Could not verify bucket existence: {health['error']}")
+        start_bucket_health_refresh()
         _firebase_initialized = True
 
         print("✅ Firebase initialized successfully")
@@ -79,6 +94,96 @@ def get_firestore():
     return db
 
 
+# --------------------- Batched reads ---------------------
+#
+# `get_documents` reads many documents in one BatchGetDocuments round trip
+# (`db.get_all`), optionally with a field mask. Inside a request every
+# document read through it is remembered on `flask.g`, so asking for the same
+# document again (e.g. the admin's own profile, then the admin's complaints'
+# authors) is answered without another read. The map lives for one request
+# only; callers that write a document and read it back should `forget` it.
+
+GET_ALL_CHUNK = 300
+
+
+def _identity_map():
+    from flask import g, has_request_context
+    if not has_request_context():
+        return None
+    if '_documents' not in g:
+        g._documents = {}
+    return g._documents
+
+
+def get_documents(collection: str, ids, fields=None):
+    """{id: data or None} for `ids` in `collection`, in one round trip.
+
+    `fields` limits the read to those field paths. Missing documents map
+    to None.
+    """
+    wanted = frozenset(fields) if fields else None
+    seen = _identity_map()
+    found = {}
+    todo = []
+    for doc_id in dict.fromkeys(i for i in ids if i):
+        cached = seen.get(f'{collection}/{doc_id}') if seen is not None else None
+        # A full read answers any mask; a masked one only narrower masks
+        if cached is not None and (cached[0] is None or (wanted is not None and wanted <= cached[0])):
+            found[doc_id] = _masked(cached[1], wanted) if cached[0] != wanted else cached[1]
+        else:
+            todo.append(doc_id)
+    if todo:
+        _get_all(collection, todo, wanted, found, seen)
+    # Deep copies, so callers can't change what later reads in this request
+    # see, nested maps (location, ai fields) included
+    return {k: copy.deepcopy(v) for k, v in found.items()}
+
+
+def _masked(data, fields):
+    """Only `fields` (dotted paths) of `data`, as a masked read would return."""
+    if data is None or fields is None:
+        return data
+    out = {}
+    for path in fields:
+        value, parts = data, path.split('.')
+        for part in parts:
+            if not isinstance(value, dict) or part not in value:
+                break
+            value = value[part]
+        else:
+            target = out
+            for part in parts[:-1]:
+                target = target.setdefault(part, {})
+            target[parts[-1]] = value
+    return out
+
+
+def _get_all(collection: str, todo, wanted, found, seen):
+    from services.tracing import span
+    database = get_firestore()
+    ref_collection = database.collection(collection)
+    with span('get_all', collection=collection, docs=len(todo), cached=len(found)):
+        for start in range(0, len(todo), GET_ALL_CHUNK):
+            refs = [ref_collection.document(doc_id) for doc_id in todo[start:start + GET_ALL_CHUNK]]
+            for snap in database.get_all(refs, field_paths=list(wanted) if wanted else None):
+                data = (snap.to_dict() or {}) if snap.exists else None
+                found[snap.id] = data
+                if seen is not None:
+                    seen[f'{collection}/{snap.id}'] = (wanted, data)
+
+
+def get_document(collection: str, doc_id: str, fields=None):
+    """One document's data (None if missing), through the request's identity map."""
+    return get_documents(collection, [doc_id], fields).get(doc_id)
+
+
+def forget(collection: str, doc_id: str):
+    """Drop a document from this request's identity map after writing it."""
+    seen = _identity_map()
+    if seen is not None:
+        seen.pop(f'{collection}/{doc_id}', None)
+
+
 def get_storage():
     """Get Storage bucket instance."""
     if bucket is None:
@@ -87,16 +192,272 @@ def get_storage():
     return bucket
 
 
-def verify_token(id_token):
-    """Verify Firebase ID token."""
+class _TokenCache:
+    """Bounded LRU of decoded ID tokens keyed by a SHA-256 of the raw token.
+
+    Entries expire at the token's `exp` minus a safety margin (or sooner when
+    revocation checks are enabled), so a cached token is never accepted
+    after Firebase itself would reject it. Each entry remembers whether it
+    was checked for revocation; a caller that needs that check doesn't get
+    an entry verified without it.
+    """
+
+    def __init__(self, max_size: int, margin_seconds: int):
+        self.max_size = max_size
+        self.margin = margin_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(id_token: str) -> str:
+        return hashlib.sha256(id_token.encode('utf-8')).hexdigest()
+
+    def get(self, key: str, check_revoked: bool = False):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            decoded, valid_until, revocation_checked = entry
+            if now >= valid_until:
+                del self._entries[key]
+                self.expired += 1
+                self.misses += 1
+                return None
+            if check_revoked and not revocation_checked:
+                # Weaker check than the caller needs: verify again
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return decoded
+
+    def put(self, key: str, decoded: dict, max_age=None, check_revoked: bool = False):
+        valid_until = float(decoded.get('exp', 0)) - self.margin
+        if max_age is not None:
+            valid_until = min(valid_until, time.time() + max_age)
+        if valid_until <= time.time():
+            return
+        with self._lock:
+            self._entries[key] = (decoded, valid_until, check_revoked)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'evictions': self.evictions,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+_token_cache = _TokenCache(Config.AUTH_TOKEN_CACHE_SIZE,
+                           Config.AUTH_TOKEN_CACHE_MARGIN_SECONDS)
+
+
+# --------------------- Storage helpers ---------------------
+
+_bucket_health = {'exists': None, 'checked_at': None, 'error': None}
+_health_thread = None
+
+
+def check_bucket_health():
+    """Check bucket existence once and cache the result."""
+    global _bucket_health
+    health = {'exists': None, 'checked_at': time.time(), 'error': None}
+    try:
+        health['exists'] = bool(bucket.exists()) if bucket is not None else False
+    except Exception as e:
+        health['exists'] = None
+        health['error'] = str(e)
+    _bucket_health = health
+    return health
+
+
+def bucket_health():
+    """Last cached bucket health ({'exists', 'checked_at', 'error'})."""
+    return dict(_bucket_health)
+
+
+def start_bucket_health_refresh(interval_seconds=None):
+    """Re-check bucket health in the background so uploads never block on it."""
+    global _health_thread
+    if _health_thread is not None:
+        return
+    interval = interval_seconds or Config.STORAGE_HEALTH_INTERVAL_SECONDS
+
+    def _loop():
+        while True:
+            time.sleep(interval)
+            check_bucket_health()
+
+    _health_thread = threading.Thread(
+        target=_loop, name='bucket-health', daemon=True)
+    _health_thread.start()
+
+
+def public_url_for(path, download_token=None):
+    """URL clients can read `path` from without a per-object ACL call.
+
+    'token' mode uses a Firebase download token stored in the object's
+    metadata at upload time; 'public_prefix' mode assumes the bucket grants
+    public read on the upload prefix via IAM.
+    """
+    bucket_name = get_storage().name
+    if Config.STORAGE_PUBLIC_MODE == 'public_prefix' or not download_token:
+        return f"https://storage.googleapis.com/{bucket_name}/{quote(path)}"
+    return (f"https://firebasestorage.googleapis.com/v0/b/{bucket_name}/o/"
+            f"{quote(path, safe='')}?alt=media&token={download_token}")
+
+
+def upload_stream(path, stream, content_type, size=None, download_token=None):
+    """Stream a file object into Storage as a chunked resumable upload.
+
+    At most STORAGE_UPLOAD_CHUNK_SIZE bytes are held in memory at a time.
+    The download token travels with the initial request, so the object is
+    readable as soon as the upload finishes.
+
+    Returns {'path', 'url', 'download_token'}.
+    """
+    blob = get_storage().blob(path, chunk_size=Config.STORAGE_UPLOAD_CHUNK_SIZE)
+    if Config.STORAGE_PUBLIC_MODE == 'token':
+        download_token = download_token or uuid.uuid4().hex
+        blob.metadata = {'firebaseStorageDownloadTokens': download_token}
+    else:
+        download_token = None
+    blob.upload_from_file(stream, size=size, content_type=content_type)
+    return {
+        'path': path,
+        'url': public_url_for(path, download_token),
+        'download_token': download_token,
+    }
+
+
+def upload_bytes(path, data, content_type, download_token=None):
+    """Single-request upload for small objects such as image derivatives."""
+    blob = get_storage().blob(path)
+    if Config.STORAGE_PUBLIC_MODE == 'token':
+        download_token = download_token or uuid.uuid4().hex
+        blob.metadata = {'firebaseStorageDownloadTokens': download_token}
+    else:
+        download_token = None
+    blob.cache_control = 'public, max-age=31536000, immutable'
+    blob.upload_from_string(data, content_type=content_type)
+    return {
+        'path': path,
+        'url': public_url_for(path, download_token),
+        'download_token': download_token,
+    }
+
+
+def signed_upload_url(path, content_type, max_bytes, expires_seconds=None):
+    """V4 signed PUT URL for uploading one object straight to Storage.
+
+    The client must send exactly the returned headers; GCS rejects a
+    different Content-Type or a body outside the length range.
+    """
+    expires_seconds = expires_seconds or Config.SIGNED_UPLOAD_TTL_SECONDS
+    headers = {'x-goog-content-length-range': f"1,{int(max_bytes)}"}
+    url = get_storage().blob(path).generate_signed_url(
+        version='v4',
+        expiration=timedelta(seconds=expires_seconds),
+        method='PUT',
+        content_type=content_type,
+        headers=headers,
+    )
+    return {
+        'upload_url': url,
+        'method': 'PUT',
+        'headers': {'Content-Type': content_type, **headers},
+        'path': path,
+        'expires_in': expires_seconds,
+    }
+
+
+def finalize_upload(path):
+    """Attach a download token to a directly-uploaded object.
+
+    Returns {'path', 'url', 'download_token', 'size', 'content_type', 'md5'},
+    or None if the object does not exist.
+    """
+    blob = get_storage().get_blob(path)
+    if blob is None:
+        return None
+    metadata = dict(blob.metadata or {})
+    download_token = None
+    if Config.STORAGE_PUBLIC_MODE == 'token':
+        download_token = (metadata.get('firebaseStorageDownloadTokens') or '').split(',')[0]
+        if not download_token:
+            download_token = uuid.uuid4().hex
+            metadata['firebaseStorageDownloadTokens'] = download_token
+            blob.metadata = metadata
+            blob.patch()
+    return {
+        'path': path,
+        'url': public_url_for(path, download_token),
+        'download_token': download_token,
+        'size': blob.size,
+        'content_type': blob.content_type,
+        'md5': blob.md5_hash,
+    }
+
+
+def download_bytes(path):
+    return get_storage().blob(path).download_as_bytes()
+
+
+def delete_object(path):
     try:
-        decoded_token = auth.verify_id_token(id_token)
+        get_storage().blob(path).delete()
+    except Exception as e:
+        print(f"Storage delete error for {path}: {e}")
+
+
+@traced('verify_token')
+def verify_token(id_token, check_revoked=None):
+    """Verify Firebase ID token, reusing a recent verification when possible."""
+    if not id_token:
+        return None
+    if check_revoked is None:
+        check_revoked = Config.AUTH_CHECK_REVOKED
+    key = _TokenCache.key(id_token)
+    decoded_token = _token_cache.get(key, check_revoked=check_revoked)
+    if decoded_token is not None:
+        return decoded_token
+    try:
+        decoded_token = auth.verify_id_token(
+            id_token, check_revoked=check_revoked)
+        _token_cache.put(key, decoded_token,
+                         max_age=Config.AUTH_REVOCATION_RECHECK_SECONDS if check_revoked else None,
+                         check_revoked=check_revoked)
         return decoded_token
     except Exception as e:
         print(f"Token verification error: {str(e)}")
         return None
 
 
+def token_cache_stats():
+    """Hit/miss counters for the decoded ID-token cache."""
+    return _token_cache.stats()
+
+
 # --------------------- Query helpers ---------------------
 
 def _haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
@@ -111,12 +472,16 @@ def _haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     return R * c
 
 
+@traced('geo_query')
 def get_nearby_documents(collection: str, center_lat: float, center_lng: float, radius_meters: float,
-                         lat_field: str = 'location.lat', lng_field: str = 'location.lng'):
+                         lat_field: str = 'location.lat', lng_field: str = 'location.lng',
+                         fields=None):
     """Fetch documents within an approximate radius using a bounding box then filter by haversine.
 
     Firestore does not support true geo-queries without extra indexing; this helper uses a simple
-    bounding-box approximation on lat/lng and then filters client-side.
+    bounding-box approximation on lat/lng and then filters client-side. `fields` limits the
+    returned data to those paths (plus the coordinates), e.g. to pick candidates cheaply
+    before reading the few that matter with `get_documents`.
     """
     db = get_firestore()
     radius_km = radius_meters / 1000.0
@@ -135,6 +500,11 @@ def get_nearby_documents(collection: str, center_lat: float, center_lng: float,
         lat_field, '<=', max_lat)
     query = query.where(lng_field, '>=', min_lng).where(
         lng_field, '<=', max_lng)
+    if fields:
+        coords = [lat_field, lng_field]
+        if lng_field.endswith('lng'):
+            coords.append(lng_field[:-3] + 'lon')
+        query = query.select(list(dict.fromkeys([*fields, *coords])))
 
     results = []
     for doc in query.stream():
@@ -10,6 +10,9 @@ from typing import Any, Dict, List, Optional
 import math
 import json
 import google.generativeai as genai
+from google.api_core.exceptions import InvalidArgument
+from services import circuit_breaker, metrics
+from services.tracing import traced
 
 
 # Configure Gemini API
@@ -20,6 +23,43 @@ except Exception:
     # Defer failure to call-time; functions will return safe defaults
     pass
 
+# While Gemini is failing or slow, calls fail fast with CircuitOpenError
+# (reported like any other error) instead of waiting for a timeout
+breaker = circuit_breaker.register(circuit_breaker.CircuitBreaker(
+    'gemini',
+    window=Config.GEMINI_BREAKER_WINDOW,
+    min_calls=Config.GEMINI_BREAKER_MIN_CALLS,
+    failure_rate=Config.GEMINI_BREAKER_FAILURE_RATE,
+    slow_seconds=Config.GEMINI_BREAKER_SLOW_SECONDS,
+    slow_rate=Config.GEMINI_BREAKER_SLOW_RATE,
+    open_seconds=Config.GEMINI_BREAKER_OPEN_SECONDS,
+    ignore=(InvalidArgument,),
+))
+
+
+def ai_available() -> bool:
+    """False while the Gemini breaker is open; callers should skip AI work."""
+    return breaker.available()
+
+
+def _json_or_text(text: str, expect_json: bool, allow_array: bool = False):
+    """Wrap model text as a result dict, parsing JSON when requested."""
+    if expect_json:
+        try:
+            return {'success': True, 'result': json.loads(text)}
+        except Exception:
+            # Try to extract JSON substring
+            if allow_array and '[' in text:
+                start, end = text.find('['), text.rfind(']')
+            else:
+                start, end = text.find('{'), text.rfind('}')
+            if start != -1 and end != -1 and end > start:
+                try:
+                    return {'success': True, 'result': json.loads(text[start:end+1])}
+                except Exception:
+                    pass
+    return {'success': True, 'result': text}
+
 
 def analyze_image(image_data, prompt, *, expect_json: bool = False):
     """
@@ -35,21 +75,10 @@ def analyze_image(image_data, prompt, *, expect_json: bool = False):
     try:
         # type: ignore[attr-defined]
         model = genai.GenerativeModel('gemini-1.5-flash')
-        response = model.generate_content([prompt, image_data])
-        text = (response.text or '').strip()
-        if expect_json:
-            try:
-                return {'success': True, 'result': json.loads(text)}
-            except Exception:
-                # Try to extract JSON substring
-                start = text.find('{')
-                end = text.rfind('}')
-                if start != -1 and end != -1 and end > start:
-                    try:
-                        return {'success': True, 'result': json.loads(text[start:end+1])}
-                    except Exception:
-                        pass
-        return {'success': True, 'result': text}
+        images = image_data if isinstance(image_data, list) else [image_data]
+        with breaker.guard(), metrics.timer('gemini', 'generate_content'):
+            response = model.generate_content([prompt, *images])
+        return _json_or_text((response.text or '').strip(), expect_json)
     except Exception as e:
         return {
             'success': False,
@@ -70,20 +99,9 @@ def generate_text(prompt, *, expect_json: bool = False):
     try:
         # type: ignore[attr-defined]
         model = genai.GenerativeModel('gemini-1.5-flash')
-        response = model.generate_content(prompt)
-        text = (response.text or '').strip()
-        if expect_json:
-            try:
-                return {'success': True, 'result': json.loads(text)}
-            except Exception:
-                start = text.find('[') if '[' in text else text.find('{')
-                end = text.rfind(']') if ']' in text else text.rfind('}')
-                if start != -1 and end != -1 and end > start:
-                    try:
-                        return {'success': True, 'result': json.loads(text[start:end+1])}
-                    except Exception:
-                        pass
-        return {'success': True, 'result': text}
+        with breaker.guard(), metrics.timer('gemini', 'generate_content'):
+            response = model.generate_content(prompt)
+        return _json_or_text((response.text or '').strip(), expect_json, allow_array=True)
     except Exception as e:
         return {
             'success': False,
@@ -91,9 +109,39 @@ def generate_text(prompt, *, expect_json: bool = False):
         }
 
 
-def predict_issue_type(image_data):
-    """Predict civic issue type from image."""
-    prompt = """Analyze this civic infrastructure image and classify it into ONE of these categories:
+async def analyze_image_async(image_data, prompt, *, expect_json: bool = False):
+    """`analyze_image` on the SDK's async transport (no thread held while waiting)."""
+    try:
+        # type: ignore[attr-defined]
+        model = genai.GenerativeModel('gemini-1.5-flash')
+        images = image_data if isinstance(image_data, list) else [image_data]
+        with breaker.guard(), metrics.timer('gemini', 'generate_content'):
+            response = await model.generate_content_async([prompt, *images])
+        return _json_or_text((response.text or '').strip(), expect_json)
+    except Exception as e:
+        return {
+            'success': False,
+            'error': str(e)
+        }
+
+
+async def generate_text_async(prompt, *, expect_json: bool = False):
+    """`generate_text` on the SDK's async transport."""
+    try:
+        # type: ignore[attr-defined]
+        model = genai.GenerativeModel('gemini-1.5-flash')
+        with breaker.guard(), metrics.timer('gemini', 'generate_content'):
+            response = await model.generate_content_async(prompt)
+        return _json_or_text((response.text or '').strip(), expect_json, allow_array=True)
+    except Exception as e:
+        return {
+            'success': False,
+            'error': str(e)
+        }
+
+
+def _predict_issue_type_prompt():
+    return """Analyze this civic infrastructure image and classify it into ONE of these categories:
     - pothole
     - streetlight
     - garbage
@@ -104,12 +152,20 @@ def predict_issue_type(image_data):
     
     Respond with ONLY the category name, nothing else."""
 
-    return analyze_image(image_data, prompt)
 
+@traced('predict_type')
+def predict_issue_type(image_data):
+    """Predict civic issue type from image."""
+    return analyze_image(image_data, _predict_issue_type_prompt())
 
-def generate_summary_and_priority(description, issue_type):
-    """Generate complaint summary and suggest priority."""
-    prompt = f"""Given this civic complaint:
+
+async def predict_issue_type_async(image_data):
+    """Async variant of `predict_issue_type`."""
+    return await analyze_image_async(image_data, _predict_issue_type_prompt())
+
+
+def _summary_and_priority_prompt(description, issue_type):
+    return f"""Given this civic complaint:
     Type: {issue_type}
     Description: {description}
     
@@ -121,27 +177,58 @@ def generate_summary_and_priority(description, issue_type):
     SUMMARY: [your summary]
     PRIORITY: [level] - [reason]"""
 
-    return generate_text(prompt)
 
+@traced('summarize')
+def generate_summary_and_priority(description, issue_type):
+    """Generate complaint summary and suggest priority."""
+    return generate_text(_summary_and_priority_prompt(description, issue_type))
 
-def verify_resolution(before_image, after_image, issue_type):
-    """Compare before/after images to verify issue resolution."""
-    prompt = f"""Compare these before and after images of a {issue_type} civic issue.
-    
-    Determine if the issue has been resolved. Provide:
-    1. Resolution status (resolved/not_resolved/partially_resolved)
-    2. Confidence score (0-100)
-    3. Brief explanation
-    
-    Format:
-    STATUS: [status]
-    CONFIDENCE: [score]
-    EXPLANATION: [brief explanation]"""
 
-    # Note: Gemini can handle multiple images in one call
-    return analyze_image([before_image, after_image], prompt)
+async def generate_summary_and_priority_async(description, issue_type):
+    """Async variant of `generate_summary_and_priority`."""
+    return await generate_text_async(_summary_and_priority_prompt(description, issue_type))
+
+
+RESOLUTION_STATUSES = ('resolved', 'partially_resolved', 'not_resolved')
+
+
+def _verify_resolution_prompt(issue_type):
+    return (
+        f"The first image shows a reported {issue_type or 'civic'} issue; the second was taken "
+        "after the city worked on it. Decide whether the issue has been resolved.\n"
+        "Return JSON with keys status (one of resolved, partially_resolved, not_resolved), "
+        "confidence (0.0-1.0) and explanation (one sentence).\nReturn ONLY JSON."
+    )
+
+
+@traced('verify_resolution')
+def verify_resolution(before_image, after_image, issue_type) -> Dict[str, Any]:
+    """Compare before/after images in one call.
+
+    Returns:
+        dict: {"status", "confidence", "explanation"}, or {"error"} on failure
+    """
+    res = analyze_image([before_image, after_image], _verify_resolution_prompt(issue_type),
+                        expect_json=True)
+    if not res.get('success'):
+        return {'error': res.get('error')}
+    data = res.get('result')
+    if not isinstance(data, dict):
+        return {'error': 'Unexpected model output'}
+    status = str(data.get('status') or '').strip().lower().replace(' ', '_')
+    if status not in RESOLUTION_STATUSES:
+        return {'error': f'Unexpected status: {status or None}'}
+    try:
+        confidence = float(data.get('confidence', 0.0))
+    except Exception:
+        confidence = 0.0
+    if confidence > 1.0:  # percent despite the prompt
+        confidence /= 100.0
+    return {'status': status, 'confidence': max(0.0, min(1.0, confidence)),
+            'explanation': str(data.get('explanation') or '')}
 
 
+@traced('insights')
 def generate_insights(complaints_data):
     """Generate insights from aggregated complaints data."""
     prompt = f"""Analyze this civic complaints data and provide insights:
@@ -159,9 +246,8 @@ def generate_insights(complaints_data):
     return generate_text(prompt)
 
 
-def chatbot_response(user_query, context_data):
-    """Generate chatbot response for user queries."""
-    prompt = f"""You are a helpful assistant for CityFix, a civic complaint platform.
+def _chatbot_prompt(user_query, context_data):
+    return f"""You are a helpful assistant for CityFix, a civic complaint platform.
     
     User query: {user_query}
     Context: {context_data}
@@ -169,11 +255,21 @@ def chatbot_response(user_query, context_data):
     Provide a clear, concise, and helpful response. If asked about complaint status, 
     format it nicely with relevant details."""
 
-    return generate_text(prompt)
+
+@traced('chatbot')
+def chatbot_response(user_query, context_data):
+    """Generate chatbot response for user queries."""
+    return generate_text(_chatbot_prompt(user_query, context_data))
+
+
+async def chatbot_response_async(user_query, context_data):
+    """Async variant of `chatbot_response`."""
+    return await generate_text_async(_chatbot_prompt(user_query, context_data))
 
 
 # --------------------- New helpers for hackathon features ---------------------
 
+@traced('classify')
 def classify_issue(image_data, description: str) -> Dict[str, Any]:
     """Classify the issue category with a confidence, using image and text.
 
@@ -201,6 +297,7 @@ def classify_issue(image_data, description: str) -> Dict[str, Any]:
     return {"category": category, "confidence": max(0.0, min(1.0, confidence))}
 
 
+@traced('embedding')
 def get_text_embedding(text: str) -> Optional[List[float]]:
     """Get text embedding vector using Gemini embeddings."""
     try:
@@ -208,10 +305,11 @@ def get_text_embedding(text: str) -> Optional[List[float]]:
         emb_fn = getattr(genai, 'embed_content', None)
         if not callable(emb_fn):
             return None
-        try:
-            res = emb_fn(model='text-embedding-004', content=text)
-        except Exception:
-            res = emb_fn(model='models/text-embedding-004', content=text)
+        with breaker.guard(), metrics.timer('gemini', 'embed_content'):
+            try:
+                res = emb_fn(model='text-embedding-004', content=text)
+            except Exception:
+                res = emb_fn(model='models/text-embedding-004', content=text)
 
         # Normalize output
         if isinstance(res, dict):
@@ -243,6 +341,7 @@ def cosine_similarity(v1: List[float], v2: List[float]) -> float:
     return float(dot/denom) if denom else 0.0
 
 
+@traced('image_similarity')
 def image_similarity_score(image1, image2) -> float:
     """Approximate image similarity using Gemini with a targeted prompt.
 
@@ -255,8 +354,9 @@ def image_similarity_score(image1, image2) -> float:
     try:
         # type: ignore[attr-defined]
         model = genai.GenerativeModel('gemini-1.5-flash')
-        resp = model.generate_content(
-            [prompt + " Return ONLY JSON.", image1, image2])
+        with breaker.guard(), metrics.timer('gemini', 'generate_content'):
+            resp = model.generate_content(
+                [prompt + " Return ONLY JSON.", image1, image2])
         text = (resp.text or '').strip()
         data = __safe_json_parse(text)
         sim = float(data.get('similarity', 0.0))
@@ -265,6 +365,7 @@ def image_similarity_score(image1, image2) -> float:
         return 0.0
 
 
+@traced('severity')
 def assess_severity(description: str, category: Optional[str] = None) -> Dict[str, Any]:
     """Assess severity and reason from text (and optional category)."""
     prompt = (
@@ -275,7 +376,7 @@ def assess_severity(description: str, category: Optional[str] = None) -> Dict[st
     )
     res = generate_text(prompt + "\nReturn ONLY JSON.", expect_json=True)
     if not res.get('success'):
-        return {"severity": "Medium", "reason": "AI unavailable"}
+        return {"severity": "Medium", "reason": "AI unavailable", "error": res.get('error')}
     data = res.get('result') or {}
     sev = str(data.get('severity') or 'Medium')
     if sev not in ("High", "Medium", "Low"):
@@ -283,6 +384,7 @@ def assess_severity(description: str, category: Optional[str] = None) -> Dict[st
     return {"severity": sev, "reason": str(data.get('reason') or '')}
 
 
+@traced('weekly_summary')
 def weekly_summary_bullets(stats: Dict[str, Any], complaints: List[Dict[str, Any]]) -> List[str]:
     """Generate 3 concise bullet points summarizing the period."""
     prompt = (
@@ -0,0 +1,260 @@
+"""Idempotency-Key support for endpoints that create things or run the AI pipeline.
+
+A client sends `Idempotency-Key: <unique string>` with a POST and reuses the
+same key when it retries. The response of the first completed execution is
+stored for IDEMPOTENCY_TTL_SECONDS and replayed, marked `Idempotent-Replayed:
+true`, so a retry neither creates a second document nor calls Gemini again.
+
+- A duplicate that arrives while the first request is still running waits
+  for it (up to IDEMPOTENCY_WAIT_SECONDS) and gets the same response. If it
+  is still running after that, the duplicate gets 409 with Retry-After.
+- Keys are scoped per user and endpoint. Reusing a key with a different
+  body gets 422.
+- 5xx responses, 429/503 from admission control and exceptions are not
+  stored. The key is released, so the next retry runs the view again. An
+  execution that dies without releasing its key (process killed) stops
+  blocking retries after IDEMPOTENCY_LOCK_SECONDS.
+
+Keys live in memory by default. With several instances, set
+IDEMPOTENCY_STORE=firestore so they are shared through the
+`idempotency_keys` collection. Add a TTL policy on `expires_at` there.
+
+Views opt in with the `idempotent(scope)` decorator, below `token_required`
+and above `admit`, so replays don't spend rate-limit tokens.
+"""
+from config import Config
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+from typing import Any, Dict, Optional
+from flask import jsonify, make_response, request
+import hashlib
+import threading
+import time
+
+from services import metrics, tracing
+
+IDEMPOTENCY_COLLECTION = 'idempotency_keys'
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+IN_PROGRESS, DONE = 'in_progress', 'done'
+
+REQUESTS = metrics.counter('cityfix_idempotency_requests_total',
+                           'Requests carrying an Idempotency-Key, by outcome',
+                           ('scope', 'outcome'))
+
+
+def _is_final(status: int) -> bool:
+    """Responses a retry should get back instead of running the view again."""
+    return status < 500 and status not in (409, 429)
+
+
+# --------------------- Key stores ---------------------
+#
+# A record is {'state', 'fingerprint', 'lease_until'} while in progress and
+# gains {'status', 'mimetype', 'body'} once done. `start` claims a key (returns
+# None) or returns the record holding it; `wait` blocks until that record
+# changes or the timeout passes.
+
+class MemoryStore:
+    """Keys in this process; expired records are dropped as new ones arrive."""
+    remote = False
+
+    def __init__(self, max_keys: int = 10000):
+        self.max_keys = max_keys
+        self._records: Dict[str, Dict[str, Any]] = {}
+        self._changed = threading.Condition()
+
+    def _purge(self, now: float):
+        for k in [k for k, r in self._records.items() if r['state'] == DONE and r['expires'] <= now]:
+            del self._records[k]
+        # Still full: drop the oldest finished records (insertion order)
+        for k in [k for k, r in self._records.items() if r['state'] == DONE][
+                :len(self._records) - self.max_keys]:
+            del self._records[k]
+
+    def start(self, key: str, fingerprint: str, lease: float) -> Optional[Dict[str, Any]]:
+        now = time.monotonic()
+        with self._changed:
+            if len(self._records) >= self.max_keys:
+                self._purge(now)
+            record = self._records.get(key)
+            stale = record is None \
+                or (record['state'] == IN_PROGRESS and record['lease_until'] <= now) \
+                or (record['state'] == DONE and record['expires'] <= now)
+            if stale:
+                self._records[key] = {'state': IN_PROGRESS, 'fingerprint': fingerprint,
+                                      'lease_until': now + lease}
+                return None
+            return dict(record)
+
+    def wait(self, key: str, timeout: float):
+        with self._changed:
+            record = self._records.get(key)
+            self._changed.wait_for(lambda: self._records.get(key) is not record, timeout)
+
+    def finish(self, key: str, result: Dict[str, Any], ttl: float):
+        with self._changed:
+            record = self._records.get(key) or {}
+            self._records[key] = {**record, **result, 'state': DONE,
+                                  'expires': time.monotonic() + ttl}
+            self._changed.notify_all()
+
+    def release(self, key: str):
+        with self._changed:
+            self._records.pop(key, None)
+            self._changed.notify_all()
+
+
+class FirestoreStore:
+    """Keys shared by all instances, one `idempotency_keys` document per key."""
+    remote = True
+    poll_seconds = 0.25
+
+    def _ref(self, key: str):
+        from services.firebase_service import get_firestore
+        return get_firestore().collection(IDEMPOTENCY_COLLECTION).document(key)
+
+    def start(self, key: str, fingerprint: str, lease: float) -> Optional[Dict[str, Any]]:
+        from firebase_admin import firestore
+        from services.firebase_service import get_firestore
+        ref = self._ref(key)
+
+        @firestore.transactional
+        def start(transaction):
+            snap = ref.get(transaction=transaction)
+            record = (snap.to_dict() or {}) if snap.exists else None
+            now = time.time()
+            if record is not None:
+                stale = (record.get('state') == IN_PROGRESS and record.get('lease_until', 0) <= now) \
+                    or (record.get('state') == DONE and record.get('expires', 0) <= now)
+                if not stale:
+                    return record
+            transaction.set(ref, {
+                'state': IN_PROGRESS, 'fingerprint': fingerprint, 'lease_until': now + lease,
+                'expires_at': datetime.now(timezone.utc) + timedelta(seconds=lease),
+            })
+            return None
+
+        return start(get_firestore().transaction())
+
+    def wait(self, key: str, timeout: float):
+        deadline = time.monotonic() + timeout
+        delay = self.poll_seconds
+        while True:
+            time.sleep(max(0.0, min(delay, deadline - time.monotonic())))
+            if time.monotonic() >= deadline:
+                return
+            snap = self._ref(key).get()
+            if not snap.exists or (snap.to_dict() or {}).get('state') != IN_PROGRESS:
+                return
+            delay = min(delay * 2, 2.0)
+
+    def finish(self, key: str, result: Dict[str, Any], ttl: float):
+        self._ref(key).update({
+            **result, 'state': DONE, 'expires': time.time() + ttl,
+            'expires_at': datetime.now(timezone.utc) + timedelta(seconds=ttl),
+        })
+
+    def release(self, key: str):
+        self._ref(key).delete()
+
+
+_store = None
+
+
+def set_store(store):
+    global _store
+    _store = store
+
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = FirestoreStore() if Config.IDEMPOTENCY_STORE == 'firestore' else MemoryStore()
+    return _store
+
+
+# --------------------- Decorator ---------------------
+
+def _fingerprint() -> str:
+    digest = hashlib.sha256()
+    digest.update(f'{request.method} {request.path}\n'.encode('utf-8'))
+    digest.update(request.get_data(cache=True))
+    return digest.hexdigest()
+
+
+def _replay(record: Dict[str, Any]):
+    response = make_response(record['body'], record['status'])
+    response.mimetype = record['mimetype']
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def _in_progress(scope: str):
+    REQUESTS.inc(scope, 'in_progress')
+    retry_after = max(1, int(Config.IDEMPOTENCY_WAIT_SECONDS))
+    return (jsonify({'error': 'A request with this Idempotency-Key is still in progress',
+                     'retry_after': retry_after}), 409, {'Retry-After': str(retry_after)})
+
+
+def idempotent(scope: str):
+    """Decorator: run the view once per (user, scope, Idempotency-Key)."""
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            client_key = request.headers.get(HEADER)
+            if not Config.IDEMPOTENCY_ENABLED or not client_key:
+                return f(*args, **kwargs)
+            if len(client_key) > MAX_KEY_LENGTH:
+                return jsonify({'error': f'{HEADER} must be at most {MAX_KEY_LENGTH} characters'}), 400
+
+            uid = (getattr(request, 'user', None) or {}).get('uid', '')
+            key = hashlib.sha256(f'{scope}:{uid}:{client_key}'.encode('utf-8')).hexdigest()
+            fingerprint = _fingerprint()
+            store = get_store()
+            deadline = time.monotonic() + Config.IDEMPOTENCY_WAIT_SECONDS
+            waited = False
+
+            try:
+                while True:
+                    record = store.start(key, fingerprint, Config.IDEMPOTENCY_LOCK_SECONDS)
+                    if record is None:
+                        break
+                    if record.get('fingerprint') != fingerprint:
+                        REQUESTS.inc(scope, 'mismatch')
+                        return jsonify({'error': f'{HEADER} was already used with a different request'}), 422
+                    if record.get('state') == DONE:
+                        REQUESTS.inc(scope, 'waited' if waited else 'replayed')
+                        return _replay(record)
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return _in_progress(scope)
+                    # Same request still running elsewhere: wait for its response
+                    with tracing.span('idempotency_wait'):
+                        store.wait(key, remaining)
+                    waited = True
+            except Exception as e:
+                # Fail open: a store outage shouldn't block report submission
+                print(f"Idempotency store error: {e}")
+                return f(*args, **kwargs)
+
+            REQUESTS.inc(scope, 'executed')
+            try:
+                response = make_response(f(*args, **kwargs))
+            except BaseException:
+                store.release(key)
+                raise
+            try:
+                if _is_final(response.status_code) and not response.is_streamed:
+                    store.finish(key, {'status': response.status_code,
+                                       'mimetype': response.mimetype,
+                                       'body': response.get_data()},
+                                 Config.IDEMPOTENCY_TTL_SECONDS)
+                else:
+                    store.release(key)
+            except Exception as e:
+                # The response is still good; retries will just run again
+                print(f"Idempotency store error: {e}")
+            return response
+        return decorated
+    return decorator
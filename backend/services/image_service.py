@@ -0,0 +1,239 @@
+"""Upload-time image derivatives.
+
+Every uploaded photo gets a thumbnail, a medium display size and an
+analysis-size JPEG for Gemini. All variants are orientation-corrected and
+written without EXIF. They are rendered after the upload has been
+answered: a background job reads the stored object back and decodes it in
+a process pool, so neither the photo bytes nor Pillow hold up a Flask
+worker. The variants are stored next to the original with the same
+download token, which makes their URLs derivable from the original URL.
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from config import Config
+from typing import Dict, Optional, Tuple
+from urllib.parse import quote, unquote
+import base64
+import hashlib
+import multiprocessing
+import threading
+import io
+
+
+VARIANTS = {
+    'thumb': (Config.IMAGE_THUMB_SIZE, 75),
+    'medium': (Config.IMAGE_MEDIUM_SIZE, 82),
+    'analysis': (Config.IMAGE_ANALYSIS_SIZE, 85),
+}
+
+_process_pool = None
+_io_pool = None
+_job_pool = None
+_upload_pool = None
+_pool_lock = threading.Lock()
+
+
+def dhash(img, size: int = 8) -> str:
+    """64-bit difference hash as 16 hex chars; survives re-encoding and resizing."""
+    from PIL import Image
+    small = img.convert('L').resize((size + 1, size), Image.LANCZOS)
+    px = list(small.getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            left = px[row * (size + 1) + col]
+            right = px[row * (size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return f"{bits:0{size * size // 4}x}"
+
+
+def hamming(a: str, b: str) -> int:
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
+
+
+def render_derivatives(data: bytes) -> Tuple[Dict[str, bytes], str]:
+    """Decode once, encode every variant as EXIF-free JPEG and compute the dHash.
+
+    Runs in a worker process.
+    """
+    from PIL import Image, ImageOps
+    with Image.open(io.BytesIO(data)) as src:
+        # JPEG draft mode decodes at reduced scale when the source is huge
+        largest = max(size for size, _ in VARIANTS.values())
+        src.draft('RGB', (largest, largest))
+        img = ImageOps.exif_transpose(src).convert('RGB')
+
+    out = {}
+    for name, (size, quality) in sorted(VARIANTS.items(), key=lambda v: -v[1][0]):
+        variant = img.copy()
+        variant.thumbnail((size, size), Image.LANCZOS)
+        buf = io.BytesIO()
+        variant.save(buf, format='JPEG', quality=quality,
+                     optimize=True, progressive=size >= 512)
+        out[name] = buf.getvalue()
+    return out, dhash(img)
+
+
+def process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    with _pool_lock:
+        if _process_pool is None:
+            # spawn: forking a process that holds gRPC channels is unsafe
+            _process_pool = ProcessPoolExecutor(
+                max_workers=Config.IMAGE_POOL_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'))
+        return _process_pool
+
+
+def io_pool() -> ThreadPoolExecutor:
+    """Bounded thread pool for concurrent Storage writes."""
+    global _io_pool
+    with _pool_lock:
+        if _io_pool is None:
+            _io_pool = ThreadPoolExecutor(
+                max_workers=Config.STORAGE_WRITE_WORKERS,
+                thread_name_prefix='storage-write')
+        return _io_pool
+
+
+def job_pool() -> ThreadPoolExecutor:
+    """Runs whole post-upload jobs; kept apart from io_pool, which they wait on."""
+    global _job_pool
+    with _pool_lock:
+        if _job_pool is None:
+            _job_pool = ThreadPoolExecutor(
+                max_workers=Config.IMAGE_POOL_WORKERS,
+                thread_name_prefix='image-job')
+        return _job_pool
+
+
+def upload_pool() -> ThreadPoolExecutor:
+    """Whole-file uploads for batch requests (each waits on io_pool/process_pool)."""
+    global _upload_pool
+    with _pool_lock:
+        if _upload_pool is None:
+            _upload_pool = ThreadPoolExecutor(
+                max_workers=Config.UPLOAD_BATCH_WORKERS,
+                thread_name_prefix='upload')
+        return _upload_pool
+
+
+def derivative_path(path: str, variant: str) -> str:
+    stem = path.rsplit('.', 1)[0] if '.' in path.rsplit('/', 1)[-1] else path
+    return f"{stem}__{variant}.jpg"
+
+
+def _url_prefixes():
+    try:
+        from services.firebase_service import get_storage
+        bucket_name = get_storage().name
+    except Exception:
+        return None, None
+    return (f"https://firebasestorage.googleapis.com/v0/b/{bucket_name}/o/",
+            f"https://storage.googleapis.com/{bucket_name}/")
+
+
+def object_path_from_url(photo_url: Optional[str]) -> Optional[str]:
+    """Storage path of a photo URL issued by this backend, else None."""
+    if not photo_url:
+        return None
+    token_prefix, public_prefix = _url_prefixes()
+    if token_prefix and photo_url.startswith(token_prefix):
+        return unquote(photo_url[len(token_prefix):].partition('?')[0])
+    if public_prefix and photo_url.startswith(public_prefix):
+        return unquote(photo_url[len(public_prefix):].partition('?')[0])
+    return None
+
+
+def derivative_url(photo_url: Optional[str], variant: str) -> Optional[str]:
+    """URL of a variant for a photo uploaded by this backend, else None."""
+    path = object_path_from_url(photo_url)
+    if path is None:
+        return None
+    token_prefix, public_prefix = _url_prefixes()
+    path = derivative_path(path, variant)
+    if photo_url.startswith(token_prefix):
+        query = photo_url.partition('?')[2]
+        return f"{token_prefix}{quote(path, safe='')}" + (f"?{query}" if query else '')
+    return f"{public_prefix}{quote(path)}"
+
+
+def store_derivatives(path: str, data: bytes,
+                      download_token: Optional[str] = None) -> Tuple[Dict[str, str], Optional[str]]:
+    """Render variants off-thread and upload them concurrently.
+
+    Returns ({variant: url}, dhash); ({}, None) if rendering failed (the
+    original upload is still usable).
+    """
+    from services.firebase_service import upload_bytes
+    try:
+        rendered, phash = process_pool().submit(render_derivatives, data).result(
+            timeout=Config.IMAGE_DERIVE_TIMEOUT_SECONDS)
+    except Exception as e:
+        print(f"Derivative render error for {path}: {e}")
+        return {}, None
+
+    futures = {
+        name: io_pool().submit(upload_bytes, derivative_path(path, name), body,
+                               'image/jpeg', download_token)
+        for name, body in rendered.items()
+    }
+    urls = {}
+    for name, future in futures.items():
+        try:
+            urls[name] = future.result()['url']
+        except Exception as e:
+            print(f"Derivative upload error for {path} ({name}): {e}")
+    return urls, phash
+
+
+def expected_derivatives(photo_url: Optional[str]) -> Dict[str, str]:
+    """Variant URLs a photo will have once its derivatives are written."""
+    urls = {name: derivative_url(photo_url, name) for name in VARIANTS}
+    return {name: url for name, url in urls.items() if url}
+
+
+def content_hashes(data: bytes) -> Tuple[str, str]:
+    """(SHA-256 hex, base64 MD5 as reported by GCS) of the raw bytes."""
+    return (hashlib.sha256(data).hexdigest(),
+            base64.b64encode(hashlib.md5(data).digest()).decode('ascii'))
+
+
+class HashingReader:
+    """File-like wrapper that hashes what is read through it without keeping
+    a copy, so memory per upload stays at one chunk."""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._pos = 0
+        self._hashed = 0
+        self._sha256 = hashlib.sha256()
+        self._md5 = hashlib.md5()
+
+    def read(self, size=-1):
+        chunk = self._stream.read(size)
+        if chunk:
+            end = self._pos + len(chunk)
+            # Resumable-upload recovery seeks back and re-reads; hash each
+            # byte once
+            if end > self._hashed:
+                fresh = chunk[max(0, self._hashed - self._pos):]
+                self._sha256.update(fresh)
+                self._md5.update(fresh)
+                self._hashed = end
+            self._pos = end
+        return chunk
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=0):
+        self._pos = self._stream.seek(offset, whence)
+        return self._pos
+
+    @property
+    def sha256(self) -> str:
+        return self._sha256.hexdigest()
+
+    @property
+    def md5(self) -> str:
+        return base64.b64encode(self._md5.digest()).decode('ascii')
@@ -0,0 +1,420 @@
+"""In-process metrics served at `/metrics` in the Prometheus text format.
+
+Counters, gauges and histograms live in a module-level registry. Recording
+is a dict update under a lock plus a bisect for histograms (a few µs), so
+instrumentation stays on in production. What is recorded:
+
+- every Flask request, and the native AI routes in asgi.py: latency
+  histogram per endpoint and method, request count per status, requests
+  in flight;
+- Firestore and Storage client calls (`instrument_google_clients`), Gemini
+  calls and image downloads (`timer`): latency, errors and in-flight calls
+  per dependency and operation;
+- cache hit ratios and other service state, read at scrape time from
+  registered collectors.
+
+Each process keeps its own registry; with several workers, scrape each one.
+"""
+from bisect import bisect_left
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+import functools
+import threading
+
+from services import tracing
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry: Dict[str, '_Metric'] = {}
+_collectors: Dict[str, Callable[[], Iterable[Tuple[str, str, str, Dict[str, Any], float]]]] = {}
+_registry_lock = threading.Lock()
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple, extra: str = '') -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._values: Dict[Tuple, Any] = {}
+        self._lock = threading.Lock()
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append(f'{self.name}{_labels(self.labelnames, labels)} {_number(value)}')
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                # Per-bucket (non-cumulative) counts + overflow, sum, count
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted((labels, ([*s[0]], s[1], s[2])) for labels, s in self._values.items())
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                le = 'le="%s"' % _number(bound)
+                lines.append(f'{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, labels)} {total!r}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, labels)} {count}')
+        return lines
+
+
+def _register(cls, name: str, help: str, labels: Tuple[str, ...] = (), **kwargs):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = cls(name, help, labels, **kwargs)
+        return metric
+
+
+def counter(name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+    return _register(Counter, name, help, labels)
+
+
+def gauge(name: str, help: str, labels: Tuple[str, ...] = ()) -> Gauge:
+    return _register(Gauge, name, help, labels)
+
+
+def histogram(name: str, help: str, labels: Tuple[str, ...] = (),
+              buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+    return _register(Histogram, name, help, labels, buckets=buckets)
+
+
+def register_collector(key: str, fn: Callable[[], Iterable[Tuple[str, str, str, Dict[str, Any], float]]]):
+    """Add (or replace) a scrape-time source yielding (name, type, help, labels, value)."""
+    _collectors[key] = fn
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format (0.0.4)."""
+    with _registry_lock:
+        metrics = list(_registry.values())
+    lines: List[str] = []
+    for metric in metrics:
+        lines.extend(metric.render())
+
+    # Samples of one family must be contiguous, whichever collector yields them
+    families: Dict[str, Tuple[str, str, List[str]]] = {}
+    for collector in list(_collectors.values()):
+        try:
+            samples = list(collector())
+        except Exception as e:
+            print(f"Metrics collector error: {e}")
+            continue
+        for name, kind, help, labels, value in samples:
+            if value is None:
+                continue
+            family = families.setdefault(name, (kind, help, []))
+            names = tuple(labels)
+            family[2].append(f'{name}{_labels(names, tuple(labels[n] for n in names))} {_number(value)}')
+    for name, (kind, help, samples) in families.items():
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} {kind}')
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+
+# --------------------- HTTP requests ---------------------
+
+HTTP_LATENCY = histogram('cityfix_http_request_duration_seconds',
+                         'Request latency by endpoint', ('endpoint', 'method'))
+HTTP_REQUESTS = counter('cityfix_http_requests_total',
+                        'Requests by endpoint and status', ('endpoint', 'method', 'status'))
+HTTP_IN_FLIGHT = gauge('cityfix_http_requests_in_flight', 'Requests being handled')
+
+
+def observe_request(endpoint: str, method: str, status: int, seconds: float):
+    HTTP_LATENCY.observe(seconds, endpoint, method)
+    HTTP_REQUESTS.inc(endpoint, method, status)
+
+
+def init_app(app):
+    """Record latency, status and in-flight count for every request."""
+    from flask import g, request
+
+    @app.before_request
+    def _metrics_start():
+        g._metrics_start = perf_counter()
+        HTTP_IN_FLIGHT.inc()
+
+    @app.after_request
+    def _metrics_status(response):
+        g._metrics_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def _metrics_finish(exc):
+        start = g.pop('_metrics_start', None)
+        if start is None:
+            return
+        HTTP_IN_FLIGHT.dec()
+        status = g.pop('_metrics_status', 500)
+        # Unmatched URLs share one label so scanners can't add series
+        observe_request(request.endpoint or 'unmatched', request.method, status,
+                        perf_counter() - start)
+
+
+# --------------------- Dependencies ---------------------
+
+DEPENDENCY_LATENCY = histogram('cityfix_dependency_duration_seconds',
+                               'Latency of calls to external services',
+                               ('dependency', 'operation', 'collection'))
+DEPENDENCY_ERRORS = counter('cityfix_dependency_errors_total',
+                            'Failed calls to external services',
+                            ('dependency', 'operation', 'collection'))
+DEPENDENCY_IN_FLIGHT = gauge('cityfix_dependency_in_flight',
+                             'Calls to external services in progress', ('dependency',))
+
+
+def observe_dependency(dependency: str, operation: str, seconds: float,
+                       ok: bool = True, collection: str = ''):
+    DEPENDENCY_LATENCY.observe(seconds, dependency, operation, collection)
+    if not ok:
+        DEPENDENCY_ERRORS.inc(dependency, operation, collection)
+
+
+class timer:
+    """Time a dependency call: `with metrics.timer('gemini', 'generate_content'):`.
+
+    Exceptions raised inside the block are counted as errors and re-raised.
+    Inside a request the call is also recorded as a tracing span.
+    """
+    __slots__ = ('dependency', 'operation', 'collection', 'start', 'span')
+
+    def __init__(self, dependency: str, operation: str, collection: str = ''):
+        self.dependency = dependency
+        self.operation = operation
+        self.collection = collection
+
+    def __enter__(self):
+        DEPENDENCY_IN_FLIGHT.inc(self.dependency)
+        self.span = tracing.start_span(f'{self.dependency}.{self.operation}',
+                                       {'collection': self.collection} if self.collection else None)
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = perf_counter() - self.start
+        tracing.end_span(self.span, exc)
+        DEPENDENCY_IN_FLIGHT.dec(self.dependency)
+        observe_dependency(self.dependency, self.operation, elapsed,
+                           exc_type is None, self.collection)
+        return False
+
+
+# Set while an instrumented client call runs on this thread, so SDK methods
+# that call each other (Query.get -> Query.stream) are recorded once
+_active = threading.local()
+
+
+def _timed_iter(iterator, dependency: str, operation: str, collection: str):
+    """Yield from a streaming call, timing only the time spent waiting on it."""
+    elapsed = 0.0
+    ok = True
+    first = perf_counter()
+    DEPENDENCY_IN_FLIGHT.inc(dependency)
+    try:
+        while True:
+            _active.on = True
+            start = perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            except Exception:
+                ok = False
+                raise
+            finally:
+                elapsed += perf_counter() - start
+                _active.on = False
+            yield item
+    finally:
+        DEPENDENCY_IN_FLIGHT.dec(dependency)
+        observe_dependency(dependency, operation, elapsed, ok, collection)
+        tracing.add_span(f'{dependency}.{operation}', first, elapsed,
+                         {'collection': collection, 'wait_only': True} if collection else {'wait_only': True})
+
+
+def _collection_of(obj) -> str:
+    """Top-level collection of a Firestore reference or query, else ''."""
+    path = getattr(obj, '_path', None)
+    if path:
+        return path[0]
+    parent = getattr(obj, '_parent', None)
+    if parent is not None:
+        return _collection_of(parent)
+    return ''
+
+
+def _wrap(cls, method: str, dependency: str, operation: str, streaming: bool = False,
+          by_collection: bool = False):
+    original = getattr(cls, method, None)
+    if original is None or getattr(original, '_metrics_wrapped', False):
+        return
+
+    @functools.wraps(original)
+    def wrapper(self, *args, **kwargs):
+        if getattr(_active, 'on', False):
+            return original(self, *args, **kwargs)
+        collection = _collection_of(self) if by_collection else ''
+        if streaming:
+            _active.on = True
+            try:
+                iterator = iter(original(self, *args, **kwargs))
+            finally:
+                _active.on = False
+            return _timed_iter(iterator, dependency, operation, collection)
+
+        _active.on = True
+        DEPENDENCY_IN_FLIGHT.inc(dependency)
+        span = tracing.start_span(f'{dependency}.{operation}',
+                                  {'collection': collection} if collection else None)
+        start = perf_counter()
+        error = None
+        try:
+            return original(self, *args, **kwargs)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            elapsed = perf_counter() - start
+            _active.on = False
+            tracing.end_span(span, error)
+            DEPENDENCY_IN_FLIGHT.dec(dependency)
+            observe_dependency(dependency, operation, elapsed, error is None, collection)
+
+    wrapper._metrics_wrapped = True
+    setattr(cls, method, wrapper)
+
+
+_instrumented = False
+
+
+def instrument_google_clients():
+    """Time every Firestore and Storage client call made through the SDKs."""
+    global _instrumented
+    if _instrumented:
+        return
+    _instrumented = True
+    try:
+        from google.cloud.firestore_v1 import (
+            document, query, collection, batch, bulk_batch, client, transaction, aggregation)
+        for method in ('get', 'set', 'update', 'delete', 'create'):
+            _wrap(document.DocumentReference, method, 'firestore', f'document.{method}',
+                  by_collection=True)
+        _wrap(query.Query, 'get', 'firestore', 'query.get', by_collection=True)
+        _wrap(query.Query, 'stream', 'firestore', 'query.stream', streaming=True,
+              by_collection=True)
+        _wrap(collection.CollectionReference, 'get', 'firestore', 'query.get', by_collection=True)
+        _wrap(collection.CollectionReference, 'stream', 'firestore', 'query.stream',
+              streaming=True, by_collection=True)
+        _wrap(collection.CollectionReference, 'add', 'firestore', 'collection.add',
+              by_collection=True)
+        _wrap(aggregation.AggregationQuery, 'get', 'firestore', 'aggregation.get')
+        _wrap(batch.WriteBatch, 'commit', 'firestore', 'batch.commit')
+        _wrap(bulk_batch.BulkWriteBatch, 'commit', 'firestore', 'bulk_writer.commit')
+        _wrap(transaction.Transaction, '_commit', 'firestore', 'transaction.commit')
+        _wrap(client.Client, 'get_all', 'firestore', 'get_all')
+    except Exception as e:
+        print(f"Firestore instrumentation unavailable: {e}")
+    try:
+        from google.cloud.storage import blob, bucket
+        for method in ('upload_from_file', 'upload_from_string', 'download_as_bytes',
+                       'reload', 'patch', 'delete', 'exists'):
+            _wrap(blob.Blob, method, 'storage', f'blob.{method}')
+        for method in ('exists', 'get_blob'):
+            _wrap(bucket.Bucket, method, 'storage', f'bucket.{method}')
+    except Exception as e:
+        print(f"Storage instrumentation unavailable: {e}")
+
+
+# --------------------- Scrape-time collectors ---------------------
+
+def cache_collector(caches: Callable[[], Dict[str, Dict[str, Any]]]):
+    """Collector for `{name: stats}` dicts with hits/misses (and size)."""
+    def collect():
+        for name, stats in caches().items():
+            hits = stats.get('hits')
+            misses = stats.get('misses')
+            if hits is None or misses is None:
+                continue
+            labels = {'cache': name}
+            yield ('cityfix_cache_hits_total', 'counter', 'Cache hits', labels, hits)
+            yield ('cityfix_cache_misses_total', 'counter', 'Cache misses', labels, misses)
+            lookups = hits + misses
+            yield ('cityfix_cache_hit_ratio', 'gauge', 'Cache hit ratio since start', labels,
+                   hits / lookups if lookups else 0.0)
+            if stats.get('size') is not None:
+                yield ('cityfix_cache_entries', 'gauge', 'Entries held in the cache', labels,
+                       stats['size'])
+    return collect
+
+
+def prometheus_response():
+    from flask import Response
+    return Response(render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
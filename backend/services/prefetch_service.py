@@ -0,0 +1,161 @@
+"""Speculative image classification started as soon as a photo is uploaded.
+
+The complaint form uploads the photo first and submits the description
+seconds later. Classifying the photo in the background during that gap
+means `/api/complaints/new` and `/api/ai/predict-type` usually find the
+answer ready. Results are keyed by Storage object path:
+
+- in this process, as futures (so a request arriving mid-classification
+  waits for it instead of calling Gemini a second time);
+- in Firestore `ai_prefetch/{sha1(path)}`, for other workers;
+- in the upload index `ai` cache, so exact re-uploads reuse them too.
+
+The Firestore document is deleted once `/new` has used it. Photos that never
+become a complaint are left with `expires_at` (AI_PREFETCH_TTL_SECONDS);
+add a TTL policy on that field for the `ai_prefetch` collection.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from config import Config
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional
+import hashlib
+import threading
+import time
+
+COLLECTION = 'ai_prefetch'
+
+_pool = None
+_futures: 'OrderedDict[str, Any]' = OrderedDict()
+_lock = threading.Lock()
+_stats = {'started': 0, 'hits': 0, 'waited': 0, 'misses': 0, 'failed': 0}
+
+
+def _executor() -> ThreadPoolExecutor:
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=Config.AI_PREFETCH_WORKERS,
+                                       thread_name_prefix='ai-prefetch')
+        return _pool
+
+
+def _doc_id(path: str) -> str:
+    return hashlib.sha1(path.encode('utf-8')).hexdigest()
+
+
+def _classify(path: str, photo_url: str, content_hash: Optional[str]) -> Optional[Dict[str, Any]]:
+    from services.enrichment_service import fetch_analysis_image, predict_complaint_type
+    from services.firebase_service import get_firestore
+    from firebase_admin import firestore
+    from services import upload_index
+
+    started = time.time()
+    try:
+        prediction = predict_complaint_type(fetch_analysis_image(photo_url, timeout=10))
+    except Exception as e:
+        print(f"AI prefetch error for {path}: {e}")
+        prediction = None
+    if not prediction or not prediction.get('predicted_type'):
+        with _lock:
+            _stats['failed'] += 1
+        return None
+
+    try:
+        get_firestore().collection(COLLECTION).document(_doc_id(path)).set({
+            'path': path,
+            'photo_url': photo_url,
+            'prediction': prediction,
+            'duration_ms': int((time.time() - started) * 1000),
+            'created_at': firestore.SERVER_TIMESTAMP,
+            'expires_at': datetime.now(timezone.utc) + timedelta(seconds=Config.AI_PREFETCH_TTL_SECONDS),
+        })
+    except Exception as e:
+        print(f"AI prefetch store error for {path}: {e}")
+    if content_hash:
+        upload_index.remember_ai(content_hash, prediction)
+    return prediction
+
+
+def start_prefetch(path: str, photo_url: str, content_hash: Optional[str] = None):
+    """Queue image-only classification for a freshly uploaded object."""
+    if not Config.AI_PREFETCH_ENABLED or not path or not photo_url:
+        return
+    with _lock:
+        if path in _futures:
+            return
+    future = _executor().submit(_classify, path, photo_url, content_hash)
+    with _lock:
+        _futures[path] = future
+        _stats['started'] += 1
+        while len(_futures) > Config.AI_PREFETCH_MAX_ENTRIES:
+            _futures.popitem(last=False)
+
+
+def pending(path: str):
+    """In-process future for `path` (running or finished), or None."""
+    with _lock:
+        return _futures.get(path)
+
+
+def get_prediction(path: Optional[str] = None, photo_url: Optional[str] = None,
+                   wait: Optional[float] = None) -> Optional[Dict[str, Any]]:
+    """Prefetched {'type', 'predicted_type', 'ai_tags'} for an object, or None.
+
+    Waits up to `wait` seconds (AI_PREFETCH_WAIT_SECONDS by default) for a
+    classification still running in this process.
+    """
+    if path is None:
+        from services.image_service import object_path_from_url
+        path = object_path_from_url(photo_url)
+    if not path:
+        return None
+    wait = Config.AI_PREFETCH_WAIT_SECONDS if wait is None else wait
+
+    with _lock:
+        future = _futures.get(path)
+    if future is not None:
+        done = future.done()
+        try:
+            prediction = future.result(timeout=wait)
+        except Exception:
+            # Still running after `wait`, or failed: fall through to Firestore
+            prediction = None
+        if prediction:
+            with _lock:
+                _stats['hits' if done else 'waited'] += 1
+            return dict(prediction)
+
+    try:
+        from services.firebase_service import get_firestore
+        snap = get_firestore().collection(COLLECTION).document(_doc_id(path)).get()
+        if snap.exists and (snap.to_dict() or {}).get('prediction'):
+            with _lock:
+                _stats['hits'] += 1
+            return dict(snap.to_dict()['prediction'])
+    except Exception as e:
+        print(f"AI prefetch lookup error for {path}: {e}")
+    with _lock:
+        _stats['misses'] += 1
+    return None
+
+
+def discard(path: Optional[str] = None, photo_url: Optional[str] = None):
+    """Drop the prefetched result for an object once a complaint has used it."""
+    if path is None:
+        from services.image_service import object_path_from_url
+        path = object_path_from_url(photo_url)
+    if not path:
+        return
+    with _lock:
+        _futures.pop(path, None)
+    try:
+        from services.firebase_service import get_firestore
+        get_firestore().collection(COLLECTION).document(_doc_id(path)).delete()
+    except Exception as e:
+        print(f"AI prefetch cleanup error for {path}: {e}")
+
+
+def prefetch_stats() -> Dict[str, Any]:
+    with _lock:
+        return {**_stats, 'in_process': len(_futures)}
@@ -0,0 +1,83 @@
+"""Weekly AI summary stored under `reports/weekly_summary`.
+
+Run by the scheduler (see services/scheduler_service.py), never inline on a
+request thread.
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict
+
+
+def generate_weekly_summary() -> Dict[str, Any]:
+    """Summarize the last 7 days of issues with Gemini and store the report.
+
+    Returns the stats the report was built from.
+    """
+    from services.firebase_service import get_firestore
+    from services.gemini_service import weekly_summary_bullets
+    from firebase_admin import firestore
+    db = get_firestore()
+
+    # Collect last 7 days issues (use 'issues' collection to match frontend)
+    # Fallback if lack of index: fetch recent 300 and filter client-side
+    try:
+        issues_ref = db.collection('issues').order_by(
+            'createdAt', direction='DESCENDING').limit(300)
+        docs = list(issues_ref.stream())
+    except Exception:
+        docs = list(db.collection('issues').limit(300).stream())
+    now = datetime.now(timezone.utc)
+    seven_days_ago = now - timedelta(days=7)
+
+    items = []
+    total = 0
+    resolved = 0
+    by_type = {}
+    for d in docs:
+        data = d.to_dict() or {}
+        created = data.get('createdAt') or data.get('created_at')
+        # createdAt may be ISO string or Timestamp; be tolerant
+        try:
+            if created and hasattr(created, 'to_datetime'):
+                created_dt = created.to_datetime()
+            elif created and hasattr(created, 'timestamp'):
+                created_dt = created
+            else:
+                created_dt = datetime.fromisoformat(
+                    str(created).replace('Z', '+00:00')) if created else None
+        except Exception:
+            created_dt = None
+        if created_dt and created_dt.tzinfo is None:
+            created_dt = created_dt.replace(tzinfo=timezone.utc)
+        if not created_dt or created_dt < seven_days_ago:
+            continue
+        total += 1
+        status = (data.get('status') or '').lower()
+        if status in ('resolved', 'closed'):
+            resolved += 1
+        tags = data.get('tags') or []
+        itype = data.get('category') or (
+            tags[0] if tags else 'other')
+        by_type[itype] = by_type.get(itype, 0) + 1
+        items.append({
+            'id': d.id,
+            'category': data.get('category'),
+            'priority': data.get('priority'),
+            'status': data.get('status'),
+            'location': data.get('location')
+        })
+
+    stats = {
+        'total_new': total,
+        'resolved': resolved,
+        'pending': max(0, total - resolved),
+        'by_type': by_type,
+    }
+    bullets = weekly_summary_bullets(stats, items)
+    report = {
+        'generated_at': firestore.SERVER_TIMESTAMP,
+        'period_days': 7,
+        'stats': stats,
+        'bullets': bullets,
+    }
+    db.collection('reports').document('weekly_summary').set(report)
+    return stats
@@ -0,0 +1,168 @@
+"""Before/after photo comparison for resolution verification.
+
+`verify` runs the whole pipeline for the admin and AI verify-resolution
+routes:
+
+1. Fetch both photos concurrently (analysis-size derivatives when they
+   exist). The before photo is the complaint's original and never changes,
+   so its downscaled copy is kept in a small LRU cache.
+2. Downscale both to RESOLUTION_IMAGE_SIZE on the longest edge.
+3. Compare them locally: mean absolute RGB difference and SSIM on a
+   small thumbnail. An after photo that is nearly identical to the before
+   photo (a resubmitted or re-encoded original) is answered `not_resolved`
+   without calling Gemini.
+4. Otherwise make one Gemini call that returns status, confidence and an
+   explanation as JSON.
+
+The result carries the similarity scores and per-stage timings (ms), so the
+routes can store it as is.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from config import Config
+from typing import Any, Dict, Optional
+import threading
+import time
+
+import numpy as np
+
+from services import tracing
+
+COMPARE_SIZE = 128   # thumbnail side for the local pre-check
+SSIM_BLOCK = 8
+
+_pool = None
+_lock = threading.Lock()
+_before_cache: 'OrderedDict[str, Any]' = OrderedDict()
+_stats = {'hits': 0, 'misses': 0, 'prechecked': 0, 'model_calls': 0}
+
+
+def _executor() -> ThreadPoolExecutor:
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=Config.RESOLUTION_FETCH_WORKERS,
+                                       thread_name_prefix='resolution-fetch')
+        return _pool
+
+
+def downscale(img):
+    """Upright RGB copy no larger than RESOLUTION_IMAGE_SIZE on its longest edge."""
+    from PIL import Image, ImageOps
+    img = ImageOps.exif_transpose(img).convert('RGB')
+    size = Config.RESOLUTION_IMAGE_SIZE
+    if max(img.size) > size:
+        img.thumbnail((size, size), Image.LANCZOS)
+    return img
+
+
+def _load(url: str):
+    from services.enrichment_service import fetch_analysis_image
+    return downscale(fetch_analysis_image(url, timeout=Config.RESOLUTION_FETCH_TIMEOUT))
+
+
+def load_before(url: str):
+    """Downscaled before photo, from the LRU cache when possible."""
+    with _lock:
+        img = _before_cache.get(url)
+        if img is not None:
+            _before_cache.move_to_end(url)
+            _stats['hits'] += 1
+            return img
+        _stats['misses'] += 1
+    img = _load(url)
+    with _lock:
+        _before_cache[url] = img
+        while len(_before_cache) > Config.RESOLUTION_CACHE_SIZE:
+            _before_cache.popitem(last=False)
+    return img
+
+
+def _thumbnail(img) -> np.ndarray:
+    from PIL import Image
+    small = img.convert('RGB').resize((COMPARE_SIZE, COMPARE_SIZE), Image.BILINEAR)
+    return np.asarray(small, dtype=np.float32) / 255.0
+
+
+def compare(before, after) -> Dict[str, float]:
+    """Mean absolute RGB difference and grayscale block SSIM, both in 0..1."""
+    a, b = _thumbnail(before), _thumbnail(after)
+    # Colour counts here: a repainted or cleaned surface can keep its brightness
+    pixel_diff = float(np.abs(a - b).mean())
+
+    # SSIM (luma) over non-overlapping blocks, then averaged
+    luma = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    a, b = a @ luma, b @ luma
+    blocks = COMPARE_SIZE // SSIM_BLOCK
+    a = a.reshape(blocks, SSIM_BLOCK, blocks, SSIM_BLOCK).swapaxes(1, 2).reshape(-1, SSIM_BLOCK ** 2)
+    b = b.reshape(blocks, SSIM_BLOCK, blocks, SSIM_BLOCK).swapaxes(1, 2).reshape(-1, SSIM_BLOCK ** 2)
+    mu_a, mu_b = a.mean(axis=1), b.mean(axis=1)
+    var_a, var_b = a.var(axis=1), b.var(axis=1)
+    cov = ((a - mu_a[:, None]) * (b - mu_b[:, None])).mean(axis=1)
+    c1, c2 = 0.01 ** 2, 0.03 ** 2
+    ssim = ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / \
+        ((mu_a ** 2 + mu_b ** 2 + c1) * (var_a + var_b + c2))
+    return {'ssim': round(float(ssim.mean()), 4), 'pixel_diff': round(pixel_diff, 4)}
+
+
+def near_identical(similarity: Dict[str, float]) -> bool:
+    return (similarity['ssim'] >= Config.RESOLUTION_SSIM_THRESHOLD
+            and similarity['pixel_diff'] <= Config.RESOLUTION_PIXEL_THRESHOLD)
+
+
+def _ms(start: float) -> float:
+    return round((time.perf_counter() - start) * 1000, 1)
+
+
+def verify(issue_type: Optional[str], before_url: Optional[str] = None,
+           after_url: Optional[str] = None, before_image=None, after_image=None) -> Dict[str, Any]:
+    """Verify a resolution from URLs and/or already decoded PIL images.
+
+    Returns {status, resolved, confidence, explanation, method, similarity,
+    timings_ms}, or {error, similarity?, timings_ms} when Gemini fails.
+    """
+    from services.gemini_service import verify_resolution
+    timings = {}
+    started = time.perf_counter()
+
+    stage = time.perf_counter()
+    with tracing.span('fetch_images'):
+        before_future = _executor().submit(load_before, before_url) if before_image is None else None
+        after = downscale(after_image) if after_image is not None else _load(after_url)
+        before = downscale(before_image) if before_future is None else before_future.result()
+    timings['fetch'] = _ms(stage)
+
+    stage = time.perf_counter()
+    with tracing.span('precheck'):
+        similarity = compare(before, after)
+    timings['precheck'] = _ms(stage)
+
+    if near_identical(similarity):
+        with _lock:
+            _stats['prechecked'] += 1
+        result = {
+            'status': 'not_resolved',
+            'confidence': round(similarity['ssim'], 2),
+            'explanation': 'The after photo is nearly identical to the original photo.',
+            'method': 'precheck',
+        }
+    else:
+        with _lock:
+            _stats['model_calls'] += 1
+        stage = time.perf_counter()
+        result = {**verify_resolution(before, after, issue_type), 'method': 'model'}
+        timings['model'] = _ms(stage)
+
+    if 'status' in result:
+        result['resolved'] = result['status'] == 'resolved'
+    timings['total'] = _ms(started)
+    result['similarity'] = similarity
+    result['timings_ms'] = timings
+    return result
+
+
+def resolution_stats() -> Dict[str, Any]:
+    with _lock:
+        lookups = _stats['hits'] + _stats['misses']
+        return {**_stats, 'cached_before_images': len(_before_cache),
+                'hit_ratio': round(_stats['hits'] / lookups, 4) if lookups else 0.0}
@@ -0,0 +1,328 @@
+"""Background jobs that run once across all worker processes.
+
+Each web worker starts an APScheduler, so a plain interval job would run
+once per worker. Coordinated jobs go through Firestore instead:
+
+- `scheduler_jobs/{job}` is a lease. A worker runs a job only after
+  claiming it in a transaction, which fails while another worker holds an
+  unexpired lease (no overlapping runs) or when the job already started
+  within the last half interval (so every worker's timer firing for the
+  same slot yields a single run).
+- Timers are aligned to a fixed epoch and jittered by up to
+  `SCHEDULER_JITTER_SECONDS`, so workers don't all hit the lease at once.
+- `job_runs/{id}` records every run: trigger, worker, status, timings and
+  error.
+- Manual triggers enqueue a `queued` run; whichever scheduler polls next
+  (every `SCHEDULER_POLL_SECONDS`) claims and executes it.
+- A worker that dies mid-run never releases its lease. Once the lease
+  expires, the run it names is marked `failed` (by the next claim of that
+  job, or by the queue poll), and so is a run left `claimed` for longer
+  than a lease.
+
+Jobs run inside the web workers when `RUN_SCHEDULER_IN_WEB` is set, or in a
+single standalone process via `python scheduler.py`.
+"""
+from datetime import datetime, timedelta, timezone
+from config import Config
+from typing import Any, Dict, List, Optional
+import os
+import socket
+import time
+
+JOBS_COLLECTION = 'scheduler_jobs'
+RUNS_COLLECTION = 'job_runs'
+QUEUE_JOB_ID = 'job_queue'
+
+# Interval timers count from here, so all workers fire in the same slots
+_EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+_scheduler = None
+
+
+def _weekly_summary():
+    from services.report_service import generate_weekly_summary
+    return generate_weekly_summary()
+
+
+JOBS: Dict[str, Dict[str, Any]] = {
+    'weekly_summary': {
+        'func': _weekly_summary,
+        'interval_seconds': Config.WEEKLY_SUMMARY_INTERVAL_HOURS * 3600,
+    },
+}
+
+
+def worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _db():
+    from services.firebase_service import get_firestore
+    return get_firestore()
+
+
+_UNFINISHED = ('claimed', 'running')
+
+
+def _abandoned_run(transaction, state: Dict[str, Any], now: datetime):
+    """Run ref whose worker let the lease in `state` expire while it was
+    unfinished, else None. Transactional read; call before any write."""
+    lease_until = state.get('lease_until')
+    if not lease_until or lease_until > now or not state.get('run_id'):
+        return None
+    ref = _db().collection(RUNS_COLLECTION).document(state['run_id'])
+    snap = ref.get(transaction=transaction)
+    if not snap.exists or (snap.to_dict() or {}).get('status') not in _UNFINISHED:
+        return None
+    return ref
+
+
+def _fail_abandoned(transaction, run_ref, state: Dict[str, Any], now: datetime):
+    transaction.update(run_ref, {
+        'status': 'failed',
+        'error': f"Lease expired; worker {state.get('holder')} stopped before finishing",
+        'finished_at': now,
+    })
+    print(f"Scheduler: run {run_ref.id} abandoned by {state.get('holder')}, marked failed")
+
+
+def _claim(name: str, force: bool = False, run_id: Optional[str] = None) -> Optional[str]:
+    """Take the job's lease for `run_id`. Returns None on success, else why not."""
+    from firebase_admin import firestore
+    db = _db()
+    ref = db.collection(JOBS_COLLECTION).document(name)
+    interval = JOBS[name]['interval_seconds']
+    now = _now()
+
+    @firestore.transactional
+    def claim(transaction):
+        snap = ref.get(transaction=transaction)
+        state = (snap.to_dict() or {}) if snap.exists else {}
+        lease_until = state.get('lease_until')
+        if lease_until and lease_until > now:
+            return 'running'
+        abandoned = _abandoned_run(transaction, state, now)
+        if abandoned is not None:
+            _fail_abandoned(transaction, abandoned, state, now)
+        last_started = state.get('last_started_at')
+        if not force and last_started and (now - last_started).total_seconds() < interval / 2:
+            if abandoned is not None:
+                transaction.set(ref, {'lease_until': None, 'holder': None, 'run_id': None,
+                                      'last_status': 'failed'}, merge=True)
+            return 'not due'
+        transaction.set(ref, {
+            'lease_until': now + timedelta(seconds=Config.SCHEDULER_LEASE_SECONDS),
+            'holder': worker_id(),
+            'run_id': run_id,
+            'last_started_at': now,
+        }, merge=True)
+        return None
+
+    return claim(db.transaction())
+
+
+def _reap(name: str):
+    """Fail the run behind an expired, unreleased lease of `name` and clear it."""
+    from firebase_admin import firestore
+    db = _db()
+    ref = db.collection(JOBS_COLLECTION).document(name)
+    now = _now()
+
+    @firestore.transactional
+    def reap(transaction):
+        snap = ref.get(transaction=transaction)
+        state = (snap.to_dict() or {}) if snap.exists else {}
+        abandoned = _abandoned_run(transaction, state, now)
+        if abandoned is None:
+            return
+        _fail_abandoned(transaction, abandoned, state, now)
+        transaction.set(ref, {'lease_until': None, 'holder': None, 'run_id': None,
+                              'last_status': 'failed', 'last_run_id': abandoned.id}, merge=True)
+
+    reap(db.transaction())
+
+
+def _reap_claimed(snaps):
+    """Fail runs stuck in 'claimed': the worker died before starting them."""
+    cutoff = _now() - timedelta(seconds=Config.SCHEDULER_LEASE_SECONDS)
+    for snap in snaps:
+        claimed_at = (snap.to_dict() or {}).get('claimed_at')
+        if claimed_at and claimed_at < cutoff:
+            snap.reference.update({'status': 'failed', 'finished_at': _now(),
+                                   'error': 'Claimed by a worker that never started it'})
+
+
+def _release(name: str, status: str, run_id: str, duration_ms: int):
+    try:
+        _db().collection(JOBS_COLLECTION).document(name).set({
+            'lease_until': None,
+            'holder': None,
+            'run_id': None,
+            'last_finished_at': _now(),
+            'last_status': status,
+            'last_run_id': run_id,
+            'last_duration_ms': duration_ms,
+        }, merge=True)
+    except Exception as e:
+        print(f"Scheduler: failed to release {name}: {e}")
+
+
+def run_job(name: str, trigger: str = 'schedule', run_id: Optional[str] = None,
+            force: bool = False) -> Optional[str]:
+    """Run `name` if this worker can claim it. Returns the job_runs id, or None if skipped."""
+    from firebase_admin import firestore
+    runs = _db().collection(RUNS_COLLECTION)
+    # The lease names the run, so an abandoned run can be failed later
+    ref = runs.document(run_id) if run_id else runs.document()
+    try:
+        reason = _claim(name, force=force, run_id=ref.id)
+    except Exception as e:
+        print(f"Scheduler: could not claim {name}: {e}")
+        return None
+    if reason:
+        print(f"Scheduler: skipping {name} ({reason})")
+        return None
+
+    started = {
+        'status': 'running',
+        'worker': worker_id(),
+        'started_at': firestore.SERVER_TIMESTAMP,
+    }
+    if run_id:
+        ref.update(started)
+    else:
+        ref.set({'job': name, 'trigger': trigger,
+                 'created_at': firestore.SERVER_TIMESTAMP, **started})
+
+    start = time.time()
+    status, error, result = 'succeeded', None, None
+    try:
+        result = JOBS[name]['func']()
+    except Exception as e:
+        status, error = 'failed', str(e)
+        print(f"Scheduler: {name} failed: {e}")
+    duration_ms = int((time.time() - start) * 1000)
+
+    try:
+        ref.update({
+            'status': status,
+            'error': error,
+            'result': result if isinstance(result, dict) else None,
+            'finished_at': firestore.SERVER_TIMESTAMP,
+            'duration_ms': duration_ms,
+        })
+    except Exception as e:
+        print(f"Scheduler: failed to record run {ref.id}: {e}")
+    _release(name, status, ref.id, duration_ms)
+    return ref.id
+
+
+def _take_queued(run_id: str) -> bool:
+    """Flip a queued run to 'claimed' unless another worker got there first."""
+    from firebase_admin import firestore
+    db = _db()
+    ref = db.collection(RUNS_COLLECTION).document(run_id)
+
+    @firestore.transactional
+    def take(transaction):
+        snap = ref.get(transaction=transaction)
+        if not snap.exists or (snap.to_dict() or {}).get('status') != 'queued':
+            return False
+        transaction.update(ref, {'status': 'claimed', 'worker': worker_id(),
+                                 'claimed_at': _now()})
+        return True
+
+    return take(db.transaction())
+
+
+def run_queued():
+    """Fail abandoned runs, then execute manually enqueued runs, oldest first."""
+    runs = _db().collection(RUNS_COLLECTION)
+    try:
+        for name in JOBS:
+            _reap(name)
+        _reap_claimed(runs.where('status', '==', 'claimed').limit(50).stream())
+    except Exception as e:
+        print(f"Scheduler: stale run check failed: {e}")
+    try:
+        snaps = list(runs.where('status', '==', 'queued').limit(10).stream())
+    except Exception as e:
+        print(f"Scheduler: queue poll failed: {e}")
+        return
+    snaps.sort(key=lambda s: (s.to_dict() or {}).get('created_at') or _EPOCH)
+    for snap in snaps:
+        name = (snap.to_dict() or {}).get('job')
+        if name not in JOBS:
+            snap.reference.update({'status': 'failed', 'error': f'Unknown job {name}'})
+            continue
+        try:
+            if not _take_queued(snap.id):
+                continue
+        except Exception as e:
+            print(f"Scheduler: could not take run {snap.id}: {e}")
+            continue
+        if run_job(name, trigger='manual', run_id=snap.id, force=True) is None:
+            # Another run of this job holds the lease; retry on the next poll
+            snap.reference.update({'status': 'queued', 'worker': None, 'claimed_at': None})
+
+
+def enqueue(name: str, requested_by: Optional[str] = None) -> Dict[str, Any]:
+    """Queue a manual run, or return the run already waiting for this job."""
+    from firebase_admin import firestore
+    if name not in JOBS:
+        raise ValueError(f"Unknown job '{name}'")
+    runs = _db().collection(RUNS_COLLECTION)
+    for snap in runs.where('job', '==', name).where('status', '==', 'queued').limit(1).stream():
+        return {'run_id': snap.id, 'job': name, 'status': 'queued', 'already_queued': True}
+
+    ref = runs.document()
+    ref.set({
+        'job': name,
+        'trigger': 'manual',
+        'status': 'queued',
+        'requested_by': requested_by,
+        'created_at': firestore.SERVER_TIMESTAMP,
+    })
+    _nudge()
+    return {'run_id': ref.id, 'job': name, 'status': 'queued', 'already_queued': False}
+
+
+def _nudge():
+    """Poll the queue now if this process runs the scheduler."""
+    if _scheduler is None:
+        return
+    try:
+        _scheduler.modify_job(QUEUE_JOB_ID, next_run_time=_now())
+    except Exception as e:
+        print(f"Scheduler: nudge failed: {e}")
+
+
+def get_run(run_id: str) -> Optional[Dict[str, Any]]:
+    snap = _db().collection(RUNS_COLLECTION).document(run_id).get()
+    if not snap.exists:
+        return None
+    return {'id': snap.id, **(snap.to_dict() or {})}
+
+
+def recent_runs(limit: int = 20) -> List[Dict[str, Any]]:
+    query = _db().collection(RUNS_COLLECTION).order_by('created_at', direction='DESCENDING')
+    return [{'id': snap.id, **(snap.to_dict() or {})} for snap in query.limit(limit).stream()]
+
+
+def register_jobs(scheduler):
+    """Add the coordinated jobs and the manual-run queue poller to `scheduler`."""
+    global _scheduler
+    for name, job in JOBS.items():
+        scheduler.add_job(run_job, 'interval', args=[name], id=name,
+                          seconds=job['interval_seconds'], start_date=_EPOCH,
+                          jitter=Config.SCHEDULER_JITTER_SECONDS,
+                          max_instances=1, coalesce=True)
+    scheduler.add_job(run_queued, 'interval', id=QUEUE_JOB_ID,
+                      seconds=Config.SCHEDULER_POLL_SECONDS,
+                      jitter=max(1, Config.SCHEDULER_POLL_SECONDS // 3),
+                      max_instances=1, coalesce=True)
+    _scheduler = scheduler
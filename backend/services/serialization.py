@@ -0,0 +1,200 @@
+"""Response encoding: orjson for JSON, optional MessagePack, gzip/brotli.
+
+- `OrjsonProvider` replaces Flask's JSON provider when orjson is installed,
+  so every `jsonify` gets the fast encoder. Keys are still sorted and
+  datetimes (including Firestore's `DatetimeWithNanoseconds`) are still HTTP
+  dates, but the output is not byte-identical to the stdlib encoder's:
+  non-ASCII text is written as UTF-8 instead of `\\uXXXX` escapes (the same
+  JSON to any parser). Values orjson can't encode, such as integers wider
+  than 64 bits, fall back to the stdlib encoder. `GeoPoint` becomes
+  `{latitude, longitude}` and document references their path.
+- `negotiated(payload)` returns MessagePack instead of JSON when the client
+  asks for `application/msgpack` (timestamps use the msgpack Timestamp
+  extension).
+- Responses over `COMPRESS_MIN_BYTES` are compressed with brotli (if the
+  `brotli` package is installed) or gzip, per `Accept-Encoding`.
+"""
+from datetime import date, datetime, time, timezone
+from flask import current_app, jsonify, request
+from flask.json.provider import DefaultJSONProvider
+from services import tracing
+import decimal
+import gzip
+
+import msgpack
+
+try:
+    import orjson
+except ImportError:  # Optional dependency; falls back to Flask's stdlib encoder
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # Optional dependency; gzip only without it
+    brotli = None
+
+
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack')
+
+COMPRESSIBLE_MIMETYPES = {
+    'application/json', 'application/msgpack', 'application/x-msgpack',
+    'application/x-ndjson', 'text/csv', 'text/html', 'text/plain',
+}
+
+
+def _firestore_value(o):
+    """GeoPoint / DocumentReference as plain values, else NotImplemented."""
+    if hasattr(o, 'latitude') and hasattr(o, 'longitude'):
+        return {'latitude': o.latitude, 'longitude': o.longitude}
+    if hasattr(o, 'path') and hasattr(o, 'parent') and hasattr(o, 'id'):
+        return o.path
+    return NotImplemented
+
+
+_DAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+           'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+def _http_date(d: date) -> str:
+    """Same output as werkzeug's http_date, without the email.utils round trip."""
+    if not isinstance(d, datetime):
+        d = datetime.combine(d, time(), tzinfo=timezone.utc)
+    elif d.tzinfo is None:
+        d = d.replace(tzinfo=timezone.utc)
+    elif d.utcoffset():
+        d = d.astimezone(timezone.utc)
+    return (f"{_DAYS[d.weekday()]}, {d.day:02d} {_MONTHS[d.month - 1]} {d.year:04d} "
+            f"{d.hour:02d}:{d.minute:02d}:{d.second:02d} GMT")
+
+
+def _json_default(o):
+    # OPT_PASSTHROUGH_DATETIME routes every datetime here, so plain and
+    # Firestore timestamps keep the format Flask's encoder used
+    if isinstance(o, date):
+        return _http_date(o)
+    if isinstance(o, decimal.Decimal):
+        return str(o)
+    if hasattr(o, '__html__'):
+        return str(o.__html__())
+    if hasattr(o, 'item'):  # numpy scalars
+        return o.item()
+    value = _firestore_value(o)
+    if value is not NotImplemented:
+        return value
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider that encodes with orjson; parsing is unchanged."""
+
+    # Also used by the stdlib fallback, so both encode the same types alike
+    default = staticmethod(_json_default)
+
+    def _options(self, indent: bool = False) -> int:
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS | \
+            orjson.OPT_SERIALIZE_NUMPY
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumps(self, obj, **kwargs) -> str:
+        if kwargs:
+            # Callers asking for json.dumps options get the stdlib encoder
+            return super().dumps(obj, **kwargs)
+        try:
+            return orjson.dumps(obj, default=_json_default, option=self._options()).decode('utf-8')
+        except orjson.JSONEncodeError:
+            # e.g. integers beyond 64 bits, which the stdlib encoder handles
+            return super().dumps(obj)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        try:
+            body = orjson.dumps(obj, default=_json_default,
+                                option=self._options(indent) | orjson.OPT_APPEND_NEWLINE)
+        except orjson.JSONEncodeError:
+            return super().response(obj)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+def _msgpack_default(o):
+    if isinstance(o, datetime):
+        if o.tzinfo is None:
+            o = o.replace(tzinfo=timezone.utc)
+        return msgpack.Timestamp.from_datetime(o)
+    if isinstance(o, date):
+        return o.isoformat()
+    if isinstance(o, decimal.Decimal):
+        return str(o)
+    if hasattr(o, 'item'):
+        return o.item()
+    value = _firestore_value(o)
+    if value is not NotImplemented:
+        return value
+    raise TypeError(f"Object of type {type(o).__name__} is not MessagePack serializable")
+
+
+def wants_msgpack() -> bool:
+    best = request.accept_mimetypes.best_match(('application/json',) + MSGPACK_MIMETYPES)
+    return best in MSGPACK_MIMETYPES
+
+
+def negotiated(payload):
+    """`jsonify(payload)`, or MessagePack when the client prefers it."""
+    if not wants_msgpack():
+        return jsonify(payload)
+    body = msgpack.packb(payload, default=_msgpack_default, datetime=False)
+    response = current_app.response_class(body, mimetype='application/msgpack')
+    response.vary.add('Accept')
+    return response
+
+
+def _encoding_for(accept) -> str:
+    if brotli is not None and accept['br']:
+        return 'br'
+    if accept['gzip']:
+        return 'gzip'
+    return ''
+
+
+def compress_response(response):
+    """after_request hook: compress large buffered bodies the client accepts."""
+    cfg = current_app.config
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code in (204, 206, 304)
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.content_length is not None and response.content_length < cfg['COMPRESS_MIN_BYTES']:
+        return response
+    encoding = _encoding_for(request.accept_encodings)
+    if not encoding:
+        return response
+
+    body = response.get_data()
+    if len(body) < cfg['COMPRESS_MIN_BYTES']:
+        return response
+    with tracing.span('compress', encoding=encoding):
+        if encoding == 'br':
+            compressed = brotli.compress(body, quality=cfg['BROTLI_QUALITY'])
+        else:
+            compressed = gzip.compress(body, compresslevel=cfg['GZIP_LEVEL'], mtime=0)
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def init_app(app):
+    """Install the orjson provider and the compression hook."""
+    if orjson is not None:
+        app.json_provider_class = OrjsonProvider
+        app.json = OrjsonProvider(app)
+    else:
+        print("orjson not installed; using the standard JSON encoder")
+    if app.config['COMPRESSION_ENABLED']:
+        app.after_request(compress_response)
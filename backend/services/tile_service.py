@@ -0,0 +1,333 @@
+"""Server-side clustering of issue locations into slippy-map tiles.
+
+Points are projected to Web Mercator and kept sorted by a Morton (Z-order)
+code at INDEX_ZOOM, so every tile at z <= INDEX_ZOOM is one contiguous range
+found with two binary searches. Each tile is clustered on a fixed grid, which
+bounds the payload regardless of how many issues fall inside it. Rendered
+tiles are cached and dropped individually when an issue inside them changes.
+
+The write hooks keep the index current; a periodic rescan in a background
+thread picks up direct frontend writes and deletions, while requests keep
+using the index it replaces.
+"""
+from config import Config
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+import math
+import threading
+import time
+import numpy as np
+
+
+INDEX_ZOOM = 16
+MAX_ZOOM = 22
+_MAX_LAT = 85.05112878
+
+
+def _project(lat, lng) -> Tuple[np.ndarray, np.ndarray]:
+    """Lat/lng (degrees) to normalized Web Mercator x, y in [0, 1)."""
+    lat = np.clip(np.asarray(lat, dtype=np.float64), -_MAX_LAT, _MAX_LAT)
+    lng = np.asarray(lng, dtype=np.float64)
+    x = (lng + 180.0) / 360.0
+    s = np.sin(np.radians(lat))
+    y = 0.5 - np.log((1 + s) / (1 - s)) / (4 * math.pi)
+    eps = 1e-12
+    return np.clip(x, 0, 1 - eps), np.clip(y, 0, 1 - eps)
+
+
+def _spread_bits(v: np.ndarray) -> np.ndarray:
+    v = v.astype(np.uint64) & np.uint64(0xFFFF)
+    v = (v | (v << np.uint64(8))) & np.uint64(0x00FF00FF)
+    v = (v | (v << np.uint64(4))) & np.uint64(0x0F0F0F0F)
+    v = (v | (v << np.uint64(2))) & np.uint64(0x33333333)
+    v = (v | (v << np.uint64(1))) & np.uint64(0x55555555)
+    return v
+
+
+def _morton(tx: np.ndarray, ty: np.ndarray) -> np.ndarray:
+    return _spread_bits(tx) | (_spread_bits(ty) << np.uint64(1))
+
+
+def _tile_of(x: float, y: float, z: int) -> Tuple[int, int]:
+    n = 1 << z
+    return int(x * n), int(y * n)
+
+
+def tile_bounds(z: int, x: int, y: int) -> Dict[str, float]:
+    n = 1 << z
+
+    def lat_of(ty):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * ty / n))))
+    return {
+        'west': x / n * 360.0 - 180.0, 'east': (x + 1) / n * 360.0 - 180.0,
+        'north': lat_of(y), 'south': lat_of(y + 1),
+    }
+
+
+class TileIndex:
+    """Morton-sorted point arrays plus a per-tile LRU of rendered payloads."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.built_at = 0.0
+        # ids upserted while a rescan is running, None when none is
+        self._touched: Optional[set] = None
+        self._set_points([], [], [], [], [])
+        self.cache: 'OrderedDict[Tuple, Dict[str, Any]]' = OrderedDict()
+        self.cache_by_tile: Dict[Tuple[int, int, int], set] = {}
+        self.hits = 0
+        self.misses = 0
+
+    # ----- point storage -----
+
+    def _set_points(self, ids, lats, lngs, statuses, types):
+        x, y = _project(lats, lngs)
+        n = 1 << INDEX_ZOOM
+        codes = _morton((x * n).astype(np.uint64), (y * n).astype(np.uint64))
+        order = np.argsort(codes, kind='stable')
+        self.codes = codes[order]
+        self.x = x[order]
+        self.y = y[order]
+        self.lat = np.asarray(lats, dtype=np.float64)[order]
+        self.lng = np.asarray(lngs, dtype=np.float64)[order]
+        self.ids = np.asarray(ids, dtype=object)[order]
+        self.status = np.asarray(statuses, dtype=object)[order]
+        self.type = np.asarray(types, dtype=object)[order]
+
+    def _rows(self) -> Dict[str, Tuple[str, float, float, str, str]]:
+        return {row[0]: row for row in zip(self.ids.tolist(), self.lat.tolist(), self.lng.tolist(),
+                                           self.status.tolist(), self.type.tolist())}
+
+    def begin_load(self):
+        """Start remembering upserts, so the scan about to run can't undo them."""
+        with self.lock:
+            self._touched = set()
+
+    def cancel_load(self):
+        with self.lock:
+            self._touched = None
+
+    def load(self, rows: List[Tuple[str, float, float, str, str]]):
+        """Swap in scanned points, dropping only the cached tiles that changed."""
+        with self.lock:
+            old = self._rows()
+            new = {row[0]: row for row in rows}
+            # Hook updates that landed after the scan read the document win
+            for doc_id in self._touched or ():
+                if doc_id in old:
+                    new[doc_id] = old[doc_id]
+            self._touched = None
+            columns = (list(c) for c in zip(*new.values())) if new else ([], [], [], [], [])
+            self._set_points(*columns)
+            if not self.built_at:
+                self.cache.clear()
+                self.cache_by_tile.clear()
+            else:
+                for doc_id in old.keys() | new.keys():
+                    before, after = old.get(doc_id), new.get(doc_id)
+                    if before == after:
+                        continue
+                    for row in (before, after):
+                        if row:
+                            x, y = _project([row[1]], [row[2]])
+                            self._invalidate_point(float(x[0]), float(y[0]))
+            self.built_at = time.time()
+
+    def _remove(self, doc_id: str) -> Optional[Tuple[float, float]]:
+        hit = np.nonzero(self.ids == doc_id)[0]
+        if hit.size == 0:
+            return None
+        i = int(hit[0])
+        old = (float(self.x[i]), float(self.y[i]))
+        for name in ('codes', 'x', 'y', 'lat', 'lng', 'ids', 'status', 'type'):
+            setattr(self, name, np.delete(getattr(self, name), i))
+        return old
+
+    def upsert(self, doc_id: str, lat: float, lng: float, status: str, itype: str):
+        with self.lock:
+            if self._touched is not None:
+                self._touched.add(doc_id)
+            old = self._remove(doc_id)
+            x, y = _project([lat], [lng])
+            n = 1 << INDEX_ZOOM
+            code = _morton((x * n).astype(np.uint64), (y * n).astype(np.uint64))
+            i = int(np.searchsorted(self.codes, code[0], side='right'))
+            self.codes = np.insert(self.codes, i, code[0])
+            self.x = np.insert(self.x, i, x[0])
+            self.y = np.insert(self.y, i, y[0])
+            self.lat = np.insert(self.lat, i, float(lat))
+            self.lng = np.insert(self.lng, i, float(lng))
+            self.ids = np.insert(self.ids, i, doc_id)
+            self.status = np.insert(self.status, i, status)
+            self.type = np.insert(self.type, i, itype)
+            if old:
+                self._invalidate_point(*old)
+            self._invalidate_point(float(x[0]), float(y[0]))
+
+    def _invalidate_point(self, x: float, y: float):
+        for z in range(MAX_ZOOM + 1):
+            for key in self.cache_by_tile.pop((z, *_tile_of(x, y, z)), ()):
+                self.cache.pop(key, None)
+
+    # ----- tile rendering -----
+
+    def _range(self, z: int, tx: int, ty: int) -> Tuple[int, int]:
+        if z <= INDEX_ZOOM:
+            shift = np.uint64(2 * (INDEX_ZOOM - z))
+            lo = _morton(np.array([tx]), np.array([ty]))[0] << shift
+            hi = (_morton(np.array([tx]), np.array([ty]))[0] + np.uint64(1)) << shift
+        else:
+            # Deeper than the index: take the parent range and filter below
+            d = z - INDEX_ZOOM
+            lo = _morton(np.array([tx >> d]), np.array([ty >> d]))[0]
+            hi = lo + np.uint64(1)
+        return (int(np.searchsorted(self.codes, lo, side='left')),
+                int(np.searchsorted(self.codes, hi, side='left')))
+
+    def render(self, z: int, tx: int, ty: int, status: Optional[str] = None,
+               itype: Optional[str] = None, mode: str = 'clusters') -> Dict[str, Any]:
+        key = (z, tx, ty, status, itype, mode)
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return cached
+            self.misses += 1
+
+            lo, hi = self._range(z, tx, ty)
+            n = 1 << z
+            px = self.x[lo:hi] * n - tx
+            py = self.y[lo:hi] * n - ty
+            mask = (px >= 0) & (px < 1) & (py >= 0) & (py < 1)
+            if status:
+                mask &= self.status[lo:hi] == status.lower()
+            if itype:
+                mask &= self.type[lo:hi] == itype
+            idx = np.nonzero(mask)[0]
+
+            grid = Config.TILE_CLUSTER_GRID * (2 if mode == 'heat' else 1)
+            payload: Dict[str, Any] = {'z': z, 'x': tx, 'y': ty,
+                                       'bounds': tile_bounds(z, tx, ty),
+                                       'total': int(idx.size), 'grid': grid}
+            if idx.size:
+                cx = np.minimum((px[idx] * grid).astype(np.int64), grid - 1)
+                cy = np.minimum((py[idx] * grid).astype(np.int64), grid - 1)
+                cell = cy * grid + cx
+                cells, first, inverse, counts = np.unique(
+                    cell, return_index=True, return_inverse=True, return_counts=True)
+                lat = self.lat[lo:hi][idx]
+                lng = self.lng[lo:hi][idx]
+                c_lat = np.bincount(inverse, weights=lat) / counts
+                c_lng = np.bincount(inverse, weights=lng) / counts
+                if mode == 'heat':
+                    payload['points'] = [[round(a, 5), round(b, 5), int(c)] for a, b, c in
+                                         zip(c_lat.tolist(), c_lng.tolist(), counts.tolist())]
+                else:
+                    rep_ids = self.ids[lo:hi][idx][first]
+                    payload['clusters'] = [
+                        {'lat': round(a, 6), 'lng': round(b, 6), 'count': int(c), 'id': rid}
+                        for a, b, c, rid in zip(c_lat.tolist(), c_lng.tolist(),
+                                                counts.tolist(), rep_ids.tolist())
+                    ]
+            elif mode == 'heat':
+                payload['points'] = []
+            else:
+                payload['clusters'] = []
+
+            self.cache[key] = payload
+            self.cache_by_tile.setdefault((z, tx, ty), set()).add(key)
+            while len(self.cache) > Config.TILE_CACHE_SIZE:
+                old_key, _ = self.cache.popitem(last=False)
+                self.cache_by_tile.get(old_key[:3], set()).discard(old_key)
+            return payload
+
+
+_index = TileIndex()
+_build_lock = threading.Lock()
+_last_attempt = 0.0
+
+
+def _point_from(doc_id: str, data: Dict[str, Any]):
+    loc = data.get('location') or {}
+    lat = loc.get('lat')
+    lng = loc.get('lng') if loc.get('lng') is not None else loc.get('lon')
+    try:
+        lat, lng = float(lat), float(lng)
+    except (TypeError, ValueError):
+        return None
+    itype = data.get('category') or data.get('type') or 'Other'
+    status = str(data.get('status') or 'pending').lower()
+    return (doc_id, lat, lng, status, str(itype))
+
+
+def rebuild_index(collections=('complaints', 'issues')) -> int:
+    """Reload all issue locations from Firestore into the tile index."""
+    from services.firebase_service import get_firestore
+    db = get_firestore()
+    rows = []
+    _index.begin_load()
+    try:
+        for name in collections:
+            for doc in db.collection(name).select(['location', 'status', 'type', 'category']).stream():
+                point = _point_from(doc.id, doc.to_dict() or {})
+                if point:
+                    rows.append(point)
+    except Exception:
+        _index.cancel_load()
+        raise
+    _index.load(rows)
+    return len(rows)
+
+
+def _refresh():
+    """Background rescan; requests keep using the current index meanwhile."""
+    global _last_attempt
+    if not _build_lock.acquire(blocking=False):
+        return  # another rescan is running
+    try:
+        if time.time() - max(_index.built_at, _last_attempt) >= Config.TILE_INDEX_TTL_SECONDS:
+            _last_attempt = time.time()
+            rebuild_index()
+    except Exception as e:
+        print(f"Tile index refresh error: {e}")
+    finally:
+        _build_lock.release()
+
+
+def _ensure_fresh():
+    if not _index.built_at:
+        # Nothing to serve yet: the first build runs inline
+        with _build_lock:
+            if not _index.built_at:
+                rebuild_index()
+        return
+    # Direct frontend writes to `issues` bypass the hooks; a periodic rescan picks them up
+    if time.time() - max(_index.built_at, _last_attempt) >= Config.TILE_INDEX_TTL_SECONDS \
+            and not _build_lock.locked():
+        threading.Thread(target=_refresh, name='tile-index-refresh', daemon=True).start()
+
+
+def get_tile(z: int, x: int, y: int, status: Optional[str] = None,
+             itype: Optional[str] = None, mode: str = 'clusters') -> Dict[str, Any]:
+    if not (0 <= z <= MAX_ZOOM) or not (0 <= x < (1 << z)) or not (0 <= y < (1 << z)):
+        raise ValueError('Tile coordinates out of range')
+    _ensure_fresh()
+    return _index.render(z, x, y, status, itype, mode)
+
+
+def on_issue_changed(doc_id: str, data: Dict[str, Any]):
+    """Apply a created/updated issue to the index and drop affected tiles."""
+    try:
+        if not _index.built_at:
+            return
+        point = _point_from(doc_id, data)
+        if point:
+            _index.upsert(*point)
+    except Exception as e:
+        print(f"Tile index update error: {e}")
+
+
+def cache_stats() -> Dict[str, Any]:
+    return {'hits': _index.hits, 'misses': _index.misses,
+            'size': len(_index.cache), 'points': int(_index.ids.size)}
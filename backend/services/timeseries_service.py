@@ -0,0 +1,499 @@
+"""Pre-aggregated time-series rollups for trend analytics.
+
+Issues are counted into hourly and daily buckets keyed by
+(category, status, geocell). Each granularity is a NumPy ring buffer of
+shape (keys, window) so queries are a handful of vectorized sums instead of
+a scan over raw documents. The engine is updated incrementally as issues
+arrive or change status and is persisted as compact sparse snapshots under
+the `rollups` collection:
+
+- `rollups/{hourly,daily}` is the base, written only by a full rebuild and
+  tagged with a `generation` id;
+- every process writes the events it recorded since loading to its own
+  shard, `rollups/{name}@{worker}`, tagged with the base generation.
+
+Loading sums the base and every shard of its generation, so workers never
+overwrite each other's counts. A rebuild starts a new generation; older
+shards are ignored and deleted.
+"""
+from config import Config
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import threading
+import uuid
+import zlib
+import numpy as np
+
+
+GRANULARITIES = {
+    'hourly': (3600, Config.ROLLUP_HOURLY_WINDOW),
+    'daily': (86400, Config.ROLLUP_DAILY_WINDOW),
+}
+KEY_FIELDS = ('category', 'status', 'geocell')
+_KEY_SEP = '|'
+COLLECTION = 'rollups'
+
+
+class RollupSeries:
+    """Fixed-window ring buffer of counts per key for one bucket size."""
+
+    def __init__(self, bucket_seconds: int, window: int, capacity: int = 64):
+        self.bucket_seconds = int(bucket_seconds)
+        self.window = int(window)
+        self.keys: Dict[Tuple[str, str, str], int] = {}
+        self.key_list: List[Tuple[str, str, str]] = []
+        self.counts = np.zeros((capacity, self.window), dtype=np.int32)
+        # Absolute bucket number currently stored in each slot (-1 = empty)
+        self.slot_bucket = np.full(self.window, -1, dtype=np.int64)
+        self.latest_bucket = -1
+
+    def _row(self, key: Tuple[str, str, str]) -> int:
+        row = self.keys.get(key)
+        if row is not None:
+            return row
+        row = len(self.key_list)
+        if row >= self.counts.shape[0]:
+            grown = np.zeros((self.counts.shape[0] * 2, self.window), dtype=np.int32)
+            grown[:self.counts.shape[0]] = self.counts
+            self.counts = grown
+        self.keys[key] = row
+        self.key_list.append(key)
+        return row
+
+    def _claim_slots(self, buckets: np.ndarray) -> np.ndarray:
+        """Map absolute buckets to slots, recycling slots that hold stale buckets.
+
+        Returns a boolean mask of buckets that still fall inside the window.
+        """
+        newest = int(buckets.max())
+        if newest > self.latest_bucket:
+            self.latest_bucket = newest
+        in_window = buckets > self.latest_bucket - self.window
+        for b in np.unique(buckets[in_window]):
+            slot = int(b % self.window)
+            if self.slot_bucket[slot] != b:
+                self.counts[:, slot] = 0
+                self.slot_bucket[slot] = b
+        return in_window
+
+    def add(self, epoch_seconds: float, key: Tuple[str, str, str], n: int = 1):
+        self.add_many(np.array([epoch_seconds], dtype=np.float64), [key],
+                      np.array([n], dtype=np.int32))
+
+    def add_many(self, epochs: np.ndarray, keys: List[Tuple[str, str, str]],
+                 weights: Optional[np.ndarray] = None):
+        if len(keys) == 0:
+            return
+        buckets = (np.asarray(epochs, dtype=np.float64) //
+                   self.bucket_seconds).astype(np.int64)
+        rows = np.fromiter((self._row(k) for k in keys),
+                           dtype=np.int64, count=len(keys))
+        if weights is None:
+            weights = np.ones(len(keys), dtype=np.int32)
+        mask = self._claim_slots(buckets)
+        np.add.at(self.counts, (rows[mask], buckets[mask] % self.window),
+                  weights[mask])
+
+    def query(self, start_epoch: float, end_epoch: float,
+              filters: Optional[Dict[str, str]] = None,
+              group_by: Optional[str] = None) -> Dict[str, Any]:
+        """Sum matching keys per bucket between start and end (inclusive)."""
+        first = int(start_epoch // self.bucket_seconds)
+        last = int(end_epoch // self.bucket_seconds)
+        first = max(first, last - self.window + 1)
+        buckets = np.arange(first, last + 1, dtype=np.int64)
+        slots = buckets % self.window
+        live = self.slot_bucket[slots] == buckets
+
+        n_keys = len(self.key_list)
+        mask = np.ones(n_keys, dtype=bool)
+        for field, value in (filters or {}).items():
+            if value is None:
+                continue
+            idx = KEY_FIELDS.index(field)
+            mask &= np.fromiter((k[idx] == value for k in self.key_list),
+                                dtype=bool, count=n_keys)
+
+        window = self.counts[:n_keys][:, slots] * live
+        series: Dict[str, List[int]] = {}
+        if group_by in KEY_FIELDS:
+            idx = KEY_FIELDS.index(group_by)
+            labels = np.array([k[idx] for k in self.key_list], dtype=object)
+            for label in sorted(set(labels[mask])):
+                rows = mask & (labels == label)
+                series[label] = window[rows].sum(axis=0).astype(int).tolist()
+        else:
+            series['total'] = window[mask].sum(axis=0).astype(int).tolist()
+
+        return {
+            'bucket_seconds': self.bucket_seconds,
+            'buckets': [_iso(b * self.bucket_seconds) for b in buckets.tolist()],
+            'series': series,
+        }
+
+    def to_snapshot(self) -> Dict[str, Any]:
+        """Sparse, zlib-compressed representation suitable for one Firestore doc."""
+        n_keys = len(self.key_list)
+        rows, slots = np.nonzero(self.counts[:n_keys])
+        values = self.counts[rows, slots]
+        return {
+            'bucket_seconds': self.bucket_seconds,
+            'window': self.window,
+            'keys': [_KEY_SEP.join(k) for k in self.key_list],
+            'rows': zlib.compress(rows.astype(np.int32).tobytes()),
+            'slots': zlib.compress(slots.astype(np.int32).tobytes()),
+            'values': zlib.compress(values.astype(np.int32).tobytes()),
+            'slot_bucket': zlib.compress(self.slot_bucket.tobytes()),
+            'latest_bucket': int(self.latest_bucket),
+        }
+
+    def merge(self, other: 'RollupSeries'):
+        """Add another series' counts (same bucket size) into this one."""
+        n_keys = len(other.key_list)
+        rows, slots = np.nonzero(other.counts[:n_keys])
+        live = other.slot_bucket[slots] >= 0
+        rows, slots = rows[live], slots[live]
+        if len(rows) == 0:
+            return
+        epochs = (other.slot_bucket[slots] * other.bucket_seconds).astype(np.float64)
+        self.add_many(epochs, [other.key_list[r] for r in rows.tolist()],
+                      other.counts[rows, slots].astype(np.int32))
+
+    @classmethod
+    def from_snapshot(cls, snap: Dict[str, Any]) -> 'RollupSeries':
+        keys = [tuple(k.split(_KEY_SEP)) for k in snap.get('keys') or []]
+        series = cls(snap['bucket_seconds'], snap['window'],
+                     capacity=max(64, len(keys)))
+        for k in keys:
+            series._row(k)  # type: ignore[arg-type]
+        rows = np.frombuffer(zlib.decompress(snap['rows']), dtype=np.int32)
+        slots = np.frombuffer(zlib.decompress(snap['slots']), dtype=np.int32)
+        values = np.frombuffer(zlib.decompress(snap['values']), dtype=np.int32)
+        series.counts[rows, slots] = values
+        series.slot_bucket = np.frombuffer(
+            zlib.decompress(snap['slot_bucket']), dtype=np.int64).copy()
+        series.latest_bucket = int(snap.get('latest_bucket', -1))
+        return series
+
+
+_lock = threading.Lock()
+# Everything known to this process: base + shards at load + _delta
+_series: Dict[str, RollupSeries] = {}
+# Events recorded by this process since the base generation was loaded
+_delta: Dict[str, RollupSeries] = {}
+_generation: Optional[str] = None
+_worker_id = uuid.uuid4().hex[:12]
+_loaded = False
+_dirty = False
+_pending: List[Tuple[float, Tuple[str, str, str], int]] = []
+
+
+# --------------------- Key extraction ---------------------
+
+def _iso(epoch_seconds: float) -> str:
+    return datetime.fromtimestamp(epoch_seconds, tz=timezone.utc).isoformat()
+
+
+def _to_epoch(value) -> Optional[float]:
+    """Accept Firestore timestamps, datetimes or ISO strings; sentinels yield None."""
+    if value is None:
+        return None
+    try:
+        if hasattr(value, 'timestamp') and callable(value.timestamp):
+            if isinstance(value, datetime) and value.tzinfo is None:
+                value = value.replace(tzinfo=timezone.utc)
+            return float(value.timestamp())
+        if isinstance(value, (int, float)):
+            return float(value)
+        if isinstance(value, str):
+            dt = datetime.fromisoformat(value.replace('Z', '+00:00'))
+            if dt.tzinfo is None:
+                dt = dt.replace(tzinfo=timezone.utc)
+            return dt.timestamp()
+    except Exception:
+        return None
+    return None
+
+
+def geocell(lat, lng) -> str:
+    """Grid cell label for a coordinate (Config.ROLLUP_GEOCELL_PRECISION decimals)."""
+    try:
+        p = Config.ROLLUP_GEOCELL_PRECISION
+        return f"{round(float(lat), p):.{p}f},{round(float(lng), p):.{p}f}"
+    except (TypeError, ValueError):
+        return 'unknown'
+
+
+def _key_for(data: Dict[str, Any], status: Optional[str] = None) -> Tuple[str, str, str]:
+    tags = data.get('tags') or []
+    category = data.get('category') or data.get('type') or (
+        tags[0] if tags else 'Other')
+    status = status if status is not None else data.get('status')
+    loc = data.get('location') or {}
+    lng = loc.get('lng') if loc.get('lng') is not None else loc.get('lon')
+    return (str(category), str(status or 'pending').lower(), geocell(loc.get('lat'), lng))
+
+
+# --------------------- Incremental updates ---------------------
+
+def _apply(events: List[Tuple[float, Tuple[str, str, str], int]]):
+    global _dirty
+    if not events:
+        return
+    epochs = np.array([e[0] for e in events], dtype=np.float64)
+    keys = [e[1] for e in events]
+    weights = np.array([e[2] for e in events], dtype=np.int32)
+    for series in (*_series.values(), *_delta.values()):
+        series.add_many(epochs, keys, weights)
+    _dirty = True
+
+
+def _record(events: List[Tuple[float, Tuple[str, str, str], int]]):
+    with _lock:
+        if _loaded:
+            _apply(events)
+        else:
+            _pending.extend(events)
+
+
+def _created_epoch(data: Dict[str, Any]) -> float:
+    created = _to_epoch(data.get('created_at') or data.get('createdAt'))
+    return created if created is not None else datetime.now(timezone.utc).timestamp()
+
+
+def record_issue(data: Dict[str, Any]):
+    """Count a newly created issue/complaint in its creation bucket."""
+    try:
+        _record([(_created_epoch(data), _key_for(data), 1)])
+    except Exception as e:
+        print(f"Rollup record error: {e}")
+
+
+def record_status_change(data: Dict[str, Any], new_status: str):
+    """Move an existing issue from its current status to `new_status`.
+
+    Rollups count issues by creation bucket and *current* status, so a
+    transition is a -1/+1 pair in the bucket the issue was created in.
+    """
+    try:
+        old_key = _key_for(data)
+        new_key = _key_for(data, status=new_status)
+        if old_key == new_key:
+            return
+        epoch = _created_epoch(data)
+        _record([(epoch, old_key, -1), (epoch, new_key, 1)])
+    except Exception as e:
+        print(f"Rollup record error: {e}")
+
+
+# --------------------- Load / rebuild / persist ---------------------
+
+def _fresh_series() -> Dict[str, RollupSeries]:
+    return {name: RollupSeries(secs, window)
+            for name, (secs, window) in GRANULARITIES.items()}
+
+
+def _shard_id(name: str, worker_id: str) -> str:
+    return f'{name}@{worker_id}'
+
+
+def rebuild_from_firestore(collections: Iterable[str] = ('complaints', 'issues')) -> int:
+    """Recompute all rollups from source documents. Returns documents counted."""
+    global _series, _delta, _generation, _loaded, _dirty
+    from services.firebase_service import get_firestore
+    db = get_firestore()
+    fields = ['category', 'type', 'tags', 'status', 'location',
+              'created_at', 'createdAt']
+
+    epochs: List[float] = []
+    keys: List[Tuple[str, str, str]] = []
+    for name in collections:
+        for doc in db.collection(name).select(fields).stream():
+            data = doc.to_dict() or {}
+            epoch = _to_epoch(data.get('created_at') or data.get('createdAt'))
+            if epoch is None:
+                continue
+            epochs.append(epoch)
+            keys.append(_key_for(data))
+
+    fresh = _fresh_series()
+    if keys:
+        arr = np.array(epochs, dtype=np.float64)
+        for series in fresh.values():
+            series.add_many(arr, keys)
+
+    generation = uuid.uuid4().hex
+    batch = db.batch()
+    for name, series in fresh.items():
+        snap = series.to_snapshot()
+        snap.update({'generation': generation, 'updated_at': datetime.now(timezone.utc)})
+        batch.set(db.collection(COLLECTION).document(name), snap)
+    batch.commit()
+
+    with _lock:
+        _series = fresh
+        _delta = _fresh_series()
+        _generation = generation
+        _loaded = True
+        _dirty = False
+        # Source scan already saw anything created while it ran
+        _pending.clear()
+    _delete_stale_shards(generation)
+    return len(keys)
+
+
+def _delete_stale_shards(generation: str):
+    from services.firebase_service import get_firestore
+    try:
+        db = get_firestore()
+        for name in GRANULARITIES:
+            for doc in db.collection(COLLECTION).where('shard_of', '==', name).select(
+                    ['generation']).stream():
+                if (doc.to_dict() or {}).get('generation') != generation:
+                    doc.reference.delete()
+    except Exception as e:
+        print(f"Rollup shard cleanup error: {e}")
+
+
+def _read_stored():
+    """(generation, {name: base + other workers' shards of that generation}),
+    or None when the base is missing, predates generations or was written
+    with other window settings."""
+    from services.firebase_service import get_firestore
+    db = get_firestore()
+    bases = {snap.id: snap.to_dict() or {} for snap in db.get_all(
+        [db.collection(COLLECTION).document(name) for name in GRANULARITIES]) if snap.exists}
+    generations = {data.get('generation') for data in bases.values()}
+    if len(bases) != len(GRANULARITIES) or len(generations) != 1 or None in generations:
+        return None
+    merged = {}
+    for name, (secs, window) in GRANULARITIES.items():
+        data = bases[name]
+        if data.get('bucket_seconds') != secs or data.get('window') != window:
+            return None
+        merged[name] = RollupSeries.from_snapshot(data)
+    generation = generations.pop()
+    own = f'@{_worker_id}'
+    for doc in db.collection(COLLECTION).where('generation', '==', generation).stream():
+        data = doc.to_dict() or {}
+        name = data.get('shard_of')
+        # Our own shard is already in _delta, which _install adds back
+        if name in merged and not doc.id.endswith(own):
+            merged[name].merge(RollupSeries.from_snapshot(data))
+    return generation, merged
+
+
+def _install(generation, merged: Dict[str, RollupSeries]):
+    """Switch to a freshly read view, keeping this worker's own events."""
+    global _series, _delta, _generation, _loaded
+    with _lock:
+        if generation != _generation or not _delta:
+            # New base (rebuilt elsewhere): our shard belongs to the old one
+            _delta = _fresh_series()
+            _generation = generation
+        else:
+            for name, series in merged.items():
+                series.merge(_delta[name])
+        _series = merged
+        _loaded = True
+        _apply(_pending)
+        _pending.clear()
+
+
+def load_snapshots() -> bool:
+    """Load persisted rollups; falls back to a full rebuild when none exist."""
+    try:
+        stored = _read_stored()
+        if stored is None:
+            rebuild_from_firestore()
+            return True
+        _install(*stored)
+        return True
+    except Exception as e:
+        print(f"Rollup load error: {e}")
+        return False
+
+
+def start_background_load():
+    """Load or rebuild rollups off the request path at startup."""
+    threading.Thread(target=load_snapshots, name='rollup-loader',
+                     daemon=True).start()
+
+
+def persist_snapshots():
+    """Write this worker's shard if it changed, then pick up the other shards."""
+    global _dirty
+    from services.firebase_service import get_firestore
+    with _lock:
+        if not _loaded:
+            return
+        dirty, generation = _dirty, _generation
+        snaps = {name: s.to_snapshot() for name, s in _delta.items()} if dirty else {}
+        _dirty = False
+    try:
+        db = get_firestore()
+        if snaps:
+            stored = _read_stored()
+            if stored is not None and stored[0] != generation:
+                # Rebuilt by another worker since we loaded: adopt that base
+                _install(*stored)
+                return
+            batch = db.batch()
+            for name, snap in snaps.items():
+                snap.update({'shard_of': name, 'generation': generation,
+                             'updated_at': datetime.now(timezone.utc)})
+                batch.set(db.collection(COLLECTION).document(_shard_id(name, _worker_id)), snap)
+            batch.commit()
+        stored = _read_stored()
+        if stored is not None:
+            _install(*stored)
+    except Exception as e:
+        with _lock:
+            _dirty = _dirty or dirty
+        print(f"Rollup persist error: {e}")
+
+
+# --------------------- Queries ---------------------
+
+def ensure_loaded():
+    if not _loaded:
+        load_snapshots()
+
+
+def get_series(granularity: str = 'daily', days: float = 30,
+               filters: Optional[Dict[str, str]] = None,
+               group_by: Optional[str] = None) -> Dict[str, Any]:
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"granularity must be one of {sorted(GRANULARITIES)}")
+    ensure_loaded()
+    end = datetime.now(timezone.utc).timestamp()
+    start = end - days * 86400
+    with _lock:
+        series = _series.get(granularity)
+    if series is None:
+        # Rollups couldn't be loaded (Firestore down): answer with zeros
+        secs, window = GRANULARITIES[granularity]
+        result = RollupSeries(secs, window).query(start, end, filters, group_by)
+        result['loaded'] = False
+    else:
+        with _lock:
+            result = series.query(start, end, filters, group_by)
+    result['granularity'] = granularity
+    return result
+
+
+def insight_summary(days: int = 14, top_n: int = 5) -> Dict[str, Any]:
+    """Tiny pre-aggregated view of recent activity for prompting Gemini."""
+    by_category = get_series('daily', days, group_by='category')
+    by_status = get_series('daily', days, group_by='status')
+    by_cell = get_series('daily', days, group_by='geocell')
+
+    cell_totals = sorted(((sum(v), k) for k, v in by_cell['series'].items()
+                          if k != 'unknown'), reverse=True)
+    return {
+        'period_days': days,
+        'days': [b[:10] for b in by_category['buckets']],
+        'daily_new_by_category': {k: v for k, v in by_category['series'].items() if sum(v)},
+        'status_totals': {k: int(sum(v)) for k, v in by_status['series'].items() if sum(v)},
+        'hotspots': [{'geocell': k, 'count': int(n)} for n, k in cell_totals[:top_n]],
+    }
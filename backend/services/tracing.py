@@ -0,0 +1,250 @@
+"""Per-request span tracing: Server-Timing header and a slow-request log.
+
+Spans live on `flask.g` for the duration of a request. The native async
+routes in asgi.py have no Flask request; they open a `task_trace()`, which
+keeps the trace on a context variable instead. Anywhere else (background
+threads, the scheduler, CLIs) every call here is a no-op, so services can be
+traced unconditionally:
+
+    with tracing.span('geo_query', radius_m=100):
+        ...
+
+    @tracing.traced('classify')
+    def classify_issue(...):
+
+Firestore/Storage SDK calls, Gemini calls and image downloads get spans
+automatically through services/metrics.py.
+
+Every traced response carries `Server-Timing` with the summed duration per
+span name. Requests slower than TRACE_SLOW_MS are sampled (TRACE_SAMPLE_RATE)
+into TRACE_LOG_PATH as JSON lines, one object per request with the span tree.
+"""
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from config import Config
+from functools import wraps
+from logging.handlers import RotatingFileHandler
+from time import perf_counter
+from typing import Any, Dict, List, Optional
+from flask import g, has_request_context, request
+import contextvars
+import json
+import logging
+import random
+import re
+
+
+class Span:
+    __slots__ = ('name', 'start', 'end', 'attrs', 'children')
+
+    def __init__(self, name: str, start: float, attrs: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.start = start
+        self.end: Optional[float] = None
+        self.attrs = attrs
+        self.children: List['Span'] = []
+
+    @property
+    def duration(self) -> float:
+        return ((self.end or perf_counter()) - self.start)
+
+    def to_dict(self, origin: float) -> Dict[str, Any]:
+        node: Dict[str, Any] = {
+            'name': self.name,
+            'start_ms': round((self.start - origin) * 1000, 2),
+            'duration_ms': round(self.duration * 1000, 2),
+        }
+        if self.attrs:
+            node['attrs'] = self.attrs
+        if self.children:
+            node['children'] = [child.to_dict(origin) for child in self.children]
+        return node
+
+
+class Trace:
+    __slots__ = ('root', 'stack', 'count', 'dropped')
+
+    def __init__(self):
+        self.root = Span('request', perf_counter())
+        self.stack = [self.root]
+        self.count = 1
+        self.dropped = 0
+
+
+# Trace of a native async route; asyncio tasks and asyncio.to_thread inherit it
+_task_trace: contextvars.ContextVar = contextvars.ContextVar('cityfix_trace', default=None)
+
+
+def current() -> Optional[Trace]:
+    if not has_request_context():
+        return _task_trace.get()
+    return g.get('_trace')
+
+
+@contextmanager
+def task_trace():
+    """Trace the block outside Flask; yields the Trace for `server_timing`."""
+    trace = Trace()
+    token = _task_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        trace.root.end = perf_counter()
+        _task_trace.reset(token)
+
+
+def start_span(name: str, attrs: Optional[Dict[str, Any]] = None) -> Optional[Span]:
+    trace = current()
+    if trace is None:
+        return None
+    if trace.count >= Config.TRACE_MAX_SPANS:
+        trace.dropped += 1
+        return None
+    s = Span(name, perf_counter(), attrs)
+    trace.stack[-1].children.append(s)
+    trace.stack.append(s)
+    trace.count += 1
+    return s
+
+
+def end_span(s: Optional[Span], error: Optional[BaseException] = None):
+    if s is None:
+        return
+    s.end = perf_counter()
+    if error is not None:
+        s.attrs = {**(s.attrs or {}), 'error': type(error).__name__}
+    trace = current()
+    if trace is not None and s in trace.stack:
+        # Also closes children left open by an exception
+        del trace.stack[trace.stack.index(s):]
+
+
+def add_span(name: str, start: float, duration: float, attrs: Optional[Dict[str, Any]] = None):
+    """Record an already-finished interval (e.g. time spent waiting on a stream)."""
+    trace = current()
+    if trace is None:
+        return
+    if trace.count >= Config.TRACE_MAX_SPANS:
+        trace.dropped += 1
+        return
+    s = Span(name, start, attrs)
+    s.end = start + duration
+    trace.stack[-1].children.append(s)
+    trace.count += 1
+
+
+class span:
+    """`with tracing.span('stage', key=value):` — a child of the open span."""
+    __slots__ = ('name', 'attrs', '_span')
+
+    def __init__(self, name: str, **attrs):
+        self.name = name
+        self.attrs = attrs or None
+
+    def __enter__(self):
+        self._span = start_span(self.name, self.attrs)
+        return self._span
+
+    def __exit__(self, exc_type, exc, tb):
+        end_span(self._span, exc)
+        return False
+
+
+def traced(name: str):
+    """Decorator: run the function inside a span called `name`."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            s = start_span(name)
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                end_span(s, e)
+                s = None
+                raise
+            finally:
+                end_span(s)
+        return wrapper
+    return decorator
+
+
+# --------------------- Request hooks ---------------------
+
+_TOKEN = re.compile(r'[^A-Za-z0-9_.\-]')
+
+
+def server_timing(trace: Trace, limit: int = 30) -> str:
+    """Summed duration per span name, then the request total."""
+    totals: Dict[str, float] = {}
+    pending = list(trace.root.children)
+    while pending:
+        s = pending.pop(0)
+        totals[s.name] = totals.get(s.name, 0.0) + s.duration
+        pending.extend(s.children)
+    parts = [f"{_TOKEN.sub('_', name)};dur={seconds * 1000:.1f}"
+             for name, seconds in list(totals.items())[:limit]]
+    parts.append(f"total;dur={trace.root.duration * 1000:.1f}")
+    return ', '.join(parts)
+
+
+_slow_log: Optional[logging.Logger] = None
+
+
+def _slow_logger() -> logging.Logger:
+    global _slow_log
+    if _slow_log is None:
+        logger = logging.getLogger('cityfix.slow_requests')
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        if Config.TRACE_LOG_PATH:
+            handler = RotatingFileHandler(Config.TRACE_LOG_PATH, maxBytes=5 * 1024 * 1024,
+                                          backupCount=3)
+        else:
+            handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        _slow_log = logger
+    return _slow_log
+
+
+def _log_slow(trace: Trace, status: int):
+    root = trace.root
+    user = getattr(request, 'user', None) or {}
+    record = {
+        'ts': datetime.now(timezone.utc).isoformat(),
+        'method': request.method,
+        'path': request.path,
+        'endpoint': request.endpoint,
+        'status': status,
+        'uid': user.get('uid') if isinstance(user, dict) else None,
+        'total_ms': round(root.duration * 1000, 2),
+        'spans': [child.to_dict(root.start) for child in root.children],
+    }
+    if trace.dropped:
+        record['dropped_spans'] = trace.dropped
+    try:
+        _slow_logger().info(json.dumps(record, default=str))
+    except Exception as e:
+        print(f"Slow request log error: {e}")
+
+
+def init_app(app):
+    """Trace every request; add Server-Timing and log slow ones."""
+    if not app.config['TRACING_ENABLED']:
+        return
+
+    @app.before_request
+    def _trace_start():
+        g._trace = Trace()
+
+    @app.after_request
+    def _trace_finish(response):
+        trace = g.pop('_trace', None)
+        if trace is None:
+            return response
+        trace.root.end = perf_counter()
+        response.headers['Server-Timing'] = server_timing(trace)
+        if (trace.root.duration * 1000 >= app.config['TRACE_SLOW_MS']
+                and random.random() < app.config['TRACE_SAMPLE_RATE']):
+            _log_slow(trace, response.status_code)
+        return response
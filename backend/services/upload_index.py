@@ -0,0 +1,216 @@
+"""Content-hash index of uploaded photos.
+
+`upload_hashes/{sha256}` maps the exact bytes of a photo to the first
+stored copy: its path and URL, derivatives, perceptual hash, the complaints
+that used it and the AI results computed for it. A re-upload of identical
+bytes is answered from this document instead of storing another copy, and
+complaints created from it reuse the cached AI results.
+
+Photos are shared between users by content, but what other users did with
+them is not: complaint ids are also kept per user (`user_complaints.{uid}`)
+and only the requester's own are returned, and a non-owner gets only the
+AI results that depend on the image alone (`IMAGE_AI_KEYS`).
+
+The dHash is split into four 16-bit bands stored in `phash_bands`, so
+near-identical photos (re-encoded, resized) are found with one
+`array_contains_any` query and then filtered by Hamming distance.
+"""
+from config import Config
+from typing import Any, Dict, List, Optional
+import hashlib
+
+COLLECTION = 'upload_hashes'
+PHASH_BANDS = 4
+# Cached AI results computed from the photo only (summary and priority also
+# depend on the description someone wrote)
+IMAGE_AI_KEYS = ('type', 'predicted_type', 'ai_tags')
+
+
+def _collection():
+    from services.firebase_service import get_firestore
+    return get_firestore().collection(COLLECTION)
+
+
+def _entry(snap) -> Optional[Dict[str, Any]]:
+    if snap is None or not snap.exists:
+        return None
+    entry = snap.to_dict() or {}
+    entry['content_hash'] = snap.id
+    return entry
+
+
+def _first(query) -> Optional[Dict[str, Any]]:
+    try:
+        for snap in query.limit(1).stream():
+            return _entry(snap)
+    except Exception as e:
+        print(f"Upload index lookup error: {e}")
+    return None
+
+
+def phash_bands(phash: str) -> List[str]:
+    width = len(phash) // PHASH_BANDS
+    return [f"{i}:{phash[i * width:(i + 1) * width]}" for i in range(PHASH_BANDS)]
+
+
+def description_hash(description: Optional[str]) -> str:
+    return hashlib.sha256((description or '').strip().encode('utf-8')).hexdigest()
+
+
+def lookup(sha256: str) -> Optional[Dict[str, Any]]:
+    try:
+        return _entry(_collection().document(sha256).get())
+    except Exception as e:
+        print(f"Upload index lookup error: {e}")
+        return None
+
+
+def lookup_md5(md5: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Match by the MD5 GCS reports, for objects uploaded directly to Storage."""
+    if not md5:
+        return None
+    return _first(_collection().where('md5', '==', md5))
+
+
+def lookup_by_url(photo_url: Optional[str]) -> Optional[Dict[str, Any]]:
+    from services.image_service import object_path_from_url
+    path = object_path_from_url(photo_url)
+    if not path:
+        return None
+    return _first(_collection().where('path', '==', path))
+
+
+def similar(phash: Optional[str], exclude: Optional[str] = None,
+            limit: int = 5) -> List[Dict[str, Any]]:
+    """Indexed photos within UPLOAD_PHASH_MAX_DISTANCE bits of `phash`."""
+    if not phash:
+        return []
+    from services.image_service import hamming
+    query = _collection().where('phash_bands', 'array_contains_any', phash_bands(phash))
+    matches = []
+    try:
+        snaps = list(query.limit(50).stream())
+    except Exception as e:
+        print(f"Upload index similarity error: {e}")
+        return []
+    for snap in snaps:
+        entry = _entry(snap)
+        if snap.id == exclude or not entry.get('phash'):
+            continue
+        distance = hamming(phash, entry['phash'])
+        if distance <= Config.UPLOAD_PHASH_MAX_DISTANCE:
+            matches.append({
+                'content_hash': snap.id,
+                'photo_url': entry.get('url'),
+                'complaint_ids': entry.get('complaint_ids', []),
+                'user_complaints': entry.get('user_complaints') or {},
+                'distance': distance,
+            })
+    matches.sort(key=lambda m: m['distance'])
+    return matches[:limit]
+
+
+def record(sha256: str, md5: str, stored: Dict[str, Any], derivatives: Dict[str, str],
+           phash: Optional[str], uid: str) -> bool:
+    """Index the first stored copy of `sha256`.
+
+    Returns False if another upload indexed the same bytes first (its entry
+    is kept) or the write failed.
+    """
+    from firebase_admin import firestore
+    from google.api_core.exceptions import AlreadyExists
+    try:
+        # create(), not set(): concurrent uploads of the same bytes must not
+        # replace each other's entry
+        _collection().document(sha256).create({
+            'md5': md5,
+            'path': stored['path'],
+            'url': stored['url'],
+            'download_token': stored.get('download_token'),
+            'derivatives': derivatives,
+            'phash': phash,
+            'phash_bands': phash_bands(phash) if phash else [],
+            'uploaded_by': uid,
+            'complaint_ids': [],
+            'user_complaints': {},
+            'created_at': firestore.SERVER_TIMESTAMP,
+        })
+        return True
+    except AlreadyExists:
+        return False
+    except Exception as e:
+        print(f"Upload index record error for {sha256}: {e}")
+        return False
+
+
+def remember_ai(sha256: str, ai: Optional[Dict[str, Any]] = None,
+                complaint_id: Optional[str] = None, uid: Optional[str] = None):
+    """Merge AI results into a photo's cache and/or link `uid`'s complaint that used it."""
+    from firebase_admin import firestore
+    update: Dict[str, Any] = {f"ai.{key}": value for key, value in (ai or {}).items()}
+    if complaint_id:
+        update['complaint_ids'] = firestore.ArrayUnion([complaint_id])
+        if uid:
+            update[f'user_complaints.{uid}'] = firestore.ArrayUnion([complaint_id])
+    if update:
+        try:
+            _collection().document(sha256).update(update)
+        except Exception as e:
+            print(f"Upload index update error for {sha256}: {e}")
+
+
+def own_complaints(entry: Optional[Dict[str, Any]], uid: str) -> List[str]:
+    """Ids of `uid`'s complaints that used the photo."""
+    return list(((entry or {}).get('user_complaints') or {}).get(uid) or [])
+
+
+def visible_ai(entry: Optional[Dict[str, Any]], uid: str) -> Optional[Dict[str, Any]]:
+    """Cached AI results `uid` may see: all for the uploader, image-only otherwise."""
+    ai = (entry or {}).get('ai')
+    if not ai or entry.get('uploaded_by') == uid:
+        return ai
+    return {key: ai[key] for key in IMAGE_AI_KEYS if key in ai} or None
+
+
+def duplicate_payload(entry: Dict[str, Any], uid: str) -> Dict[str, Any]:
+    """Upload response for an exact re-submission of an indexed photo by `uid`."""
+    return {
+        'success': True,
+        'photo_url': entry['url'],
+        'filename': entry['path'],
+        'derivatives': entry.get('derivatives') or {},
+        'content_hash': entry['content_hash'],
+        'duplicate': True,
+        'duplicate_of': own_complaints(entry, uid),
+        'ai': visible_ai(entry, uid),
+    }
+
+
+def index_stored_object(path: str, stored: Dict[str, Any], uid: str):
+    """Background job after an upload: hash, render derivatives, index.
+
+    Proxy uploads were indexed by hash while streaming, so only their
+    derivatives and dHash are filled in here. Direct uploads are first
+    indexed here, once their bytes have been read back from Storage.
+    """
+    from services.firebase_service import download_bytes
+    from services.image_service import content_hashes, store_derivatives
+    try:
+        data = download_bytes(path)
+    except Exception as e:
+        print(f"Upload index download error for {path}: {e}")
+        return
+    sha256, md5 = content_hashes(data)
+    derivatives, phash = store_derivatives(path, data, stored.get('download_token'))
+    existing = lookup(sha256)
+    if existing is None:
+        record(sha256, md5, stored, derivatives, phash, uid)
+    elif existing['path'] == path:
+        try:
+            _collection().document(sha256).update({
+                'derivatives': derivatives,
+                'phash': phash,
+                'phash_bands': phash_bands(phash) if phash else [],
+            })
+        except Exception as e:
+            print(f"Upload index update error for {sha256}: {e}")
@@ -0,0 +1,346 @@
+"""Cached user profiles and roles, plus write-behind profile touches.
+
+`admin_required` used to read `users/{uid}` on every admin call. Profiles
+are now served from a TTL cache that a Firestore snapshot listener on admin
+user documents keeps current, and a `role` custom claim on the ID token can
+authorize admins without any read at all. A claim outlives a demotion until
+the token is refreshed, so it is only trusted for users the listener
+currently reports as admins (and only when SYNC_ROLE_CLAIMS keeps claims in
+step with the documents); everyone else falls back to the profile.
+
+`/api/auth/verify` runs on every page load; instead of writing the user
+document each time it queues a touch that is coalesced per uid and flushed
+in batched writes from a background thread. Whether the user exists comes
+from the cached profile, even a stale one, so a returning user costs no read;
+the flush uses `update()`, so a profile deleted in the meantime is not
+recreated.
+"""
+from config import Config
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+import atexit
+import threading
+import time
+
+
+class _ProfileCache:
+    """uid -> (profile or None when the doc is missing, cached_at)."""
+
+    def __init__(self, ttl_seconds: float):
+        self.ttl = ttl_seconds
+        self._entries: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, uid: str, stale_ok: bool = False):
+        """Return (found, profile); found is False when absent or stale.
+
+        `stale_ok` accepts an expired entry, for callers that only need to
+        know whether the user exists.
+        """
+        with self._lock:
+            entry = self._entries.get(uid)
+            if entry is None or (not stale_ok and time.time() - entry[1] >= self.ttl):
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            return True, entry[0]
+
+    def put(self, uid: str, profile: Optional[Dict[str, Any]]):
+        with self._lock:
+            self._entries[uid] = (profile, time.time())
+
+    def patch(self, uid: str, fields: Dict[str, Any]):
+        """Change a cached profile's fields without making the entry fresher."""
+        with self._lock:
+            entry = self._entries.get(uid)
+            if entry is not None and entry[0] is not None:
+                self._entries[uid] = ({**entry[0], **fields}, entry[1])
+
+    def discard(self, uid: str):
+        with self._lock:
+            self._entries.pop(uid, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'ttl_seconds': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+_cache = _ProfileCache(Config.ROLE_CACHE_TTL_SECONDS)
+_listener = None
+_listener_ready = False    # set once the initial snapshot has arrived
+_admins = set()            # uids the listener currently reports as admins
+_admins_lock = threading.Lock()
+
+
+def get_user_profile(uid: str) -> Optional[Dict[str, Any]]:
+    """Profile dict for `uid` (None if the user doc does not exist)."""
+    found, profile = _cache.get(uid)
+    if not found:
+        from services.firebase_service import get_document
+        profile = get_document('users', uid)
+        _cache.put(uid, profile)
+    return dict(profile) if profile is not None else None
+
+
+def peek_user_profile(uid: str):
+    """(found, profile) from the cache only; never reads Firestore."""
+    found, profile = _cache.get(uid)
+    return found, (dict(profile) if profile is not None else None)
+
+
+def put_user_profile(uid: str, profile: Optional[Dict[str, Any]]):
+    _cache.put(uid, dict(profile) if profile is not None else None)
+
+
+def invalidate_user(uid: str):
+    _cache.discard(uid)
+
+
+def _claims_trusted(uid: Optional[str]) -> bool:
+    """Whether a token's role claim can be believed for `uid` right now."""
+    if not (Config.ROLE_FROM_CLAIMS and Config.SYNC_ROLE_CLAIMS) or not uid:
+        return False
+    with _admins_lock:
+        return _listener_ready and uid in _admins
+
+
+def role_from_claims(decoded_token: Dict[str, Any]) -> Optional[str]:
+    """Role carried as a custom claim (`role: 'admin'` or `admin: true`).
+
+    None unless the claim can be trusted (see `_claims_trusted`); callers
+    then read the profile instead.
+    """
+    if not decoded_token or not _claims_trusted(decoded_token.get('uid')):
+        return None
+    if decoded_token.get('role'):
+        return str(decoded_token['role'])
+    if decoded_token.get('admin') is True:
+        return 'admin'
+    return None
+
+
+def _sync_claims(uid: str, role: Optional[str]):
+    if not Config.SYNC_ROLE_CLAIMS:
+        return
+    try:
+        from firebase_admin import auth
+        auth.set_custom_user_claims(uid, {'role': role or 'user'})
+    except Exception as e:
+        print(f"Role claim sync error for {uid}: {e}")
+
+
+def _on_admin_snapshot(docs, changes, read_time):
+    global _listener_ready
+    from services.firebase_service import get_firestore
+    with _admins_lock:
+        # Update the admin set first: a demoted user's claim stops counting
+        # before their profile is re-read
+        for change in changes:
+            kind = getattr(change.type, 'name', str(change.type))
+            if kind in ('ADDED', 'MODIFIED'):
+                _admins.add(change.document.id)
+            elif kind == 'REMOVED':
+                _admins.discard(change.document.id)
+        _listener_ready = True
+    for change in changes:
+        uid = change.document.id
+        kind = getattr(change.type, 'name', str(change.type))
+        if kind in ('ADDED', 'MODIFIED'):
+            profile = change.document.to_dict() or {}
+            put_user_profile(uid, profile)
+            _sync_claims(uid, profile.get('role'))
+        elif kind == 'REMOVED':
+            # Left the admin set (demoted or deleted): cache the current doc
+            try:
+                snap = get_firestore().collection('users').document(uid).get()
+                profile = snap.to_dict() if snap.exists else None
+                put_user_profile(uid, profile)
+                _sync_claims(uid, (profile or {}).get('role'))
+            except Exception:
+                invalidate_user(uid)
+
+
+def start_admin_listener():
+    """Watch admin user docs so role changes reach the cache immediately."""
+    global _listener
+    if _listener is not None:
+        return
+    try:
+        from services.firebase_service import get_firestore
+        query = get_firestore().collection('users').where('role', '==', 'admin')
+        _listener = query.on_snapshot(_on_admin_snapshot)
+    except Exception as e:
+        print(f"Admin role listener not started: {e}")
+
+
+def profile_cache_stats() -> Dict[str, Any]:
+    stats = _cache.stats()
+    stats['listener'] = _listener is not None
+    with _admins_lock:
+        stats['listener_ready'] = _listener_ready
+        stats['admins'] = len(_admins)
+    return stats
+
+
+# --------------------- Write-behind profile touches ---------------------
+
+class _WriteBehind:
+    """Coalesces per-uid field updates and flushes them in batched writes."""
+
+    BATCH_LIMIT = 500
+
+    def __init__(self, interval_seconds: float):
+        self.interval = interval_seconds
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self.queued = 0
+        self.written = 0
+        self.failed = 0
+        self.dropped = 0    # touches for profiles deleted before the flush
+
+    def queue(self, uid: str, fields: Dict[str, Any]):
+        with self._lock:
+            self._pending.setdefault(uid, {}).update(fields)
+            self.queued += 1
+        self._ensure_thread()
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name='profile-write-behind', daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def flush(self) -> int:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        from google.api_core.exceptions import NotFound
+        from services.firebase_service import get_firestore
+        written = 0
+        items = list(pending.items())
+        try:
+            db = get_firestore()
+            users = db.collection('users')
+            for start in range(0, len(items), self.BATCH_LIMIT):
+                chunk = items[start:start + self.BATCH_LIMIT]
+                batch = db.batch()
+                for uid, fields in chunk:
+                    # update(), not a merge-set: never recreate a deleted profile
+                    batch.update(users.document(uid), fields)
+                try:
+                    batch.commit()
+                    written += len(chunk)
+                except NotFound:
+                    # Some profile was deleted since it was cached: write one by one
+                    written += self._update_each(users, chunk)
+                except Exception as e:
+                    print(f"Profile write-behind error: {e}")
+                    self._requeue(chunk)
+        except Exception as e:
+            print(f"Profile write-behind error: {e}")
+            self._requeue(items[written:])
+        self.written += written
+        return written
+
+    def _update_each(self, users, chunk) -> int:
+        from google.api_core.exceptions import NotFound
+        written = 0
+        for uid, fields in chunk:
+            try:
+                users.document(uid).update(fields)
+                written += 1
+            except NotFound:
+                self.dropped += 1
+                invalidate_user(uid)
+            except Exception as e:
+                print(f"Profile write-behind error: {e}")
+                self._requeue([(uid, fields)])
+        return written
+
+    def _requeue(self, items):
+        with self._lock:
+            self.failed += len(items)
+            for uid, fields in items:
+                # Newer queued values win over the failed ones
+                self._pending[uid] = {**fields, **self._pending.get(uid, {})}
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'pending': len(self._pending), 'queued': self.queued,
+                    'written': self.written, 'failed': self.failed, 'dropped': self.dropped,
+                    'interval_seconds': self.interval}
+
+
+_write_behind = _WriteBehind(Config.PROFILE_WRITE_BEHIND_SECONDS)
+
+
+def touch_user(uid: str, email: Optional[str], name: Optional[str]) -> Dict[str, Any]:
+    """Record a session verify for `uid`, creating the profile if needed.
+
+    Only a brand-new user is written synchronously. Existing users get a
+    coalesced write-behind touch: `last_seen_at` always, `email`/`name`/
+    `updated_at` only when they actually changed. Firestore is read only
+    the first time this process sees `uid`.
+    """
+    from firebase_admin import firestore
+    found, profile = _cache.get(uid, stale_ok=True)
+    if found:
+        profile = dict(profile) if profile is not None else None
+    else:
+        profile = get_user_profile(uid)
+    if profile is None:
+        from google.api_core.exceptions import AlreadyExists
+        from services.firebase_service import get_firestore
+        profile = {
+            'uid': uid,
+            'email': email,
+            'name': name,
+            'role': 'user',
+            'created_at': firestore.SERVER_TIMESTAMP,
+            'updated_at': firestore.SERVER_TIMESTAMP,
+        }
+        try:
+            get_firestore().collection('users').document(uid).create(profile)
+            invalidate_user(uid)
+            return profile
+        except AlreadyExists:
+            # Created since we cached it as missing (another instance)
+            invalidate_user(uid)
+            profile = get_user_profile(uid) or profile
+
+    fields: Dict[str, Any] = {'last_seen_at': datetime.now(timezone.utc)}
+    if profile.get('email') != email or profile.get('name') != name:
+        fields.update({'email': email, 'name': name,
+                       'updated_at': firestore.SERVER_TIMESTAMP})
+        _cache.patch(uid, {'email': email, 'name': name})
+    _write_behind.queue(uid, fields)
+    return profile
+
+
+def flush_profile_writes() -> int:
+    return _write_behind.flush()
+
+
+def write_behind_stats() -> Dict[str, Any]:
+    return _write_behind.stats()